@@ -25,16 +25,20 @@ import asyncio
 import threading
 import asyncio
 import itertools
+import bisect
+import time
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List, Iterator
+
+from aiorpcx import run_in_thread
 
 from . import bitcoin, util
 from .bitcoin import COINBASE_MATURITY
 from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException
 from .transaction import Transaction, TxOutput, TxInput, PartialTxInput, TxOutpoint, PartialTransaction
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
-from .blockchain import hash_header
 from .i18n import _
 from .logging import Logger
 
@@ -55,6 +59,14 @@ class HistoryItem(NamedTuple):
     delta: int
     fee: Optional[int]
     balance: int
+    monotonic_timestamp: int  # max timestamp of this and all previous txs
+
+
+class IndexedTxo(NamedTuple):
+    """A wallet txo, as stored in the UTXO index."""
+    txid: str
+    value: int
+    is_coinbase: bool
 
 
 class TxWalletDelta(NamedTuple):
@@ -65,6 +77,111 @@ class TxWalletDelta(NamedTuple):
     fee: Optional[int]
 
 
+class HistoryIndex:
+    """Wallet history, ordered by tx position, with running balances.
+
+    AddressSynchronizer keeps this up to date as txs are added, removed,
+    or change position (e.g. when they get mined or reorged), so that the
+    history does not need to be recomputed from scratch.
+    """
+
+    def __init__(self):
+        self._keys = []  # type: List[Tuple[float, int, str]]  # sorted list of (height, txpos, txid)
+        self._key_of_tx = {}  # type: Dict[str, Tuple[float, int, str]]
+        self._delta_of_tx = {}  # type: Dict[str, int]
+        self._timestamp_of_tx = {}  # type: Dict[str, Optional[int]]
+        # running balance and monotonic timestamp after each tx.
+        # only the first _num_valid_running_values items are up to date
+        self._balances = []  # type: List[int]
+        self._monotonic_timestamps = []  # type: List[int]
+        self._num_valid_running_values = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, txid: str) -> bool:
+        return txid in self._key_of_tx
+
+    def _invalidate_running_values(self, idx: int) -> None:
+        self._num_valid_running_values = min(self._num_valid_running_values, idx)
+
+    def _pop(self, txid: str) -> None:
+        key = self._key_of_tx.pop(txid)
+        del self._delta_of_tx[txid]
+        del self._timestamp_of_tx[txid]
+        idx = bisect.bisect_left(self._keys, key)
+        del self._keys[idx]
+        del self._balances[idx]
+        del self._monotonic_timestamps[idx]
+        self._invalidate_running_values(idx)
+
+    def add(self, txid: str, txpos: Tuple[float, int], delta: int, timestamp: Optional[int]) -> None:
+        """Adds txid to the history, or updates its position, delta and timestamp."""
+        key = (txpos[0], txpos[1], txid)
+        if self._key_of_tx.get(txid) == key:
+            if (self._delta_of_tx[txid], self._timestamp_of_tx[txid]) != (delta, timestamp):
+                self._delta_of_tx[txid] = delta
+                self._timestamp_of_tx[txid] = timestamp
+                self._invalidate_running_values(bisect.bisect_left(self._keys, key))
+            return
+        if txid in self._key_of_tx:
+            self._pop(txid)
+        idx = bisect.bisect_left(self._keys, key)
+        self._keys.insert(idx, key)
+        self._balances.insert(idx, 0)
+        self._monotonic_timestamps.insert(idx, 0)
+        self._key_of_tx[txid] = key
+        self._delta_of_tx[txid] = delta
+        self._timestamp_of_tx[txid] = timestamp
+        self._invalidate_running_values(idx)
+
+    def remove(self, txid: str) -> None:
+        if txid in self._key_of_tx:
+            self._pop(txid)
+
+    def _update_running_values(self) -> None:
+        idx = self._num_valid_running_values
+        balance = self._balances[idx - 1] if idx > 0 else 0
+        monotonic_timestamp = self._monotonic_timestamps[idx - 1] if idx > 0 else 0
+        for i in range(idx, len(self._keys)):
+            txid = self._keys[i][2]
+            balance += self._delta_of_tx[txid]
+            monotonic_timestamp = max(monotonic_timestamp, self._timestamp_of_tx[txid] or 999_999_999_999)
+            self._balances[i] = balance
+            self._monotonic_timestamps[i] = monotonic_timestamp
+        self._num_valid_running_values = len(self._keys)
+
+    def get_balance(self) -> int:
+        self._update_running_values()
+        return self._balances[-1] if self._balances else 0
+
+    def get_position(self, txid: str) -> int:
+        """Returns the position of txid in the history. Raises KeyError if not found."""
+        return bisect.bisect_left(self._keys, self._key_of_tx[txid])
+
+    def get_position_after(self, key: Tuple[float, int, str]) -> int:
+        """Returns the position of the first tx whose (height, txpos, txid) key is > key.
+        key does not need to be in the history.
+        """
+        return bisect.bisect_right(self._keys, key)
+
+    def get_position_of_timestamp(self, timestamp: int) -> int:
+        """Returns the position of the first tx that has a monotonic timestamp >= timestamp.
+        txs before that position all have a timestamp < timestamp.
+        """
+        self._update_running_values()
+        return bisect.bisect_left(self._monotonic_timestamps, timestamp)
+
+    def items(self, start: int = 0) -> Iterator[Tuple[str, int, int, Optional[int], int]]:
+        """Yields (txid, delta, balance, timestamp, monotonic_timestamp)
+        tuples, oldest first, starting at position start.
+        """
+        self._update_running_values()
+        for i in range(start, len(self._keys)):
+            txid = self._keys[i][2]
+            yield txid, self._delta_of_tx[txid], self._balances[i], self._timestamp_of_tx[txid], self._monotonic_timestamps[i]
+
+
 class AddressSynchronizer(Logger):
     """
     inherited by wallet
@@ -91,8 +208,8 @@ class AddressSynchronizer(Logger):
         self.up_to_date = False
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
-
-        self._get_addr_balance_cache = {}
+        # history of the whole wallet. built lazily, on first use. Access with self.lock.
+        self._history_index = None  # type: Optional[HistoryIndex]
 
         self.load_and_cleanup()
 
@@ -110,6 +227,7 @@ class AddressSynchronizer(Logger):
 
     def load_and_cleanup(self):
         self.load_local_history()
+        self.load_utxo_index()
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
@@ -189,13 +307,17 @@ class AddressSynchronizer(Logger):
 
     def start_network(self, network: Optional['Network']) -> None:
         self.network = network
+        # pruning holds transaction_lock per item, as add_transaction records
+        # spent outpoints before the tx that spends them
+        remove_unreferenced_data = partial(self.db.remove_unreferenced_data, lock=self.transaction_lock)
         if self.network is not None:
             self.synchronizer = Synchronizer(self)
             self.verifier = SPV(self.network, self)
-            util.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
-
-    def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+            # this walks the whole history, do not block the caller
+            asyncio.run_coroutine_threadsafe(
+                run_in_thread(remove_unreferenced_data), self.network.asyncio_loop)
+        else:
+            remove_unreferenced_data()
 
     def stop(self):
         if self.network:
@@ -205,7 +327,6 @@ class AddressSynchronizer(Logger):
             if self.verifier:
                 asyncio.run_coroutine_threadsafe(self.verifier.stop(), self.network.asyncio_loop)
                 self.verifier = None
-            util.unregister_callback(self.on_blockchain_updated)
             self.db.put('stored_height', self.get_local_height())
 
     def add_address(self, address):
@@ -310,7 +431,8 @@ class AddressSynchronizer(Logger):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v)
-                        self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                        touched_coins.add((addr, prevout_hash, prevout_n))
+            touched_coins = set()
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -328,17 +450,21 @@ class AddressSynchronizer(Logger):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    touched_coins.add((addr, tx_hash, n))
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
                         self._add_tx_to_local_history(next_tx)
+                        self._update_tx_in_history_index(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
             self.db.add_num_inputs_to_tx(tx_hash, len(tx.inputs()))
+            for coin in touched_coins:
+                self._update_coin_in_utxo_index(*coin)
+            self._update_tx_in_history_index(tx_hash)
             return True
 
     def remove_transaction(self, tx_hash: str) -> None:
@@ -364,13 +490,16 @@ class AddressSynchronizer(Logger):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            touched_coins = self._get_coins_of_tx(tx_hash)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
             self.db.remove_verified_tx(tx_hash)
             self.unverified_tx.pop(tx_hash, None)
+            for coin in touched_coins:
+                self._update_coin_in_utxo_index(*coin)
+            if self._history_index is not None:
+                self._history_index.remove(tx_hash)
             if tx:
                 for idx, txo in enumerate(tx.outputs()):
                     scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
@@ -391,17 +520,31 @@ class AddressSynchronizer(Logger):
         self.add_unverified_tx(tx_hash, tx_height)
         self.add_transaction(tx, allow_unrelated=True)
 
-    def receive_history_callback(self, addr: str, hist, tx_fees: Dict[str, int]):
+    def get_address_history_status(self, addr: str) -> Optional[str]:
+        """Returns the status hash of the server-provided history of addr
+        (db.get_addr_history), as a server would announce it.
+        It is stored along with the history, so that it does not have to be
+        recomputed each time we compare it with the status of a server.
+        """
+        status = self.db.get_addr_history_status(addr)
+        if status is None:
+            # not stored yet, e.g. history from an older version
+            status = history_status(self.db.get_addr_history(addr))
+            if status is not None:
+                self.db.set_addr_history_status(addr, status)
+        return status
+
+    def receive_history_callback(self, addr: str, hist, tx_fees: Dict[str, int], *, status: str = None):
         with self.lock:
             old_hist = self.get_address_history(addr)
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
-                    self.db.remove_verified_tx(tx_hash)
+                    self._remove_verified_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
-            self.db.set_addr_history(addr, hist)
+            self.db.set_addr_history(addr, hist, status=status)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -440,8 +583,10 @@ class AddressSynchronizer(Logger):
 
     def remove_local_transactions_we_dont_have(self):
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
+            if self.db.has_transaction(txid):
+                continue
             tx_height = self.get_tx_height(txid).height
-            if tx_height == TX_HEIGHT_LOCAL and not self.db.get_transaction(txid):
+            if tx_height == TX_HEIGHT_LOCAL:
                 self.remove_transaction(txid)
 
     def clear_history(self):
@@ -449,6 +594,108 @@ class AddressSynchronizer(Logger):
             with self.transaction_lock:
                 self.db.clear_history()
                 self._history_local.clear()
+                self._utxos.clear()
+                self._unsettled_spent_txos.clear()
+                self._history_index = None
+
+    @profiler
+    def load_utxo_index(self):
+        # The UTXO index lets us compute utxos and balances without walking
+        # the history of each address. Coins that have been spent are only
+        # kept in the index while they can still affect the balance, i.e.
+        # until both the funding and the spending tx are SPV-verified.
+        self._utxos = defaultdict(dict)  # type: Dict[str, Dict[str, IndexedTxo]]  # addr -> prevout_str -> txo
+        # addr -> prevout_str -> (txo, spending txid)
+        self._unsettled_spent_txos = defaultdict(dict)  # type: Dict[str, Dict[str, Tuple[IndexedTxo, str]]]
+        with self.transaction_lock:
+            for txid in self.db.list_txo():
+                for addr in self.db.get_txo_addresses(txid):
+                    for n in self.db.get_txo_addr(txid, addr):
+                        self._update_coin_in_utxo_index(addr, txid, n)
+
+    def _update_coin_in_utxo_index(self, addr: str, prevout_hash: str, prevout_n: int) -> None:
+        """Recomputes the index entry of a coin from the db."""
+        with self.transaction_lock:
+            prevout_str = f'{prevout_hash}:{prevout_n}'
+            self._utxos[addr].pop(prevout_str, None)
+            self._unsettled_spent_txos[addr].pop(prevout_str, None)
+            try:
+                v, is_cb = self.db.get_txo_addr(prevout_hash, addr)[prevout_n]
+            except KeyError:
+                return  # not a wallet coin (anymore)
+            txo = IndexedTxo(txid=prevout_hash, value=v, is_coinbase=is_cb)
+            spending_txid = self.db.get_spent_outpoint(prevout_hash, prevout_n)
+            if spending_txid is None:
+                self._utxos[addr][prevout_str] = txo
+            elif (is_cb
+                  or not self.db.is_in_verified_tx(prevout_hash)
+                  or not self.db.is_in_verified_tx(spending_txid)):
+                self._unsettled_spent_txos[addr][prevout_str] = (txo, spending_txid)
+
+    def _get_coins_of_tx(self, txid: str) -> Set[Tuple[str, str, int]]:
+        """Returns the wallet coins funded or spent by txid,
+        as (address, prevout_hash, prevout_n) tuples.
+        """
+        coins = set()
+        with self.transaction_lock:
+            for addr in self.db.get_txo_addresses(txid):
+                for n in self.db.get_txo_addr(txid, addr):
+                    coins.add((addr, txid, n))
+            for addr in self.db.get_txi_addresses(txid):
+                for ser, v in self.db.get_txi_addr(txid, addr):
+                    prevout_hash, prevout_n = ser.split(':')
+                    coins.add((addr, prevout_hash, int(prevout_n)))
+        return coins
+
+    def _update_coins_of_tx_in_utxo_index(self, txid: str) -> None:
+        with self.transaction_lock:
+            for coin in self._get_coins_of_tx(txid):
+                self._update_coin_in_utxo_index(*coin)
+
+    def _remove_verified_tx(self, txid: str) -> None:
+        with self.lock, self.transaction_lock:
+            self.db.remove_verified_tx(txid)
+            self._update_coins_of_tx_in_utxo_index(txid)
+            self._update_tx_in_history_index(txid)
+
+    def _get_wallet_delta_of_txid(self, txid: str) -> Optional[int]:
+        """Returns the effect of txid on the wallet,
+        or None if txid does not touch any wallet address.
+        """
+        delta = None
+        with self.transaction_lock:
+            for addr in set(itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid))):
+                if self.is_mine(addr):
+                    delta = (delta or 0) + self.get_tx_delta(txid, addr)
+        return delta
+
+    def _update_tx_in_history_index(self, txid: str) -> None:
+        with self.lock, self.transaction_lock:
+            if self._history_index is None:
+                return
+            delta = self._get_wallet_delta_of_txid(txid)
+            if delta is None:
+                self._history_index.remove(txid)
+            else:
+                self._history_index.add(txid, self.get_txpos(txid), delta, self.get_tx_height(txid).timestamp)
+
+    def reset_history_index(self) -> None:
+        """Forces the history index to be rebuilt, e.g. after an address was deleted."""
+        with self.lock:
+            self._history_index = None
+
+    @profiler
+    def _build_history_index(self) -> HistoryIndex:
+        history_index = HistoryIndex()
+        with self.lock, self.transaction_lock:
+            txids = set()
+            for addr in self.get_addresses():
+                txids |= self._history_local.get(addr, set())
+            for txid in txids:
+                delta = self._get_wallet_delta_of_txid(txid)
+                if delta is not None:
+                    history_index.add(txid, self.get_txpos(txid), delta, self.get_tx_height(txid).timestamp)
+        return history_index
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -477,10 +724,22 @@ class AddressSynchronizer(Logger):
     @with_lock
     @with_transaction_lock
     @with_local_height_cached
-    def get_history(self, *, domain=None) -> Sequence[HistoryItem]:
-        # get domain
+    def get_history(self, *, domain=None, from_timestamp=None, to_timestamp=None,
+                    after_txid: str = None, after_txpos: Tuple[float, int, str] = None,
+                    offset: int = 0, limit: int = None) -> Sequence[HistoryItem]:
+        """Returns the history of domain (default: the whole wallet), oldest first.
+
+        from_timestamp, to_timestamp: only return txs in this time range.
+            Unconfirmed txs are considered to happen now.
+        after_txid: only return txs after this one (a cursor, for paging).
+        after_txpos: only return txs after this (height, txpos, txid) position.
+            Unlike after_txid, it still works if that tx left the history.
+        offset, limit: skip the first offset matching txs, return at most limit txs.
+        """
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_history_from_index(
+                from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+                after_txid=after_txid, after_txpos=after_txpos, offset=offset, limit=limit)
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -502,18 +761,74 @@ class AddressSynchronizer(Logger):
         balance = c + u + x
         h2 = []
         for tx_hash, tx_mined_status, delta, fee in history:
-            h2.append(HistoryItem(txid=tx_hash,
-                                  tx_mined_status=tx_mined_status,
-                                  delta=delta,
-                                  fee=fee,
-                                  balance=balance))
+            h2.append((tx_hash, tx_mined_status, delta, fee, balance))
             balance -= delta
         h2.reverse()
 
         if balance != 0:
             raise Exception("wallet.get_history() failed balance sanity-check")
 
-        return h2
+        h3 = []
+        monotonic_timestamp = 0
+        for tx_hash, tx_mined_status, delta, fee, balance in h2:
+            monotonic_timestamp = max(monotonic_timestamp, tx_mined_status.timestamp or 999_999_999_999)
+            h3.append(HistoryItem(txid=tx_hash,
+                                  tx_mined_status=tx_mined_status,
+                                  delta=delta,
+                                  fee=fee,
+                                  balance=balance,
+                                  monotonic_timestamp=monotonic_timestamp))
+        if after_txid is not None:
+            txids = [item.txid for item in h3]
+            if after_txid not in txids:
+                raise Exception(f"unknown txid: {after_txid}")
+            h3 = h3[txids.index(after_txid) + 1:]
+        if after_txpos is not None:
+            h3 = [item for item in h3 if (*self.get_txpos(item.txid), item.txid) > after_txpos]
+        now = time.time()
+        h3 = [item for item in h3
+              if not (from_timestamp and (item.tx_mined_status.timestamp or now) < from_timestamp)
+              and not (to_timestamp and (item.tx_mined_status.timestamp or now) >= to_timestamp)]
+        return h3[offset:offset + limit if limit is not None else None]
+
+    def _get_history_from_index(self, *, from_timestamp=None, to_timestamp=None,
+                                after_txid: str = None, after_txpos: Tuple[float, int, str] = None,
+                                offset: int = 0, limit: int = None) -> Sequence[HistoryItem]:
+        if self._history_index is None:
+            self._history_index = self._build_history_index()
+        history_index = self._history_index
+        if not any([from_timestamp, to_timestamp, after_txid, after_txpos, offset, limit is not None]):
+            if history_index.get_balance() != sum(self.get_balance()):
+                raise Exception("wallet.get_history() failed balance sanity-check")
+        start = 0
+        if after_txid is not None:
+            try:
+                start = history_index.get_position(after_txid) + 1
+            except KeyError:
+                raise Exception(f"unknown txid: {after_txid}") from None
+        if after_txpos is not None:
+            start = max(start, history_index.get_position_after(after_txpos))
+        if from_timestamp:
+            start = max(start, history_index.get_position_of_timestamp(from_timestamp))
+        now = time.time()
+        h = []
+        for txid, delta, balance, timestamp, monotonic_timestamp in history_index.items(start):
+            if limit is not None and len(h) >= limit:
+                break
+            if from_timestamp and (timestamp or now) < from_timestamp:
+                continue
+            if to_timestamp and (timestamp or now) >= to_timestamp:
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            h.append(HistoryItem(txid=txid,
+                                 tx_mined_status=self.get_tx_height(txid),
+                                 delta=delta,
+                                 fee=self.get_tx_fee(txid),
+                                 balance=balance,
+                                 monotonic_timestamp=monotonic_timestamp))
+        return h
 
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
@@ -553,25 +868,32 @@ class AddressSynchronizer(Logger):
         if self.db.is_in_verified_tx(tx_hash):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
-                    self.db.remove_verified_tx(tx_hash)
+                    self._remove_verified_tx(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
-                self.unverified_tx[tx_hash] = tx_height
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._update_tx_in_history_index(tx_hash)
+            if self.verifier and tx_height > 0:
+                self.verifier.wakeup()
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._update_tx_in_history_index(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
-        with self.lock:
+        with self.lock, self.transaction_lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._update_coins_of_tx_in_utxo_index(tx_hash)
+            self._update_tx_in_history_index(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -588,9 +910,9 @@ class AddressSynchronizer(Logger):
                 info = self.db.get_verified_tx(tx_hash)
                 tx_height = info.height
                 if tx_height > above_height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.db.remove_verified_tx(tx_hash)
+                    header = blockchain.read_header_view(tx_height)
+                    if not header or header.hash() != info.header_hash:
+                        self._remove_verified_tx(tx_hash)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
                         # If on the new fork after the reorg, the txn is at the
@@ -601,6 +923,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._update_tx_in_history_index(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -770,10 +1093,16 @@ class AddressSynchronizer(Logger):
         return out
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
+        out = {}
+        with self.lock, self.transaction_lock:
+            for prevout_str, txo in self._utxos.get(address, {}).items():
+                prevout = TxOutpoint.from_str(prevout_str)
+                utxo = PartialTxInput(prevout=prevout, is_coinbase_output=txo.is_coinbase)
+                utxo._trusted_address = address
+                utxo._trusted_value_sats = txo.value
+                utxo.block_height = self.get_tx_height(txo.txid).height
+                utxo.spent_height = None
+                out[prevout] = utxo
         return out
 
     # return the total amount ever received by an address
@@ -786,37 +1115,34 @@ class AddressSynchronizer(Logger):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        if not excluded_coins:  # cache is only used if there are no excluded_coins
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
         if excluded_coins is None:
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
         c = u = x = 0
         mempool_height = self.get_local_height() + 1  # height of next block
-        for txo, (tx_height, v, is_cb) in received.items():
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        with self.lock, self.transaction_lock:
+            utxos = self._utxos.get(address, {})
+            spent_txos = self._unsettled_spent_txos.get(address, {})
+            # note: spent coins that are not in the index anymore cancel out
+            for prevout_str, txo, spending_txid in itertools.chain(
+                    ((k, txo, None) for k, txo in utxos.items()),
+                    ((k, txo, s) for k, (txo, s) in spent_txos.items())):
+                if prevout_str in excluded_coins:
+                    continue
+                v = txo.value
+                tx_height = self.get_tx_height(txo.txid).height
+                if txo.is_coinbase and tx_height + COINBASE_MATURITY > mempool_height:
+                    x += v
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_addr_balance_cache[address] = result
-        return result
+                    u += v
+                if spending_txid is not None:
+                    if self.get_tx_height(spending_txid).height > 0:
+                        c -= v
+                    else:
+                        u -= v
+        return c, u, x
 
     @with_local_height_cached
     def get_utxos(self, domain=None, *, excluded_addresses=None,
@@ -830,6 +1156,8 @@ class AddressSynchronizer(Logger):
             domain = set(domain) - set(excluded_addresses)
         mempool_height = self.get_local_height() + 1  # height of next block
         for addr in domain:
+            if not self._utxos.get(addr):
+                continue
             utxos = self.get_addr_utxo(addr)
             for utxo in utxos.values():
                 if confirmed_only and utxo.block_height <= 0:
@@ -843,6 +1171,7 @@ class AddressSynchronizer(Logger):
                 continue
         return coins
 
+    @with_local_height_cached
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
                     excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
         if domain is None:
@@ -853,6 +1182,8 @@ class AddressSynchronizer(Logger):
         domain = set(domain) - excluded_addresses
         cc = uu = xx = 0
         for addr in domain:
+            if not self._utxos.get(addr) and not self._unsettled_spent_txos.get(addr):
+                continue
             c, u, x = self.get_addr_balance(addr, excluded_coins=excluded_coins)
             cc += c
             uu += u
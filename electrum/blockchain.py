@@ -21,8 +21,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import hashlib
 import threading
 import time
+from collections import OrderedDict
 from typing import Optional, Dict, Mapping, Sequence
 
 from . import util
@@ -37,6 +40,7 @@ from .logging import get_logger, Logger
 _logger = get_logger(__name__)
 
 HEADER_SIZE = 80  # bytes
+MAX_CACHED_HASHES = 10_000  # per Blockchain; enough for a few chunks and the heights of a wallet's txs
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
 
@@ -71,6 +75,53 @@ def deserialize_header(s: bytes, height: int) -> dict:
     h['block_height'] = height
     return h
 
+class HeaderView:
+    """A serialized header, with fields decoded on access and the hash
+    computed on first use. Cheaper than deserialize_header for callers
+    that need only a few fields.
+    """
+    __slots__ = ('raw', 'block_height', '_hash')
+
+    def __init__(self, raw: bytes, height: int, *, header_hash: str = None):
+        if len(raw) != HEADER_SIZE:
+            raise InvalidHeader('Invalid header length: {}'.format(len(raw)))
+        self.raw = raw
+        self.block_height = height
+        self._hash = header_hash
+
+    @property
+    def version(self) -> int:
+        return int.from_bytes(self.raw[0:4], byteorder='little')
+
+    @property
+    def prev_block_hash(self) -> str:
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self) -> str:
+        return hash_encode(self.raw[36:68])
+
+    @property
+    def timestamp(self) -> int:
+        return int.from_bytes(self.raw[68:72], byteorder='little')
+
+    @property
+    def bits(self) -> int:
+        return int.from_bytes(self.raw[72:76], byteorder='little')
+
+    @property
+    def nonce(self) -> int:
+        return int.from_bytes(self.raw[76:80], byteorder='little')
+
+    def hash(self) -> str:
+        if self._hash is None:
+            self._hash = hash_encode(sha256d(self.raw))
+        return self._hash
+
+    def to_dict(self) -> dict:
+        return deserialize_header(self.raw, self.block_height)
+
+
 def hash_header(header: dict) -> str:
     if header is None:
         return '0' * 64
@@ -101,8 +152,11 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_headers_file()
             os.unlink(best_chain.path())
             best_chain.update_size()
+    if best_chain.height() > constants.net.max_checkpoint():
+        best_chain.truncate_invalid_tail()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
@@ -137,12 +191,17 @@ def read_blockchains(config: 'SimpleConfig'):
                        prev_hash=prev_hash)
         # consistency checks
         h = b.read_header(b.forkpoint)
+        b.close_headers_file()
         if first_hash != hash_header(h):
             delete_chain(filename, "incorrect first hash for chain")
             return
         if not b.parent.can_connect(h, check_height=False):
             delete_chain(filename, "cannot connect chain to parent")
             return
+        b.truncate_invalid_tail()
+        if b.size() == 0:
+            delete_chain(filename, "no valid headers in chain")
+            return
         chain_id = b.get_id()
         assert first_hash == chain_id, (first_hash, chain_id)
         blockchains[chain_id] = b
@@ -151,6 +210,13 @@ def read_blockchains(config: 'SimpleConfig'):
         instantiate_chain(filename)
 
 
+def sync_headers_files() -> None:
+    with blockchains_lock:
+        chains = list(blockchains.values())
+    for chain in chains:
+        chain.sync_headers_file()
+
+
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
@@ -165,6 +231,7 @@ def init_headers_file_for_best_chain():
     filename = b.path()
     length = HEADER_SIZE * len(constants.net.CHECKPOINTS) * 2016
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        b.close_headers_file()
         with open(filename, 'wb') as f:
             if length > 0:
                 f.seek(length - 1)
@@ -179,6 +246,12 @@ class Blockchain(Logger):
     Manages blockchain headers and their verification
     """
 
+    # Appended headers are not fsynced one by one: the headers file is synced
+    # once this many headers, or this many seconds' worth, are pending.
+    # Whatever a crash loses is found by truncate_invalid_tail on startup.
+    FSYNC_MAX_PENDING_HEADERS = 2016
+    FSYNC_MAX_DELAY = 10
+
     def __init__(self, config: SimpleConfig, forkpoint: int, parent: Optional['Blockchain'],
                  forkpoint_hash: str, prev_hash: Optional[str]):
         assert isinstance(forkpoint_hash, str) and len(forkpoint_hash) == 64, forkpoint_hash
@@ -193,6 +266,15 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        # read-only mapping of the headers file, opened on first read,
+        # closed whenever the file is modified
+        self._mmap = None  # type: Optional[mmap.mmap]
+        # (height - forkpoint) -> block hash, for headers in our file whose hash was computed.
+        # least recently used first; see get_hash
+        self._hashes = OrderedDict()  # type: OrderedDict[int, str]
+        # bytes written to the headers file since its last fsync
+        self._pending_sync = 0
+        self._pending_sync_since = 0.0
         self.update_size()
 
     def with_lock(func):
@@ -295,6 +377,32 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        self.close_headers_file()
+        self._forget_hashes(self._size)
+
+    @with_lock
+    def close_headers_file(self) -> None:
+        """Closes our mapping of the headers file; it is reopened on the next read.
+        Must be called before the file is modified, truncated, moved or deleted.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    @with_lock
+    def _get_mmap(self) -> Optional[mmap.mmap]:
+        if self._mmap is None and self._size > 0:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @with_lock
+    def _forget_hashes(self, start: int, end: int = None) -> None:
+        """Forget cached hashes of the headers from start to end (relative to forkpoint)."""
+        for delta in [d for d in self._hashes if d >= start and (end is None or d < end)]:
+            del self._hashes[delta]
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
@@ -312,21 +420,54 @@ class Blockchain(Logger):
         if block_hash_as_num > target:
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
+    @classmethod
+    def verify_raw_headers(cls, data: bytes, prev_hash: str, target: int, *,
+                           expected_hashes: Mapping[int, str] = None) -> str:
+        """Same checks as verify_header, on consecutive serialized headers.
+        expected_hashes maps the index of a header in data to its known hash.
+        Returns the hash of the last header.
+        """
+        if len(data) % HEADER_SIZE != 0:
+            raise InvalidHeader('Invalid chunk length: {}'.format(len(data)))
+        if expected_hashes is None:
+            expected_hashes = {}
+        check_pow = not constants.net.TESTNET
+        if check_pow:
+            bits = cls.target_to_bits(target).to_bytes(4, byteorder='little')
+        data = memoryview(data)
+        prev_hash_bytes = bfh(prev_hash)[::-1]
+        for i in range(len(data) // HEADER_SIZE):
+            raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
+            header_hash = hashlib.sha256(hashlib.sha256(raw_header).digest()).digest()
+            expected_header_hash = expected_hashes.get(i)
+            if expected_header_hash and expected_header_hash != hash_encode(header_hash):
+                raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, hash_encode(header_hash)))
+            if raw_header[4:36] != prev_hash_bytes:
+                raise Exception("prev hash mismatch: %s vs %s" % (hash_encode(prev_hash_bytes), hash_encode(bytes(raw_header[4:36]))))
+            if check_pow:
+                if raw_header[72:76] != bits:
+                    raise Exception("bits mismatch: %s vs %s" % (int.from_bytes(bits, byteorder='little'),
+                                                                 int.from_bytes(raw_header[72:76], byteorder='little')))
+                block_hash_as_num = int.from_bytes(header_hash, byteorder='little')
+                if block_hash_as_num > target:
+                    raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
+            prev_hash_bytes = header_hash
+        return hash_encode(prev_hash_bytes)
+
     def verify_chunk(self, index: int, data: bytes) -> None:
         num = len(data) // HEADER_SIZE
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
         target = self.get_target(index-1)
-        for i in range(num):
-            height = start_height + i
+        # we can only know the hash of headers we already have, or of checkpoints
+        max_height_with_hash = max(self.height(), constants.net.max_checkpoint())
+        expected_hashes = {}
+        for i in range(min(num, max_height_with_hash - start_height + 1)):
             try:
-                expected_header_hash = self.get_hash(height)
+                expected_hashes[i] = self.get_hash(start_height + i)
             except MissingHeader:
-                expected_header_hash = None
-            raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+                pass
+        self.verify_raw_headers(data[:num*HEADER_SIZE], prev_hash, target, expected_hashes=expected_hashes)
 
     @with_lock
     def path(self):
@@ -359,7 +500,8 @@ class Blockchain(Logger):
             chunk = chunk[-delta_bytes:]
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
-        self.write(chunk, delta_bytes, truncate)
+        # the checkpoint region is not re-verified on startup
+        self.write(chunk, delta_bytes, truncate, sync=chunk_within_checkpoint_region)
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -407,17 +549,22 @@ class Blockchain(Logger):
         with open(parent.path(), 'rb') as f:
             f.seek((forkpoint - parent.forkpoint)*HEADER_SIZE)
             parent_data = f.read(parent_branch_size*HEADER_SIZE)
-        self.write(parent_data, 0)
-        parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE)
+        self.write(parent_data, 0, sync=True)
+        parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE, sync=True)
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self.close_headers_file()
+        parent.close_headers_file()
         os.replace(child_old_name, parent.path())
         self.update_size()
         parent.update_size()
+        # the files changed hands, and so did the cached hashes
+        self._forget_hashes(0)
+        parent._forget_hashes(0)
         # update pointers
         blockchains.pop(child_old_id, None)
         blockchains.pop(parent_old_id, None)
@@ -437,9 +584,16 @@ class Blockchain(Logger):
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
     @with_lock
-    def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+    def write(self, data: bytes, offset: int, truncate: bool=True, *, sync: bool=False) -> None:
+        """Writes data to the headers file at offset.
+        The file is only fsynced if sync is set, or if the budget
+        of pending writes (see FSYNC_MAX_PENDING_HEADERS) is exceeded.
+        """
         filename = self.path()
         self.assert_headers_file_available(filename)
+        self.close_headers_file()
+        start = offset // HEADER_SIZE
+        self._forget_hashes(start, None if truncate else start + len(data) // HEADER_SIZE)
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -447,9 +601,52 @@ class Blockchain(Logger):
             f.seek(offset)
             f.write(data)
             f.flush()
-            os.fsync(f.fileno())
+            if not self._pending_sync:
+                self._pending_sync_since = time.monotonic()
+            self._pending_sync += max(len(data), 1)
+            if (sync or self._pending_sync >= self.FSYNC_MAX_PENDING_HEADERS * HEADER_SIZE
+                    or time.monotonic() - self._pending_sync_since >= self.FSYNC_MAX_DELAY):
+                os.fsync(f.fileno())
+                self._pending_sync = 0
         self.update_size()
 
+    @with_lock
+    def sync_headers_file(self) -> None:
+        """Fsyncs pending writes to the headers file, if any."""
+        if not self._pending_sync:
+            return
+        filename = self.path()
+        if os.path.exists(filename):
+            with open(filename, 'rb+') as f:
+                os.fsync(f.fileno())
+        self._pending_sync = 0
+
+    @with_lock
+    def truncate_invalid_tail(self) -> None:
+        """Verifies the headers that might have been written after the last
+        fsync, and drops everything from the first one that is invalid.
+        A crash might have lost or garbled them.
+        """
+        start = max(self.forkpoint,
+                    constants.net.max_checkpoint() + 1,
+                    self.height() - self.FSYNC_MAX_PENDING_HEADERS + 1)
+        height = start
+        try:
+            prev_hash = self.get_hash(start - 1)
+            while height <= self.height():
+                header = self.read_header_view(height)
+                if header is None:
+                    break
+                target = self.get_target(height // 2016 - 1)
+                prev_hash = self.verify_raw_headers(header.raw, prev_hash, target)
+                height += 1
+        except Exception as e:
+            self.logger.info(f"invalid header at height {height}: {repr(e)}")
+        if height > self.height():
+            return
+        self.logger.info(f"truncating headers file of chain {self.forkpoint} at height {height}")
+        self.write(b'', (height - self.forkpoint) * HEADER_SIZE, sync=True)
+
     @with_lock
     def save_header(self, header: dict) -> None:
         delta = header.get('block_height') - self.forkpoint
@@ -461,24 +658,28 @@ class Blockchain(Logger):
         self.swap_with_parent()
 
     @with_lock
-    def read_header(self, height: int) -> Optional[dict]:
+    def read_header_view(self, height: int) -> Optional[HeaderView]:
         if height < 0:
             return
         if height < self.forkpoint:
-            return self.parent.read_header(height)
+            return self.parent.read_header_view(height)
         if height > self.height():
             return
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
+        m = self._get_mmap()
+        h = m[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE] if m is not None else b''
+        if len(h) < HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        if h == bytes(HEADER_SIZE):
             return None
-        return deserialize_header(h, height)
+        return HeaderView(h, height, header_hash=self._hashes.get(delta))
+
+    @with_lock
+    def read_header(self, height: int) -> Optional[dict]:
+        header = self.read_header_view(height)
+        if header is None:
+            return None
+        return header.to_dict()
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -513,11 +714,22 @@ class Blockchain(Logger):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
+        elif height < self.forkpoint:
+            return self.parent.get_hash(height)
         else:
-            header = self.read_header(height)
-            if header is None:
-                raise MissingHeader(height)
-            return hash_header(header)
+            with self.lock:
+                delta = height - self.forkpoint
+                header_hash = self._hashes.get(delta)
+                if header_hash is not None:
+                    self._hashes.move_to_end(delta)
+                    return header_hash
+                header = self.read_header_view(height)
+                if header is None:
+                    raise MissingHeader(height)
+                header_hash = self._hashes[delta] = header.hash()
+                if len(self._hashes) > MAX_CACHED_HASHES:
+                    self._hashes.popitem(last=False)
+                return header_hash
 
     def get_target(self, index: int) -> int:
         # compute target from chunk x, used in chunk x+1
@@ -529,13 +741,13 @@ class Blockchain(Logger):
             h, t = self.checkpoints[index]
             return t
         # new target
-        first = self.read_header(index * 2016)
-        last = self.read_header(index * 2016 + 2015)
+        first = self.read_header_view(index * 2016)
+        last = self.read_header_view(index * 2016 + 2015)
         if not first or not last:
             raise MissingHeader()
-        bits = last.get('bits')
+        bits = last.bits
         target = self.bits_to_target(bits)
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
+        nActualTimespan = last.timestamp - first.timestamp
         nTargetTimespan = 14 * 24 * 60 * 60
         nActualTimespan = max(nActualTimespan, nTargetTimespan // 4)
         nActualTimespan = min(nActualTimespan, nTargetTimespan * 4)
@@ -556,7 +768,7 @@ class Blockchain(Logger):
 
     @classmethod
     def target_to_bits(cls, target: int) -> int:
-        c = ("%064x" % target)[2:]
+        c = ("%066x" % target)[2:]
         while c[:2] == '00' and len(c) > 6:
             c = c[2:]
         bitsN, bitsBase = len(c) // 2, int.from_bytes(bfh(c[:6]), byteorder='big')
@@ -26,8 +26,12 @@
 import time
 import random
 import os
+import gc
+import sqlite3
 from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+from contextlib import contextmanager
+from typing import (Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Callable,
+                    Iterable)
 import binascii
 import base64
 import asyncio
@@ -37,12 +41,13 @@ from enum import IntEnum
 
 from .sql_db import SqlDB, sql
 from . import constants, util
-from .util import bh2u, profiler, get_headers_dir, is_ip_address, json_normalize
+from .util import bh2u, profiler, get_headers_dir, is_ip_address, json_normalize, chunks, log_exceptions
 from .logging import Logger
 from .lnutil import (LNPeerAddr, format_short_channel_id, ShortChannelID,
                      validate_features, IncompatibleOrInsaneFeatures)
 from .lnverifier import LNChannelVerifier, verify_sig_for_channel_update
-from .lnmsg import decode_msg
+from .lnmsg import decode_msg, MalformedMsg
+from .lngraph import CompactChannelGraph
 
 if TYPE_CHECKING:
     from .network import Network
@@ -220,10 +225,25 @@ class CategorizedChannelUpdates(NamedTuple):
     good: List        # good updates
 
 
+# note: the fields needed to load the graph are stored decoded, next to
+#       the raw messages ('msg'), which are only kept to be re-broadcast.
+#       Older versions only stored 'msg', in a file named 'gossip_db'. They
+#       cannot read the decoded columns, so this schema lives in a new file,
+#       and the old one is left as it is (see ChannelDB._import_legacy_db).
+#       It is deleted once no older version has used it for a while, as it
+#       holds a second copy of all the raw messages.
+
+LEGACY_DB_NAME = 'gossip_db'
+LEGACY_DB_GRACE_PERIOD = 30 * 24 * 3600  # seconds
+DB_NAME = 'gossip_db2'
+
 create_channel_info = """
 CREATE TABLE IF NOT EXISTS channel_info (
 short_channel_id BLOB(8),
 msg BLOB,
+node1_id BLOB(33),
+node2_id BLOB(33),
+features BLOB,
 PRIMARY KEY(short_channel_id)
 )"""
 
@@ -231,9 +251,20 @@ create_policy = """
 CREATE TABLE IF NOT EXISTS policy (
 key BLOB(41),
 msg BLOB,
+cltv_expiry_delta INTEGER,
+htlc_minimum_msat INTEGER,
+htlc_maximum_msat INTEGER,
+fee_base_msat INTEGER,
+fee_proportional_millionths INTEGER,
+channel_flags INTEGER,
+message_flags INTEGER,
+timestamp INTEGER,
 PRIMARY KEY(key)
 )"""
 
+select_policy = """SELECT key, cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat, fee_base_msat,
+fee_proportional_millionths, channel_flags, message_flags, timestamp FROM policy"""
+
 create_address = """
 CREATE TABLE IF NOT EXISTS address (
 node_id BLOB(33),
@@ -247,24 +278,76 @@ create_node_info = """
 CREATE TABLE IF NOT EXISTS node_info (
 node_id BLOB(33),
 msg BLOB,
+features BLOB,
+timestamp INTEGER,
+alias TEXT,
 PRIMARY KEY(node_id)
 )"""
 
+SQLITE_MAX_INT = 2**63 - 1
+
+
+def policy_to_sql_row(policy: 'Policy') -> Tuple:
+    # msat amounts are u64 in the messages; any amount that large means "no limit" anyway
+    return policy._replace(htlc_minimum_msat=min(policy.htlc_minimum_msat, SQLITE_MAX_INT),
+                           htlc_maximum_msat=min(policy.htlc_maximum_msat, SQLITE_MAX_INT)
+                           if policy.htlc_maximum_msat is not None else None)
+
+
+@contextmanager
+def gc_disabled():
+    # the objects created while loading the gossip live long: running
+    # the garbage collector while they are being created only slows it down
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def sort_channels_for_loading(channels: Sequence[ChannelInfo], near_node_ids: Iterable[bytes]) -> List[ChannelInfo]:
+    """Returns channels in the order in which ChannelDB loads them: the channels
+    of near_node_ids first, then those of their neighbours, then all others.
+    Within each of these groups, channels of better connected nodes come first.
+    """
+    degree = defaultdict(int)  # type: Dict[bytes, int]
+    distance = dict.fromkeys(near_node_ids, 0)  # type: Dict[bytes, int]
+    for channel_info in channels:
+        node1_id, node2_id = channel_info.node1_id, channel_info.node2_id
+        degree[node1_id] += 1
+        degree[node2_id] += 1
+        if distance.get(node1_id) == 0:
+            distance.setdefault(node2_id, 1)
+        elif distance.get(node2_id) == 0:
+            distance.setdefault(node1_id, 1)
+    sort_keys = [(min(distance.get(node1_id, 2), distance.get(node2_id, 2)),
+                  -max(degree[node1_id], degree[node2_id]), -min(degree[node1_id], degree[node2_id]))
+                 for _, node1_id, node2_id, _ in channels]
+    return [channels[i] for i in sorted(range(len(channels)), key=sort_keys.__getitem__)]
+
 
 class ChannelDB(SqlDB):
 
     NUM_MAX_RECENT_PEERS = 20
+    NUM_CHANNELS_PER_LOAD_BATCH = 2000
 
     def __init__(self, network: 'Network'):
-        path = os.path.join(get_headers_dir(network.config), 'gossip_db')
+        path = os.path.join(get_headers_dir(network.config), DB_NAME)
+        legacy_path = os.path.join(get_headers_dir(network.config), LEGACY_DB_NAME)
+        # read by create_database, in the sql thread started by SqlDB.__init__
+        self._legacy_path_to_import = legacy_path if not os.path.exists(path) and os.path.exists(legacy_path) else None
         super().__init__(network.asyncio_loop, path, commit_interval=100)
+        if not self._legacy_path_to_import:
+            self._remove_unused_legacy_db(legacy_path)
         self.lock = threading.RLock()
         self.num_nodes = 0
         self.num_channels = 0
         self._channel_updates_for_private_channels = {}  # type: Dict[Tuple[bytes, bytes], dict]
         self.ca_verifier = LNChannelVerifier(network, self)
 
-        # initialized in load_data
+        # loaded in batches by load_data
         # note: modify/iterate needs self.lock
         self._channels = {}  # type: Dict[ShortChannelID, ChannelInfo]
         self._policies = {}  # type: Dict[Tuple[bytes, ShortChannelID], Policy]  # (node_id, scid) -> Policy
@@ -276,10 +359,30 @@ class ChannelDB(SqlDB):
         self._chans_with_0_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_1_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_2_policies = set()  # type: Set[ShortChannelID]
+        # array-backed copy of the public graph, used by the path finder
+        if network.config.get('lightning_compact_graph', True):
+            self.graph = CompactChannelGraph()  # type: Optional[CompactChannelGraph]
+        else:
+            self.graph = None
+
+        # called with the short_channel_id of a channel that was removed,
+        # or one of whose policies changed or was removed
+        self._channel_changed_callbacks = []  # type: List[Callable[[ShortChannelID], None]]
 
+        self.data_partially_loaded = asyncio.Event()  # set once routing can start
         self.data_loaded = asyncio.Event()
+        self._load_started = False
+        self._num_channels_to_load = None  # type: Optional[int]
+        self._num_channels_loaded = 0
         self.network = network # only for callback
 
+    def register_channel_changed_callback(self, callback: Callable[[ShortChannelID], None]) -> None:
+        self._channel_changed_callbacks.append(callback)
+
+    def _on_channel_changed(self, short_channel_id: ShortChannelID) -> None:
+        for callback in self._channel_changed_callbacks:
+            callback(short_channel_id)
+
     def update_counts(self):
         self.num_nodes = len(self._nodes)
         self.num_channels = len(self._channels)
@@ -319,7 +422,7 @@ class ChannelDB(SqlDB):
             return None
 
     def get_recent_peers(self):
-        if not self.data_loaded.is_set():
+        if not self.data_partially_loaded.is_set():
             raise Exception("channelDB data not loaded yet!")
         with self.lock:
             ret = [self.get_last_good_address(node_id)
@@ -367,9 +470,11 @@ class ChannelDB(SqlDB):
             self._channels[channel_info.short_channel_id] = channel_info
             self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
             self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+            if self.graph is not None:
+                self.graph.add_channel(channel_info)
         self._update_num_policies_for_chan(channel_info.short_channel_id)
         if 'raw' in msg:
-            self._db_save_channel(channel_info.short_channel_id, msg['raw'])
+            self._db_save_channel(channel_info, msg['features'], msg['raw'])
 
     def policy_changed(self, old_policy: Policy, new_policy: Policy, verbose: bool) -> bool:
         changed = False
@@ -433,12 +538,16 @@ class ChannelDB(SqlDB):
         policy = Policy.from_msg(payload)
         with self.lock:
             self._policies[key] = policy
+            if self.graph is not None:
+                self.graph.update_policy(short_channel_id, start_node, policy)
         self._update_num_policies_for_chan(short_channel_id)
         if 'raw' in payload:
-            self._db_save_policy(policy.key, payload['raw'])
+            self._db_save_policy(policy, payload['raw'])
         if old_policy and not self.policy_changed(old_policy, policy, verbose):
             return UpdateStatus.UNCHANGED
         else:
+            if old_policy:
+                self._on_channel_changed(short_channel_id)
             return UpdateStatus.GOOD
 
     def add_channel_updates(self, payloads, max_age=None) -> CategorizedChannelUpdates:
@@ -474,13 +583,108 @@ class ChannelDB(SqlDB):
         c.execute(create_address)
         c.execute(create_policy)
         c.execute(create_channel_info)
+        if self._legacy_path_to_import:
+            self._import_legacy_db(c, self._legacy_path_to_import)
+        self._decode_raw_messages(c)
         self.conn.commit()
 
+    @profiler
+    def _import_legacy_db(self, c, legacy_path: str) -> None:
+        """Copies the raw messages and addresses of a database of older versions.
+        The file is only read, so that these versions can still use it
+        until it gets removed by _remove_unused_legacy_db.
+        """
+        self.logger.info(f"importing gossip from {legacy_path}")
+        c.execute("ATTACH DATABASE ? AS legacy", (legacy_path,))
+        try:
+            tables = {row[0] for row in c.execute("SELECT name FROM legacy.sqlite_master WHERE type='table'")}
+            for table, key_column in (('channel_info', 'short_channel_id'), ('policy', 'key'), ('node_info', 'node_id')):
+                if table in tables:
+                    c.execute(f"INSERT OR IGNORE INTO {table} ({key_column}, msg) SELECT {key_column}, msg FROM legacy.{table}")
+            if 'address' in tables:
+                c.execute("INSERT OR IGNORE INTO address (node_id, host, port, timestamp) "
+                          "SELECT node_id, host, port, timestamp FROM legacy.address")
+            self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            self.logger.warning(f"could not import gossip from {legacy_path}: {e!r}")
+            self.conn.rollback()
+        finally:
+            c.execute("DETACH DATABASE legacy")
+        # start the grace period of _remove_unused_legacy_db
+        try:
+            os.utime(legacy_path)
+        except OSError as e:
+            self.logger.info(f"could not touch {legacy_path}: {e!r}")
+
+    def _remove_unused_legacy_db(self, legacy_path: str) -> None:
+        """Deletes the database of older versions, once it has been imported,
+        and neither these versions nor the import modified it for LEGACY_DB_GRACE_PERIOD.
+        """
+        try:
+            if time.time() - os.path.getmtime(legacy_path) < LEGACY_DB_GRACE_PERIOD:
+                return
+            os.remove(legacy_path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.logger.info(f"could not remove {legacy_path}: {e!r}")
+            return
+        self.logger.info(f"removed {legacy_path}, not used by older versions anymore")
+
+    @profiler
+    def _decode_raw_messages(self, c) -> None:
+        """Fills in the decoded columns of the rows that only have the raw
+        message, i.e. the ones imported from an older database.
+        """
+        channels, policies, nodes, invalid = [], [], [], []
+        c.execute("SELECT short_channel_id, msg FROM channel_info WHERE node1_id IS NULL")
+        for short_channel_id, msg in c.fetchall():
+            try:
+                payload = decode_msg(msg)[1]
+            except MalformedMsg:
+                invalid.append(("channel_info", "short_channel_id", short_channel_id))
+                continue
+            channels.append((payload['node_id_1'], payload['node_id_2'], payload['features'], short_channel_id))
+        c.execute("SELECT key, msg FROM policy WHERE timestamp IS NULL")
+        for key, msg in c.fetchall():
+            try:
+                policy = Policy.from_raw_msg(key, msg)
+            except MalformedMsg:
+                invalid.append(("policy", "key", key))
+                continue
+            policies.append(tuple(policy_to_sql_row(policy)[1:]) + (key,))
+        c.execute("SELECT node_id, msg FROM node_info WHERE timestamp IS NULL")
+        for node_id, msg in c.fetchall():
+            try:
+                payload = decode_msg(msg)[1]
+            except MalformedMsg:
+                invalid.append(("node_info", "node_id", node_id))
+                continue
+            try:
+                node_info, node_addresses = NodeInfo.from_msg(payload)
+            except IncompatibleOrInsaneFeatures:
+                # kept, but skipped when loading (see are_features_valid)
+                node_info = NodeInfo(node_id, 0, payload['timestamp'], '')
+            nodes.append((payload['features'], node_info.timestamp, node_info.alias, node_id))
+        if not (channels or policies or nodes or invalid):
+            return
+        self.logger.info(f"adding decoded fields to {len(channels)} channels, {len(policies)} policies "
+                         f"and {len(nodes)} nodes, deleting {len(invalid)} invalid rows")
+        c.executemany("UPDATE channel_info SET node1_id=?, node2_id=?, features=? WHERE short_channel_id=?", channels)
+        c.executemany("""UPDATE policy SET cltv_expiry_delta=?, htlc_minimum_msat=?, htlc_maximum_msat=?,
+                         fee_base_msat=?, fee_proportional_millionths=?, channel_flags=?, message_flags=?,
+                         timestamp=? WHERE key=?""", policies)
+        c.executemany("UPDATE node_info SET features=?, timestamp=?, alias=? WHERE node_id=?", nodes)
+        for table, key_column, key in invalid:
+            c.execute(f"DELETE FROM {table} WHERE {key_column}=?", (key,))
+
     @sql
-    def _db_save_policy(self, key: bytes, msg: bytes):
+    def _db_save_policy(self, policy: Policy, msg: bytes):
         # 'msg' is a 'channel_update' message
         c = self.conn.cursor()
-        c.execute("""REPLACE INTO policy (key, msg) VALUES (?,?)""", [key, msg])
+        c.execute("""REPLACE INTO policy (key, cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat,
+                     fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp, msg)
+                     VALUES (?,?,?,?,?,?,?,?,?,?)""", tuple(policy_to_sql_row(policy)) + (msg,))
 
     @sql
     def _db_delete_policy(self, node_id: bytes, short_channel_id: ShortChannelID):
@@ -489,10 +693,11 @@ class ChannelDB(SqlDB):
         c.execute("""DELETE FROM policy WHERE key=?""", (key,))
 
     @sql
-    def _db_save_channel(self, short_channel_id: ShortChannelID, msg: bytes):
+    def _db_save_channel(self, channel_info: ChannelInfo, features: bytes, msg: bytes):
         # 'msg' is a 'channel_announcement' message
         c = self.conn.cursor()
-        c.execute("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", [short_channel_id, msg])
+        c.execute("REPLACE INTO channel_info (short_channel_id, node1_id, node2_id, features, msg) VALUES (?,?,?,?,?)",
+                  [channel_info.short_channel_id, channel_info.node1_id, channel_info.node2_id, features, msg])
 
     @sql
     def _db_delete_channel(self, short_channel_id: ShortChannelID):
@@ -500,10 +705,11 @@ class ChannelDB(SqlDB):
         c.execute("""DELETE FROM channel_info WHERE short_channel_id=?""", (short_channel_id,))
 
     @sql
-    def _db_save_node_info(self, node_id: bytes, msg: bytes):
+    def _db_save_node_info(self, node_info: NodeInfo, features: bytes, msg: bytes):
         # 'msg' is a 'node_announcement' message
         c = self.conn.cursor()
-        c.execute("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", [node_id, msg])
+        c.execute("REPLACE INTO node_info (node_id, features, timestamp, alias, msg) VALUES (?,?,?,?,?)",
+                  [node_info.node_id, features, node_info.timestamp, node_info.alias, msg])
 
     @sql
     def _db_save_node_address(self, peer: LNPeerAddr, timestamp: int):
@@ -553,7 +759,7 @@ class ChannelDB(SqlDB):
             with self.lock:
                 self._nodes[node_id] = node_info
             if 'raw' in msg_payload:
-                self._db_save_node_info(node_id, msg_payload['raw'])
+                self._db_save_node_info(node_info, msg_payload['features'], msg_payload['raw'])
             with self.lock:
                 for addr in node_addresses:
                     self._addresses[node_id].add(NodeAddress(addr.host, addr.port, 0))
@@ -575,8 +781,11 @@ class ChannelDB(SqlDB):
                 node_id, scid = key
                 with self.lock:
                     self._policies.pop(key)
+                    if self.graph is not None:
+                        self.graph.update_policy(scid, node_id, None)
                 self._db_delete_policy(*key)
                 self._update_num_policies_for_chan(scid)
+                self._on_channel_changed(scid)
             self.update_counts()
             self.logger.info(f'Deleting {len(old_policies)} old policies')
 
@@ -603,21 +812,64 @@ class ChannelDB(SqlDB):
             if channel_info:
                 self._channels_for_node[channel_info.node1_id].remove(channel_info.short_channel_id)
                 self._channels_for_node[channel_info.node2_id].remove(channel_info.short_channel_id)
+                if self.graph is not None:
+                    self.graph.remove_channel(short_channel_id)
         self._update_num_policies_for_chan(short_channel_id)
+        self._on_channel_changed(short_channel_id)
         # delete from database
         self._db_delete_channel(short_channel_id)
 
     def get_node_addresses(self, node_id):
         return self._addresses.get(node_id)
 
+    @log_exceptions
+    async def load_data(self):
+        """Loads the gossip stored on disk, in batches of channels, so that
+        routing can start before the whole graph is in memory: channels of
+        the nodes we connected to recently (our peers) come first, then those
+        of their neighbours, then the rest, best connected nodes first.
+        data_partially_loaded is set after the first batch, data_loaded at the end.
+        """
+        if self._load_started:
+            return
+        self._load_started = True
+        t0 = time.monotonic()
+        channels = await self._load_nodes_and_sort_channels()
+        self._num_channels_to_load = len(channels)
+        # the policies of the first batch are looked up one by one. for the
+        # other batches, reading the whole table at once is faster.
+        first_batch = channels[:self.NUM_CHANNELS_PER_LOAD_BATCH]
+        await self._load_channels(first_batch)
+        self.update_counts()
+        self.logger.info(f'first {len(first_batch)} channels loaded in {time.monotonic() - t0:.2f}s')
+        self.data_partially_loaded.set()
+        policies = await self._read_policies()
+        for channels_batch in chunks(channels[len(first_batch):], self.NUM_CHANNELS_PER_LOAD_BATCH):
+            await self._load_channels(channels_batch, policies)
+            self.update_counts()
+        await self._load_orphaned_policies(policies)
+        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)} '
+                         f'in {time.monotonic() - t0:.2f}s')
+        self.update_counts()
+        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
+        self.logger.info(f'num_channels_partitioned_by_policy_count. '
+                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
+        self.data_loaded.set()
+        util.trigger_callback('gossip_db_loaded')
+
+    def get_load_progress(self) -> float:
+        """Returns the fraction of the channels on disk that are loaded."""
+        if self.data_loaded.is_set():
+            return 1.0
+        if not self._num_channels_to_load:
+            return 0.0
+        return self._num_channels_loaded / self._num_channels_to_load
+
     @sql
     @profiler
-    def load_data(self):
-        if self.data_loaded.is_set():
-            return
-        # Note: this method takes several seconds... mostly due to lnmsg.decode_msg being slow.
-        #       I believe lnmsg (and lightning.json) will need a rewrite anyway, so instead of tweaking
-        #       load_data() here, that should be done. see #6006
+    def _load_nodes_and_sort_channels(self) -> List[ChannelInfo]:
+        """Loads addresses and nodes, and returns the channels to load, in order."""
+        # note: only the decoded columns are read, the raw messages are not decoded again
         c = self.conn.cursor()
         c.execute("""SELECT * FROM address""")
         for x in c:
@@ -630,36 +882,98 @@ class ChannelDB(SqlDB):
             return newest_ts
         sorted_node_ids = sorted(self._addresses.keys(), key=newest_ts_for_node_id, reverse=True)
         self._recent_peers = sorted_node_ids[:self.NUM_MAX_RECENT_PEERS]
-        c.execute("""SELECT * FROM channel_info""")
-        for short_channel_id, msg in c:
-            try:
-                ci = ChannelInfo.from_raw_msg(msg)
-            except IncompatibleOrInsaneFeatures:
-                continue
-            self._channels[ShortChannelID.normalize(short_channel_id)] = ci
-        c.execute("""SELECT * FROM node_info""")
-        for node_id, msg in c:
-            try:
-                node_info, node_addresses = NodeInfo.from_raw_msg(msg)
-            except IncompatibleOrInsaneFeatures:
-                continue
-            # don't load node_addresses because they dont have timestamps
-            self._nodes[node_id] = node_info
-        c.execute("""SELECT * FROM policy""")
-        for key, msg in c:
-            p = Policy.from_raw_msg(key, msg)
-            self._policies[(p.start_node, p.short_channel_id)] = p
-        for channel_info in self._channels.values():
-            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
-            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
-            self._update_num_policies_for_chan(channel_info.short_channel_id)
-        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
-        self.update_counts()
-        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
-        self.logger.info(f'num_channels_partitioned_by_policy_count. '
-                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
-        self.data_loaded.set()
-        util.trigger_callback('gossip_db_loaded')
+        valid_features = {}  # type: Dict[bytes, bool]
+        def are_features_valid(features: bytes) -> bool:
+            if features not in valid_features:
+                try:
+                    validate_features(int.from_bytes(features, 'big'))
+                    valid_features[features] = True
+                except IncompatibleOrInsaneFeatures:
+                    valid_features[features] = False
+            return valid_features[features]
+        nodes = {}  # type: Dict[bytes, NodeInfo]
+        channels = []  # type: List[ChannelInfo]
+        with gc_disabled():
+            c.execute("""SELECT node_id, features, timestamp, alias FROM node_info""")
+            for node_id, features, timestamp, alias in c:
+                if not are_features_valid(features):
+                    continue
+                # don't load node_addresses because they dont have timestamps
+                nodes[node_id] = NodeInfo(node_id, int.from_bytes(features, 'big'), timestamp, alias)
+            c.execute("""SELECT short_channel_id, node1_id, node2_id, features FROM channel_info""")
+            for short_channel_id, node1_id, node2_id, features in c:
+                if not are_features_valid(features):
+                    continue
+                short_channel_id = ShortChannelID(short_channel_id)
+                channels.append(ChannelInfo(short_channel_id, node1_id, node2_id, None))
+            channels = sort_channels_for_loading(channels, self._recent_peers)
+        with self.lock:
+            self._nodes.update(nodes)
+        return channels
+
+    @sql
+    @profiler
+    def _read_policies(self) -> Dict[Tuple[bytes, ShortChannelID], Policy]:
+        c = self.conn.cursor()
+        with gc_disabled():
+            return {(row[0][8:], ShortChannelID(row[0][:8])): Policy._make(row) for row in c.execute(select_policy)}
+
+    @sql
+    def _load_channels(self, channels: Sequence[ChannelInfo],
+                       all_policies: Dict[Tuple[bytes, ShortChannelID], Policy] = None) -> None:
+        """Loads a batch of channels, with their policies. These are taken out
+        of all_policies if it is given, otherwise they are read from the database.
+        """
+        with gc_disabled():
+            if all_policies is None:
+                c = self.conn.cursor()
+                keys = [channel_info.short_channel_id + node_id
+                        for channel_info in channels
+                        for node_id in (channel_info.node1_id, channel_info.node2_id)]
+                rows = []
+                # sqlite limits the number of parameters of a query
+                for keys_chunk in chunks(keys, 500):
+                    c.execute(select_policy + f""" WHERE key IN ({','.join('?' * len(keys_chunk))})""", keys_chunk)
+                    rows += c.fetchall()
+                policies = {(row[0][8:], ShortChannelID(row[0][:8])): Policy._make(row) for row in rows}
+            else:
+                policies = {}
+                for channel_info in channels:
+                    for node_id in (channel_info.node1_id, channel_info.node2_id):
+                        policy = all_policies.pop((node_id, channel_info.short_channel_id), None)
+                        if policy is not None:
+                            policies[(node_id, channel_info.short_channel_id)] = policy
+        with self.lock:
+            for channel_info in channels:
+                short_channel_id = channel_info.short_channel_id
+                self._channels[short_channel_id] = channel_info
+                self._channels_for_node[channel_info.node1_id].add(short_channel_id)
+                self._channels_for_node[channel_info.node2_id].add(short_channel_id)
+                # same as _update_num_policies_for_chan
+                num_policies = ((channel_info.node1_id, short_channel_id) in policies) \
+                    + ((channel_info.node2_id, short_channel_id) in policies)
+                [self._chans_with_0_policies, self._chans_with_1_policies,
+                 self._chans_with_2_policies][num_policies].add(short_channel_id)
+            self._policies.update(policies)
+            if self.graph is not None:
+                # the path finder sees whole batches
+                with self.graph.lock:
+                    for channel_info in channels:
+                        self.graph.add_channel(channel_info)
+                    for (node_id, short_channel_id), policy in policies.items():
+                        self.graph.update_policy(short_channel_id, node_id, policy)
+            self._num_channels_loaded += len(channels)
+
+    @sql
+    def _load_orphaned_policies(self, policies: Dict[Tuple[bytes, ShortChannelID], Policy]) -> None:
+        """Loads the policies left in policies, so that they get pruned eventually.
+        Those of the first batch of channels are already loaded, and may have changed since.
+        """
+        with self.lock:
+            for key, policy in policies.items():
+                self._policies.setdefault(key, policy)
+            if self.graph is not None:
+                self.graph.compact()
 
     def _update_num_policies_for_chan(self, short_channel_id: ShortChannelID) -> None:
         channel_info = self.get_channel_info(short_channel_id)
@@ -734,10 +1048,11 @@ class ChannelDB(SqlDB):
     def get_channels_for_node(self, node_id: bytes, *,
                               my_channels: Dict[ShortChannelID, 'Channel'] = None) -> Set[bytes]:
         """Returns the set of short channel IDs where node_id is one of the channel participants."""
-        if not self.data_loaded.is_set():
+        if not self.data_partially_loaded.is_set():
             raise Exception("channelDB data not loaded yet!")
-        relevant_channels = self._channels_for_node.get(node_id) or set()
-        relevant_channels = set(relevant_channels)  # copy
+        with self.lock:
+            relevant_channels = self._channels_for_node.get(node_id) or set()
+            relevant_channels = set(relevant_channels)  # copy
         # add our own channels  # TODO maybe slow?
         for chan in (my_channels.values() or []):
             if node_id in (chan.node_id, chan.get_local_pubkey()):
@@ -36,7 +36,7 @@ import inspect
 from functools import wraps, partial
 from itertools import repeat
 from decimal import Decimal
-from typing import Optional, TYPE_CHECKING, Dict, List
+from typing import Optional, TYPE_CHECKING, Dict, List, Tuple
 
 from .import util, ecc
 from .util import (bfh, bh2u, format_satoshis, json_decode, json_normalize,
@@ -219,6 +219,12 @@ class Commands:
         return [{'path': path, 'synchronized': w.is_up_to_date()}
                 for path, w in self.daemon.get_wallets().items()]
 
+    @command('w')
+    async def getsavestats(self, wallet: Abstract_Wallet = None):
+        """Wallet file save statistics: number of save requests, number of
+        actual writes, and write latency in seconds."""
+        return wallet.get_save_db_stats()
+
     @command('n')
     async def load_wallet(self, wallet_path=None, password=None):
         """Open wallet in daemon"""
@@ -643,8 +649,14 @@ class Commands:
         return result
 
     @command('w')
-    async def onchain_history(self, year=None, show_addresses=False, show_fiat=False, wallet: Abstract_Wallet = None):
-        """Wallet onchain history. Returns the transaction history of your wallet."""
+    async def onchain_history(self, year=None, show_addresses=False, show_fiat=False,
+                              offset=None, limit=None, cursor=None, stream=False,
+                              wallet: Abstract_Wallet = None):
+        """Wallet onchain history. Returns the transaction history of your wallet.
+        Use limit with offset or cursor to get the history one page at a time.
+        With stream, transactions are returned one by one, followed by the summary
+        (as newline-delimited JSON, if called over JSON-RPC).
+        """
         kwargs = {
             'show_addresses': show_addresses,
         }
@@ -658,7 +670,25 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
-        return json_normalize(wallet.get_detailed_history(**kwargs))
+        if stream:
+            if offset or limit is not None or cursor:
+                raise Exception("stream cannot be combined with offset, limit or cursor")
+            return _stream_json(wallet.iter_detailed_history(**kwargs))
+        after_txpos = _parse_history_cursor(cursor) if cursor else None
+        with wallet.lock:
+            result = wallet.get_detailed_history(after_txpos=after_txpos, offset=offset or 0, limit=limit, **kwargs)
+            if limit is not None:
+                txs = result['transactions']
+                next_cursor = None
+                if len(txs) == limit:
+                    last_txid = txs[-1]['txid']
+                    last_txpos = (*wallet.get_txpos(last_txid), last_txid)
+                    if wallet.get_history(after_txpos=last_txpos, limit=1,
+                                          from_timestamp=kwargs.get('from_timestamp'),
+                                          to_timestamp=kwargs.get('to_timestamp')):
+                        next_cursor = _format_history_cursor(last_txpos)
+                result['next_cursor'] = next_cursor
+        return json_normalize(result)
 
     @command('w')
     async def lightning_history(self, show_fiat=False, wallet: Abstract_Wallet = None):
@@ -1049,6 +1079,17 @@ class Commands:
     async def clear_ln_blacklist(self):
         self.network.path_finder.blacklist.clear()
 
+    @command('n')
+    async def get_route_cache_stats(self):
+        """Return hit/miss counts of the lightning route cache"""
+        return self.network.path_finder.route_cache.get_stats()
+
+    @command('n')
+    async def get_shared_sync_stats(self):
+        """Return the number of transactions and merkle proofs that the open wallets
+        requested, and how many of those had to be fetched from the server"""
+        return self.network.shared_sync.get_stats()
+
     @command('w')
     async def list_invoices(self, wallet: Abstract_Wallet = None):
         l = wallet.get_invoices()
@@ -1149,6 +1190,28 @@ def eval_bool(x: str) -> bool:
     except:
         return bool(x)
 
+def _format_history_cursor(txpos: Tuple[float, int, str]) -> str:
+    # the position of the tx rather than its txid, so that paging
+    # goes on if the tx gets removed or moves (e.g. gets mined)
+    height, pos, txid = txpos
+    return f"{height!r}:{pos}:{txid}"
+
+
+def _parse_history_cursor(cursor: str) -> Tuple[float, int, str]:
+    try:
+        height, pos, txid = cursor.split(':')
+        return float(height), int(pos), txid
+    except ValueError:
+        raise Exception(f"invalid cursor: {cursor!r}") from None
+
+
+async def _stream_json(items):
+    for item in items:
+        yield json_normalize(item)
+        # let other tasks run between items
+        await asyncio.sleep(0)
+
+
 param_descriptions = {
     'privkey': 'Private key. Type \'?\' to get a prompt.',
     'destination': 'Bitcoin address, contact or alias',
@@ -1211,6 +1274,10 @@ command_options = {
     'show_fiat':   (None, "Show fiat value of transactions"),
     'show_fees':   (None, "Show miner fees paid by transactions"),
     'year':        (None, "Show history for a given year"),
+    'offset':      (None, "Number of items to skip"),
+    'limit':       (None, "Maximum number of items to return"),
+    'cursor':      (None, "Return items after this position (the 'next_cursor' of the previous page)"),
+    'stream':      (None, "Stream the result (JSON-RPC only)"),
     'fee_method':  (None, "Fee estimation method to use"),
     'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
     'from_height': (None, "Only show transactions that confirmed after given block height"),
@@ -1228,6 +1295,8 @@ arg_types = {
     'nbits': int,
     'imax': int,
     'year': int,
+    'offset': int,
+    'limit': int,
     'from_height': int,
     'to_height': int,
     'tx': convert_raw_tx_to_hex,
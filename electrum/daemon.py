@@ -24,6 +24,7 @@
 # SOFTWARE.
 import asyncio
 import ast
+import inspect
 import os
 import time
 import traceback
@@ -175,17 +176,17 @@ class AuthenticatedServer(Logger):
             await asyncio.sleep(0.050)
             raise AuthenticationCredentialsInvalid('Invalid Credentials')
 
-    async def handle(self, request):
+    async def handle(self, http_request):
         async with self.auth_lock:
             try:
-                await self.authenticate(request.headers)
+                await self.authenticate(http_request.headers)
             except AuthenticationInvalidOrMissing:
                 return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
                                     text='Unauthorized', status=401)
             except AuthenticationCredentialsInvalid:
                 return web.Response(text='Forbidden', status=403)
         try:
-            request = await request.text()
+            request = await http_request.text()
             request = json.loads(request)
             method = request['method']
             _id = request['id']
@@ -211,8 +212,33 @@ class AuthenticatedServer(Logger):
                 'code': 1,
                 'message': str(e),
             }
+        if inspect.isasyncgen(response.get('result')):
+            return await self._stream_response(http_request, response)
         return web.json_response(response)
 
+    async def _stream_response(self, http_request, response):
+        """Sends the items of an async generator result as newline-delimited
+        JSON, one JSON-RPC response per item, so that large results do not
+        need to be held in memory.
+        """
+        items = response.pop('result')
+        stream = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await stream.prepare(http_request)
+        try:
+            async for item in items:
+                response['result'] = item
+                await stream.write(json.dumps(response).encode('utf-8') + b'\n')
+        except Exception as e:
+            self.logger.exception("internal error while streaming RPC result")
+            response.pop('result', None)
+            response['error'] = {
+                'code': 1,
+                'message': str(e),
+            }
+            await stream.write(json.dumps(response).encode('utf-8') + b'\n')
+        await stream.write_eof()
+        return stream
+
 
 class CommandsServer(AuthenticatedServer):
 
@@ -276,6 +302,8 @@ class CommandsServer(AuthenticatedServer):
         # fixme: not sure how to retrieve message in jsonrpcclient
         try:
             result = await func(*args, **kwargs)
+            if inspect.isasyncgen(result):
+                result = [item async for item in result]
         except Exception as e:
             result = {'error':str(e)}
         return result
@@ -26,10 +26,10 @@
 import base64
 import hashlib
 import functools
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Iterable, List, Dict
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer,
-    CFUNCTYPE, POINTER, cast
+    CFUNCTYPE, POINTER, cast, Array
 )
 
 from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler, randrange
@@ -365,6 +365,41 @@ def verify_signature(pubkey: bytes, sig: bytes, h: bytes) -> bool:
         return False
     return True
 
+
+def verify_signatures(items: Iterable[Tuple[bytes, bytes, bytes]]) -> List[bool]:
+    """Batched verify_signature: items are (pubkey, sig, h) tuples.
+
+    Same results as calling verify_signature for each item, for a fraction
+    of the cost: we call libsecp256k1 directly, with reused buffers, and
+    each distinct pubkey is only parsed once per call.
+    """
+    ctx = _libsecp256k1.ctx
+    pubkey_parse = _libsecp256k1.secp256k1_ec_pubkey_parse
+    signature_parse_compact = _libsecp256k1.secp256k1_ecdsa_signature_parse_compact
+    signature_normalize = _libsecp256k1.secp256k1_ecdsa_signature_normalize
+    ecdsa_verify = _libsecp256k1.secp256k1_ecdsa_verify
+    parsed_pubkeys = {}  # type: Dict[bytes, Optional[Array]]
+    sig = create_string_buffer(64)
+    results = []
+    for pubkey_bytes, sig_string, h in items:
+        if pubkey_bytes in parsed_pubkeys:
+            pubkey = parsed_pubkeys[pubkey_bytes]
+        else:
+            pubkey = create_string_buffer(64)
+            if not (isinstance(pubkey_bytes, bytes)
+                    and pubkey_parse(ctx, pubkey, pubkey_bytes, len(pubkey_bytes))):
+                pubkey = None
+            parsed_pubkeys[pubkey_bytes] = pubkey
+        ok = (pubkey is not None
+              and isinstance(sig_string, bytes) and len(sig_string) == 64
+              and isinstance(h, bytes) and len(h) == 32
+              and signature_parse_compact(ctx, sig, sig_string) == 1)
+        if ok:
+            signature_normalize(ctx, sig, sig)
+            ok = ecdsa_verify(ctx, sig, h, pubkey) == 1
+        results.append(ok)
+    return results
+
 def verify_message_with_address(address: str, sig65: bytes, message: bytes, *, net=None):
     from .bitcoin import pubkey_to_address
     assert_bytes(sig65, message)
@@ -29,7 +29,7 @@ import sys
 import traceback
 import asyncio
 import socket
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence, Dict
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address, IPv4Address
 import itertools
@@ -69,6 +69,8 @@ ca_path = certifi.where()
 BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
 MAX_INCOMING_MSG_SIZE = 1_000_000  # in bytes
+# during header sync, number of header chunks requested ahead of the one being verified
+DEFAULT_CHUNK_REQUESTS_IN_FLIGHT = 4
 
 _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
@@ -136,6 +138,7 @@ class NotificationSession(RPCSession):
         super(NotificationSession, self).__init__(*args, **kwargs)
         self.subscriptions = defaultdict(list)
         self.cache = {}
+        self._pending_subscriptions = {}  # type: Dict[str, asyncio.Future]
         self.default_timeout = NetworkTimeout.Generic.NORMAL
         self._msg_counter = itertools.count(start=1)
         self.interface = interface
@@ -179,6 +182,26 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_batch_request(self, requests: Sequence[Tuple[str, List]], *, timeout=None) -> List[Any]:
+        """Sends the (method, params) requests as a single JSON-RPC batch.
+        Returns the results in order. An error returned by the server for
+        an individual request is returned in place of its result.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(requests)} requests (id: {msg_id})")
+
+        async def send_batch():
+            async with self.send_batch() as batch:
+                for method, params in requests:
+                    batch.add_request(method, params)
+            return list(batch.results)
+        try:
+            results = await asyncio.wait_for(send_batch(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'batch request timed out (id: {msg_id})') from e
+        self.maybe_log(f"--> {results} (id: {msg_id})")
+        return results
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -188,12 +211,58 @@ class NotificationSession(RPCSession):
         # each 'subscribe' call might make a request on the network.
         key = self.get_hashable_key_for_rpc_call(method, params)
         self.subscriptions[key].append(queue)
-        if key in self.cache:
-            result = self.cache[key]
-        else:
-            result = await self.send_request(method, params)
-            self.cache[key] = result
-        await queue.put(params + [result])
+        async def send(params_list):
+            return [await self.send_request(method, params_list[0])]
+        await self._request_subscriptions({key: params}, send)
+        await queue.put(params + [self.cache[key]])
+
+    async def subscribe_batch(self, method: str, params_list: Sequence[List], queue: asyncio.Queue):
+        """Same as subscribe, for several subscriptions at once.
+        The ones that are not cached yet are sent as a single batch request.
+        """
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        send = lambda to_send: self.send_batch_request([(method, params) for params in to_send])
+        await self._request_subscriptions(dict(zip(keys, params_list)), send)
+        for key, params in zip(keys, params_list):
+            await queue.put(params + [self.cache[key]])
+
+    async def _request_subscriptions(self, params_by_key: Dict[str, List], send) -> None:
+        """Gets the results of the given subscriptions into self.cache, sending
+        the missing ones with send(params_list) -> results.
+        Subscriptions that are already being sent, e.g. for another wallet
+        watching the same address, are waited for instead of sent again.
+        """
+        while True:
+            to_send = {}  # type: Dict[str, List]
+            waiting = []  # type: List[asyncio.Future]
+            for key, params in params_by_key.items():
+                if key in self.cache:
+                    continue
+                fut = self._pending_subscriptions.get(key)
+                if fut is not None:
+                    waiting.append(fut)
+                else:
+                    to_send[key] = params
+            if not to_send and not waiting:
+                return
+            if to_send:
+                loop = asyncio.get_event_loop()
+                for key in to_send:
+                    self._pending_subscriptions[key] = loop.create_future()
+                try:
+                    results = await send(list(to_send.values()))
+                    for key, result in zip(to_send, results):
+                        if isinstance(result, Exception):
+                            raise result
+                        self.cache[key] = result
+                finally:
+                    for key in to_send:
+                        self._pending_subscriptions.pop(key).set_result(None)
+            # if the other request failed, we will send it ourselves on the next iteration
+            for fut in waiting:
+                await asyncio.shield(fut)
 
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
@@ -591,6 +660,69 @@ class Interface(Logger):
         if can_return_early and index in self._requested_chunks:
             return
         self.logger.info(f"requesting chunk from height {height}")
+        hexdata = await self._fetch_chunk(index, tip)
+        conn = self.blockchain.connect_chunk(index, hexdata)
+        if not conn:
+            return conn, 0
+        return conn, len(hexdata) // (HEADER_SIZE * 2)
+
+    async def request_chunks(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Downloads and connects the chunks from the one containing height up to tip.
+        Requests for the next few chunks are sent while waiting for the current one;
+        chunks are verified and saved in order.
+        Returns whether all chunks could be connected, and the height to continue
+        syncing from (i.e. after the last connected header, or at the chunk that failed).
+        """
+        if not is_non_negative_integer(height):
+            raise Exception(f"{repr(height)} is not a block height")
+        num_in_flight = max(1, self.network.config.get('network_chunk_requests_in_flight',
+                                                       DEFAULT_CHUNK_REQUESTS_IN_FLIGHT))
+        first_index, last_index = height // 2016, tip // 2016
+        self.logger.info(f"requesting chunks {first_index}-{last_index}, {num_in_flight} at a time")
+        next_index_to_request = first_index
+        pending = {}  # type: Dict[int, asyncio.Future]
+        try:
+            for index in range(first_index, last_index + 1):
+                while next_index_to_request <= last_index and len(pending) < num_in_flight:
+                    pending[next_index_to_request] = await self.taskgroup.spawn(
+                        self._fetch_chunk_from_any_interface(next_index_to_request, tip))
+                    next_index_to_request += 1
+                hexdata, interface = await pending.pop(index)
+                connected = self.blockchain.connect_chunk(index, hexdata)
+                if not connected and interface is not self:
+                    # do not hold another server's bad chunk against ours
+                    self.logger.info(f"bad chunk {index} from {interface.server}. disconnecting it")
+                    await interface.close()
+                    hexdata = await self._fetch_chunk(index, tip)
+                    connected = self.blockchain.connect_chunk(index, hexdata)
+                if not connected:
+                    return False, max(height, index * 2016)
+                height = index * 2016 + len(hexdata) // (HEADER_SIZE * 2)
+                util.trigger_callback('network_updated')
+        finally:
+            for fut in pending.values():
+                fut.cancel()
+        return True, height
+
+    async def _fetch_chunk_from_any_interface(self, index: int, tip: int) -> Tuple[str, 'Interface']:
+        """Returns the chunk as hex, and the interface it was downloaded from."""
+        # Chunks in the checkpoint region can be downloaded from any server, as
+        # the checkpoints pin them down. After that, we stay on our server's chain.
+        if index < len(constants.net.CHECKPOINTS):
+            interfaces = [iface for iface in self.network.interfaces.values()
+                          if iface.ready.done() and not iface.ready.cancelled()
+                          and iface.session and not iface.session.is_closing()]
+            if interfaces:
+                interface = interfaces[index % len(interfaces)]
+                if interface is not self:
+                    try:
+                        return await interface._fetch_chunk(index, tip), interface
+                    except Exception as e:
+                        self.logger.info(f"failed to get chunk {index} from {interface.server}: {repr(e)}")
+        return await self._fetch_chunk(index, tip), self
+
+    async def _fetch_chunk(self, index: int, tip: Optional[int]) -> str:
+        """Requests the headers of chunk index (up to tip) and returns them as hex."""
         size = 2016
         if tip is not None:
             size = min(size, tip - index * 2016 + 1)
@@ -610,10 +742,7 @@ class Interface(Logger):
             raise RequestCorrupted('inconsistent chunk hex and count')
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+        return res['hex']
 
     def is_main_server(self) -> bool:
         return self.network.default_server == self.server
@@ -721,14 +850,12 @@ class Interface(Logger):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                could_connect, height = await self.request_chunks(height, next_height)
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
                     last, height = await self.step(height)
                     continue
-                util.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
                 assert height <= next_height+1, (height, self.tip)
                 last = 'catchup'
             else:
@@ -896,7 +1023,26 @@ class Interface(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         # do request
         res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
-        # check response
+        self._check_merkle_response(res)
+        return res
+
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List[Union[dict, CodeMessageError]]:
+        """Batched get_merkle_for_transaction, for a list of (tx_hash, tx_height).
+        An error returned by the server for a tx is returned in place of its result.
+        """
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.session.send_batch_request(
+            [('blockchain.transaction.get_merkle', [tx_hash, tx_height]) for tx_hash, tx_height in txs])
+        for res in results:
+            if not isinstance(res, CodeMessageError):
+                self._check_merkle_response(res)
+        return results
+
+    def _check_merkle_response(self, res) -> None:
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
         pos = assert_dict_contains_field(res, field_name='pos')
@@ -906,13 +1052,29 @@ class Interface(Logger):
         assert_list_or_tuple(merkle)
         for item in merkle:
             assert_hash256_str(item)
-        return res
 
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
         raw = await self.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
-        # validate response
+        self._check_transaction_response(tx_hash, raw)
+        return raw
+
+    async def get_transactions(self, tx_hashes: Sequence[str], *, timeout=None) -> List[Union[str, CodeMessageError]]:
+        """Batched get_transaction. An error returned by the server
+        for a tx is returned in place of the raw tx.
+        """
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        results = await self.session.send_batch_request(
+            [('blockchain.transaction.get', [tx_hash]) for tx_hash in tx_hashes], timeout=timeout)
+        for tx_hash, raw in zip(tx_hashes, results):
+            if not isinstance(raw, CodeMessageError):
+                self._check_transaction_response(tx_hash, raw)
+        return results
+
+    def _check_transaction_response(self, tx_hash: str, raw) -> None:
         tx = Transaction(raw)
         try:
             tx.deserialize()  # see if raises
@@ -920,14 +1082,30 @@ class Interface(Logger):
             raise RequestCorrupted(f"cannot deserialize received transaction (txid {tx_hash})") from e
         if tx.txid() != tx_hash:
             raise RequestCorrupted(f"received tx does not match expected txid {tx_hash} (got {tx.txid()})")
-        return raw
 
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
         # do request
         res = await self.session.send_request('blockchain.scripthash.get_history', [sh])
-        # check response
+        self._check_history_response(res)
+        return res
+
+    async def get_history_for_scripthashes(self, shs: Sequence[str]) -> List[Union[List[dict], CodeMessageError]]:
+        """Batched get_history_for_scripthash. An error returned by the server
+        for a scripthash is returned in place of its history.
+        """
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        results = await self.session.send_batch_request(
+            [('blockchain.scripthash.get_history', [sh]) for sh in shs])
+        for res in results:
+            if not isinstance(res, CodeMessageError):
+                self._check_history_response(res)
+        return results
+
+    def _check_history_response(self, res) -> None:
         assert_list_or_tuple(res)
         for tx_item in res:
             assert_dict_contains_field(tx_item, field_name='height')
@@ -937,7 +1115,6 @@ class Interface(Logger):
             if tx_item['height'] in (-1, 0):
                 assert_dict_contains_field(tx_item, field_name='fee')
                 assert_non_negative_integer(tx_item['fee'])
-        return res
 
     async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
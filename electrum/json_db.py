@@ -25,16 +25,63 @@
 import threading
 import copy
 import json
+from typing import Sequence, Optional, List, Set, Tuple, Dict, Iterable
 
 from . import util
 from .logging import Logger
 
 JsonDBJsonEncoder = util.MyEncoder
 
+def key_path(path: Sequence[str], key: Optional[str]) -> List[str]:
+    """Returns the path of 'key' inside the dict found at 'path'."""
+    return list(path) + ([key] if key is not None else [])
+
+
+def apply_patch(data: dict, patch: dict) -> None:
+    """Replays a single recorded mutation on plain json data.
+
+    Patches are the json objects appended to the wallet file by
+    JsonDB.write; see JsonDB.add_patch.
+    """
+    op = patch['op']
+    path = patch['path']
+    parent = data
+    for k in path[:-1]:
+        parent = parent[int(k)] if isinstance(parent, list) else parent[k]
+    key = path[-1]
+    if op in ('add', 'replace'):
+        if isinstance(parent, list):
+            if key == '-':
+                parent.append(patch['value'])
+            else:
+                parent[int(key)] = patch['value']
+        else:
+            parent[key] = patch['value']
+    elif op == 'remove':
+        if isinstance(parent, list):
+            parent.pop(int(key))
+        else:
+            parent.pop(key, None)
+    else:
+        raise Exception(f"unknown patch op: {op!r}")
+
+
+def collapse_paths(paths: Iterable[Tuple[str, ...]]) -> List[Tuple[str, ...]]:
+    """Removes the paths that are inside another path of the set."""
+    out = []
+    for path in sorted(set(paths), key=len):
+        if not any(path[:len(p)] == p for p in out):
+            out.append(path)
+    return out
+
+
 def modifier(func):
     def wrapper(self, *args, **kwargs):
         with self.lock:
             self._modified = True
+            if not isinstance(self.data, StoredDict):
+                # changes to plain data are not recorded as patches
+                self._needs_full_write = True
             return func(self, *args, **kwargs)
     return wrapper
 
@@ -48,18 +95,21 @@ def locked(func):
 class StoredObject:
 
     db = None
+    path = None
 
     def __setattr__(self, key, value):
-        if self.db:
-            self.db.set_modified(True)
+        if self.db and key not in ('db', 'path') and not key.startswith('_'):
+            self.db.add_patch('replace', key_path(self.path, key), value)
         object.__setattr__(self, key, value)
 
-    def set_db(self, db):
+    def set_db(self, db, path=None):
         self.db = db
+        self.path = path
 
     def to_json(self):
         d = dict(vars(self))
         d.pop('db', None)
+        d.pop('path', None)
         # don't expose/store private stuff
         d = {k: v for k, v in d.items()
              if not k.startswith('_')}
@@ -74,9 +124,15 @@ class StoredDict(dict):
         self.db = db
         self.lock = self.db.lock if self.db else threading.RLock()
         self.path = path
+        # keys whose values are still in their raw json form, see JsonDB._should_load_lazily
+        self._lazy_keys = None  # type: Optional[Set[str]]
+        if self.db and self.db._should_load_lazily(path):
+            dict.update(self, data)
+            self._lazy_keys = set(data.keys())
+            return
         # recursively convert dicts to StoredDict
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self.__setitem__(k, v, patch=False)
 
     def convert_key(self, key):
         """Convert int keys to str keys, as only those are allowed in json."""
@@ -86,22 +142,30 @@ class StoredDict(dict):
         return str(int(key)) if isinstance(key, int) else key
 
     @locked
-    def __setitem__(self, key, v):
+    def __setitem__(self, key, v, patch=True):
         key = self.convert_key(key)
         is_new = key not in self
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
             return
+        v = self._convert(key, v)
+        # set item
+        dict.__setitem__(self, key, v)
+        if patch and self.db:
+            self.db.add_patch('add' if is_new else 'replace', key_path(self.path, key), v)
+
+    def _convert(self, key, v):
         # recursively set db and path
         if isinstance(v, StoredDict):
             v.db = self.db
             v.path = self.path + [key]
             for k, vv in v.items():
-                v[k] = vv
+                v.__setitem__(k, vv, patch=False)
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
-            if self.db:
+            # lazily loaded dicts convert their values one by one, on access
+            if self.db and not self.db._should_load_lazily(self.path + [key]):
                 v = self.db._convert_dict(self.path, key, v)
             if not self.db or self.db._should_convert_to_stored_dict(key):
                 v = StoredDict(v, self.db, self.path + [key])
@@ -111,22 +175,36 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
-        # set item
-        dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+            v.set_db(self.db, self.path + [key])
+        return v
+
+    def _load_lazy_key(self, key) -> None:
+        """Converts a value that was left raw when the db was loaded."""
+        if not self._lazy_keys or key not in self._lazy_keys:
+            return
+        self._lazy_keys.discard(key)
+        v = dict.__getitem__(self, key)
+        if self.path:
+            v = self.db._convert_dict(self.path[:-1], self.path[-1], {key: v})[key]
+        dict.__setitem__(self, key, self._convert(key, v))
+
+    def _load_all_lazy_keys(self) -> None:
+        for key in list(self._lazy_keys or ()):
+            self._load_lazy_key(key)
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
+        if self._lazy_keys:
+            self._lazy_keys.discard(key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch('remove', key_path(self.path, key))
 
     @locked
     def __getitem__(self, key):
         key = self.convert_key(key)
+        self._load_lazy_key(key)
         return dict.__getitem__(self, key)
 
     @locked
@@ -137,37 +215,189 @@ class StoredDict(dict):
     @locked
     def pop(self, key, v=_RaiseKeyError):
         key = self.convert_key(key)
+        self._load_lazy_key(key)
         if v is _RaiseKeyError:
             r = dict.pop(self, key)
+        elif key in self:
+            r = dict.pop(self, key)
         else:
-            r = dict.pop(self, key, v)
+            return v
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch('remove', key_path(self.path, key))
         return r
 
     @locked
     def get(self, key, default=None):
         key = self.convert_key(key)
+        self._load_lazy_key(key)
         return dict.get(self, key, default)
 
+    @locked
+    def peek(self, key, default=None):
+        """Like get, but values that were not accessed since the db was loaded
+        are returned in their raw json form. For read-only use.
+        """
+        key = self.convert_key(key)
+        return dict.get(self, key, default)
+
+    @locked
+    def items(self):
+        self._load_all_lazy_keys()
+        return dict.items(self)
+
+    @locked
+    def values(self):
+        self._load_all_lazy_keys()
+        return dict.values(self)
+
+    @locked
+    def clear(self):
+        dict.clear(self)
+        self._lazy_keys = None
+        if self.db:
+            self.db.add_patch('replace', key_path(self.path, None), {})
 
 
 
+def _without_lazy_loading(v):
+    """Returns v, with the StoredDicts that still hold raw values replaced by
+    plain (shallow) copies, as encoding a StoredDict calls its items(),
+    which converts them.
+    """
+    if not isinstance(v, StoredDict):
+        return v
+    replaced = {}
+    for key, value in dict.items(v):
+        if isinstance(value, StoredDict):
+            new_value = _without_lazy_loading(value)
+            if new_value is not value:
+                replaced[key] = new_value
+    if not replaced and not v._lazy_keys:
+        return v
+    d = dict(dict.items(v))
+    d.update(replaced)
+    return d
+
+
 class JsonDB(Logger):
 
+    # above this, the dirty paths of a consumer are reduced to their top-level keys
+    MAX_DIRTY_PATHS = 1000
+
     def __init__(self, data):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        # json-encoded mutations not yet written to disk, see add_patch
+        self.pending_changes = []  # type: List[str]
+        # set if some change could not be expressed as a patch
+        self._needs_full_write = False
+        # consumer name -> paths changed since the consumer last popped them
+        self._dirty_paths = {}  # type: Dict[str, Set[Tuple[str, ...]]]
 
     def set_modified(self, b):
+        """Setting this flag from outside means the db was changed in a way
+        that patches do not capture, so the next write will be a full one.
+        """
         with self.lock:
             self._modified = b
+            if b:
+                self._needs_full_write = True
+                self._add_dirty_path(())
+            else:
+                self._needs_full_write = False
+                self.pending_changes = []
 
     def modified(self):
         return self._modified
 
+    def add_patch(self, op: str, path: Sequence[str], value=None) -> None:
+        """Records a path-level mutation of self.data.
+
+        The value is serialized right away, as the object might be mutated
+        further before the next write.
+        """
+        with self.lock:
+            self._modified = True
+            self._add_dirty_path(tuple(path))
+            if self._needs_full_write:
+                # everything gets rewritten anyway
+                return
+            patch = {'op': op, 'path': list(path)}
+            if op != 'remove':
+                patch['value'] = value
+            self.pending_changes.append(json.dumps(patch, cls=JsonDBJsonEncoder))
+
+    def _add_dirty_path(self, path: Tuple[str, ...]) -> None:
+        for consumer, paths in self._dirty_paths.items():
+            paths.add(path)
+            if len(paths) > self.MAX_DIRTY_PATHS:
+                self._dirty_paths[consumer] = {p[:1] for p in paths}
+
+    @locked
+    def track_dirty_paths(self, consumer: str) -> None:
+        """Starts recording changed paths on behalf of 'consumer'.
+        Calling it again resets the paths recorded so far.
+        """
+        self._dirty_paths[consumer] = set()
+
+    @locked
+    def pop_dirty_paths(self, consumer: str) -> Optional[Set[Tuple[str, ...]]]:
+        """Returns the paths changed since the last call, and resets them.
+
+        The empty path means that everything must be considered changed.
+        Returns None if the consumer is not tracking changes.
+        """
+        if consumer not in self._dirty_paths:
+            return None
+        paths = self._dirty_paths[consumer]
+        self._dirty_paths[consumer] = set()
+        return paths
+
+    @locked
+    def restore_dirty_paths(self, consumer: str, paths: Iterable[Tuple[str, ...]]) -> None:
+        """Puts back paths returned by pop_dirty_paths, if the consumer
+        failed to process them. They are merged with the paths changed since.
+        """
+        if consumer in self._dirty_paths:
+            self._dirty_paths[consumer].update(paths)
+
+    @locked
+    def untrack_dirty_paths(self, consumer: str) -> None:
+        self._dirty_paths.pop(consumer, None)
+
+    @locked
+    def copy_paths_from(self, other: 'JsonDB', paths: Iterable[Tuple[str, ...]], *,
+                        exclude: Sequence[str] = ()) -> None:
+        """Copies the subtrees of other.data found at 'paths' into self.data,
+        removing them if they no longer exist in other.
+
+        The values are copied as plain json. Top-level keys in 'exclude'
+        are left untouched.
+        """
+        with other.lock:
+            paths = collapse_paths(paths)
+            if () in paths:
+                paths = [(k,) for k in set(self.data.keys()) | set(other.data.keys())]
+            for path in paths:
+                if path[0] in exclude:
+                    continue
+                src, dst = other.data, self.data
+                for n, key in enumerate(path):
+                    if key not in src:
+                        dst.pop(key, None)
+                        break
+                    is_last = n == len(path) - 1
+                    if is_last or not isinstance(src[key], dict) or not isinstance(dst.get(key), dict):
+                        # note: lists are copied as a whole
+                        dst[key] = json.loads(json.dumps(_without_lazy_loading(src[key]), cls=JsonDBJsonEncoder))
+                        break
+                    src, dst = src[key], dst[key]
+
+    def needs_full_write(self) -> bool:
+        return self._needs_full_write or not isinstance(self.data, StoredDict)
+
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
@@ -194,7 +424,19 @@ class JsonDB(Logger):
 
     @locked
     def dump(self):
-        return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
+        data = _without_lazy_loading(self.data)
+        return json.dumps(data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
+
+    @locked
+    def dump_pending_changes(self) -> str:
+        """Returns the pending patches, in the format appended to the file."""
+        return ''.join(',\n' + x for x in self.pending_changes)
 
     def _should_convert_to_stored_dict(self, key) -> bool:
         return True
+
+    def _should_load_lazily(self, path: Sequence[str]) -> bool:
+        """Whether the values of the dict at 'path' are left in their raw
+        json form on load, and only converted on first access.
+        """
+        return False
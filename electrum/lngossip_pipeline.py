@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Decoding and signature verification of gossip, off the event loop.
+
+Peers queue the raw gossip messages they receive. GossipPipeline decodes
+them and verifies their signatures in batches, in a pool of worker
+processes, and returns the decoded payloads of the valid ones. Only
+the ChannelDB bookkeeping is left to the event loop.
+
+With 'lightning_gossip_workers' set to 0, or if worker processes cannot
+be started, batches are processed in the default thread pool instead.
+That still keeps decoding off the event loop, but not off the GIL.
+This is the default in frozen builds and on Android, where starting
+worker processes is not reliable.
+"""
+
+import os
+import sys
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, List, Sequence, Optional, TYPE_CHECKING
+
+from . import ecc
+from .crypto import sha256d
+from .lnmsg import decode_msg, MalformedMsg
+from .logging import Logger
+from .util import chunks
+
+if TYPE_CHECKING:
+    from .simple_config import SimpleConfig
+
+
+GOSSIP_MSG_TYPES = {
+    256: 'channel_announcement',
+    257: 'node_announcement',
+    258: 'channel_update',
+}
+
+BATCH_SIZE = 500  # messages per job sent to a worker
+
+
+def get_gossip_msg_type(msg: bytes) -> Optional[str]:
+    """Returns the name of a gossip message without decoding it, or None if it is not gossip."""
+    return GOSSIP_MSG_TYPES.get(int.from_bytes(msg[:2], 'big'))
+
+
+def verify_channel_announcements(chan_anns: Sequence[dict]) -> List[bool]:
+    items = []
+    for payload in chan_anns:
+        h = sha256d(payload['raw'][2+256:])
+        pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
+        sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
+        items += [(pubkey, sig, h) for pubkey, sig in zip(pubkeys, sigs)]
+    results = ecc.verify_signatures(items)
+    return [all(results[4*i:4*i+4]) for i in range(len(chan_anns))]
+
+
+def verify_node_announcements(node_anns: Sequence[dict]) -> List[bool]:
+    items = [(payload['node_id'], payload['signature'], sha256d(payload['raw'][66:]))
+             for payload in node_anns]
+    return ecc.verify_signatures(items)
+
+
+class GossipBatch(NamedTuple):
+    chan_anns: List[dict]
+    node_anns: List[dict]
+    chan_upds: List[dict]  # note: their signature can only be checked against the channel, by ChannelDB
+    num_invalid: int  # messages that did not decode, or with a bad signature
+
+
+def process_gossip_batch(msgs: Sequence[bytes]) -> GossipBatch:
+    """Decodes gossip messages and verifies the signatures of announcements.
+    This runs in a worker process.
+    """
+    batch = GossipBatch([], [], [], 0)
+    num_invalid = 0
+    for msg in msgs:
+        try:
+            msg_type, payload = decode_msg(msg)
+        except MalformedMsg:
+            num_invalid += 1
+            continue
+        # raw message is needed to check signature, and is what we store
+        payload['raw'] = msg
+        if msg_type == 'channel_announcement':
+            batch.chan_anns.append(payload)
+        elif msg_type == 'node_announcement':
+            batch.node_anns.append(payload)
+        elif msg_type == 'channel_update':
+            batch.chan_upds.append(payload)
+        else:
+            num_invalid += 1
+    chan_anns_ok = verify_channel_announcements(batch.chan_anns)
+    node_anns_ok = verify_node_announcements(batch.node_anns)
+    num_invalid += chan_anns_ok.count(False) + node_anns_ok.count(False)
+    return GossipBatch(
+        chan_anns=[p for p, ok in zip(batch.chan_anns, chan_anns_ok) if ok],
+        node_anns=[p for p, ok in zip(batch.node_anns, node_anns_ok) if ok],
+        chan_upds=batch.chan_upds,
+        num_invalid=num_invalid)
+
+
+class GossipPipeline(Logger):
+
+    def __init__(self, config: 'SimpleConfig'):
+        Logger.__init__(self)
+        if getattr(sys, 'frozen', False) or 'ANDROID_DATA' in os.environ:
+            default_workers = 0
+        else:
+            default_workers = min(4, max(1, (os.cpu_count() or 1) - 1))
+        self.num_workers = config.get('lightning_gossip_workers', default_workers)
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        if self._executor is None and self.num_workers > 0:
+            try:
+                # spawn rather than fork: we have threads running.
+                # note: mp_context requires python 3.7
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.num_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            except Exception as e:
+                self.logger.warning(f"cannot start gossip workers, using threads instead: {e!r}")
+                self.num_workers = 0
+                return None
+            self.logger.info(f"started {self.num_workers} gossip workers")
+        return self._executor
+
+    async def process(self, msgs: Sequence[bytes]) -> GossipBatch:
+        """Decodes and verifies raw gossip messages, in parallel batches."""
+        loop = asyncio.get_event_loop()
+        try:
+            executor = self._get_executor()
+            batches = await asyncio.gather(*[loop.run_in_executor(executor, process_gossip_batch, batch)
+                                             for batch in chunks(msgs, BATCH_SIZE)])
+        except (BrokenProcessPool, OSError) as e:
+            self.logger.warning(f"gossip workers failed, using threads instead: {e!r}")
+            self.stop()
+            self.num_workers = 0
+            batches = await asyncio.gather(*[loop.run_in_executor(None, process_gossip_batch, batch)
+                                             for batch in chunks(msgs, BATCH_SIZE)])
+        result = GossipBatch([], [], [], 0)
+        for batch in batches:
+            result.chan_anns.extend(batch.chan_anns)
+            result.node_anns.extend(batch.node_anns)
+            result.chan_upds.extend(batch.chan_upds)
+        return result._replace(num_invalid=sum(batch.num_invalid for batch in batches))
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
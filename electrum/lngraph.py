@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Compact, array-backed view of the public channel graph.
+
+ChannelDB keeps the gossip it received in dicts of NamedTuples, which is
+convenient but costs a few hundred bytes per channel and a couple of dict
+lookups per edge visited during path finding. CompactChannelGraph mirrors
+the routing-relevant part of it in flat columns indexed by integers:
+
+- nodes and channels are numbered in order of insertion,
+- per channel: the two endpoints and the capacity,
+- per directed edge (2*channel + direction, direction 0 starting at node1):
+  the fields of the channel_update that path finding looks at,
+- the adjacency is stored in CSR form (an offsets array into a flat array
+  of channel indices), plus a small overlay for channels added since the
+  CSR was last built.
+
+Removed channels leave a hole that is skipped when iterating; holes and
+the overlay are folded back into the CSR by compact().
+ChannelDB stays the source of truth; this only ever gets written to from there.
+"""
+
+import threading
+from array import array
+from typing import Dict, List, Optional, Iterator, TYPE_CHECKING
+
+from .lnutil import ShortChannelID
+
+if TYPE_CHECKING:
+    from .channel_db import ChannelInfo, Policy
+
+
+INT64_MAX = 2 ** 63 - 1
+
+
+class CompactChannelGraph:
+
+    # fold the overlay into the CSR once this many channels were added or removed
+    MIN_CHANGES_BEFORE_COMPACT = 1000
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        # nodes
+        self.node_ids = []  # type: List[bytes]
+        self._node_idx = {}  # type: Dict[bytes, int]
+        # channels
+        self.scids = []  # type: List[Optional[ShortChannelID]]  # None for removed channels
+        self._chan_idx = {}  # type: Dict[ShortChannelID, int]
+        self.node1 = array('i')
+        self.node2 = array('i')
+        self.capacity_sat = array('q')  # -1 if unknown
+        # directed edges
+        self.has_policy = bytearray()
+        self.disabled = bytearray()
+        self.fee_base_msat = array('q')
+        self.fee_proportional_millionths = array('q')
+        self.cltv_expiry_delta = array('i')
+        self.htlc_minimum_msat = array('q')
+        self.htlc_maximum_msat = array('q')  # -1 if not set
+        # adjacency: channels of node n are adj_chans[adj_start[n]:adj_start[n+1]]
+        self._adj_start = array('i', [0])
+        self._adj_chans = array('i')
+        self._added_adj = {}  # type: Dict[int, List[int]]  # channels not in the CSR yet
+        self._num_removed = 0
+        self._num_added = 0
+
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    def num_channels(self) -> int:
+        return len(self._chan_idx)
+
+    def node_index(self, node_id: bytes) -> Optional[int]:
+        return self._node_idx.get(node_id)
+
+    def channel_index(self, short_channel_id: ShortChannelID) -> Optional[int]:
+        return self._chan_idx.get(short_channel_id)
+
+    def _add_node(self, node_id: bytes) -> int:
+        idx = self._node_idx.get(node_id)
+        if idx is None:
+            idx = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self._node_idx[node_id] = idx
+        return idx
+
+    def add_channel(self, channel_info: 'ChannelInfo') -> None:
+        with self.lock:
+            scid = channel_info.short_channel_id
+            if scid in self._chan_idx:
+                return
+            n1 = self._add_node(channel_info.node1_id)
+            n2 = self._add_node(channel_info.node2_id)
+            chan = len(self.scids)
+            self.scids.append(scid)
+            self._chan_idx[scid] = chan
+            self.node1.append(n1)
+            self.node2.append(n2)
+            capacity_sat = channel_info.capacity_sat
+            self.capacity_sat.append(capacity_sat if capacity_sat is not None else -1)
+            for _ in range(2):
+                self.has_policy.append(0)
+                self.disabled.append(0)
+                self.fee_base_msat.append(0)
+                self.fee_proportional_millionths.append(0)
+                self.cltv_expiry_delta.append(0)
+                self.htlc_minimum_msat.append(0)
+                self.htlc_maximum_msat.append(-1)
+            self._added_adj.setdefault(n1, []).append(chan)
+            self._added_adj.setdefault(n2, []).append(chan)
+            self._num_added += 1
+
+    def remove_channel(self, short_channel_id: ShortChannelID) -> None:
+        with self.lock:
+            chan = self._chan_idx.pop(short_channel_id, None)
+            if chan is None:
+                return
+            self.scids[chan] = None
+            self.has_policy[2*chan] = self.has_policy[2*chan+1] = 0
+            self._num_removed += 1
+
+    def update_policy(self, short_channel_id: ShortChannelID, start_node: bytes,
+                      policy: Optional['Policy']) -> None:
+        """Sets the policy of the edge starting at start_node. policy=None removes it."""
+        with self.lock:
+            chan = self._chan_idx.get(short_channel_id)
+            if chan is None:
+                return
+            node = self._node_idx[start_node]
+            if node == self.node1[chan]:
+                edge = 2 * chan
+            elif node == self.node2[chan]:
+                edge = 2 * chan + 1
+            else:
+                return
+            if policy is None:
+                self.has_policy[edge] = 0
+                return
+            self.has_policy[edge] = 1
+            self.disabled[edge] = 1 if policy.is_disabled() else 0
+            self.fee_base_msat[edge] = min(policy.fee_base_msat, INT64_MAX)
+            self.fee_proportional_millionths[edge] = min(policy.fee_proportional_millionths, INT64_MAX)
+            self.cltv_expiry_delta[edge] = policy.cltv_expiry_delta
+            self.htlc_minimum_msat[edge] = min(policy.htlc_minimum_msat, INT64_MAX)
+            htlc_maximum_msat = policy.htlc_maximum_msat
+            self.htlc_maximum_msat[edge] = min(htlc_maximum_msat, INT64_MAX) if htlc_maximum_msat is not None else -1
+
+    def channels_for_node(self, node: int) -> Iterator[int]:
+        """Yields the indices of the channels of node (a node index).
+        Callers should hold self.lock while iterating.
+        """
+        scids = self.scids
+        adj_start = self._adj_start
+        if node + 1 < len(adj_start):
+            adj_chans = self._adj_chans
+            for i in range(adj_start[node], adj_start[node + 1]):
+                chan = adj_chans[i]
+                if scids[chan] is not None:
+                    yield chan
+        for chan in self._added_adj.get(node, ()):
+            if scids[chan] is not None:
+                yield chan
+
+    def maybe_compact(self) -> None:
+        with self.lock:
+            num_changes = self._num_added + self._num_removed
+            if num_changes >= max(self.MIN_CHANGES_BEFORE_COMPACT, len(self.scids) // 10):
+                self.compact()
+
+    def compact(self) -> None:
+        """Drops removed channels, renumbers channels and
+        rebuilds the CSR adjacency from scratch.
+        """
+        with self.lock:
+            live = [chan for chan, scid in enumerate(self.scids) if scid is not None]
+            old = (self.scids, self.node_ids, self.node1, self.node2, self.capacity_sat,
+                   self.has_policy, self.disabled, self.fee_base_msat, self.fee_proportional_millionths,
+                   self.cltv_expiry_delta, self.htlc_minimum_msat, self.htlc_maximum_msat)
+            (scids, node_ids, node1, node2, capacity_sat, has_policy, disabled, fee_base_msat,
+             fee_proportional_millionths, cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat) = old
+            self._clear()
+            # nodes without channels are dropped
+            new_node = {}  # type: Dict[int, int]
+            def renumber(node: int) -> int:
+                idx = new_node.get(node)
+                if idx is None:
+                    idx = new_node[node] = self._add_node(node_ids[node])
+                return idx
+            degree = []  # type: List[int]
+            for new_chan, chan in enumerate(live):
+                scid = scids[chan]
+                n1 = renumber(node1[chan])
+                n2 = renumber(node2[chan])
+                self.scids.append(scid)
+                self._chan_idx[scid] = new_chan
+                self.node1.append(n1)
+                self.node2.append(n2)
+                self.capacity_sat.append(capacity_sat[chan])
+                for edge in (2 * chan, 2 * chan + 1):
+                    self.has_policy.append(has_policy[edge])
+                    self.disabled.append(disabled[edge])
+                    self.fee_base_msat.append(fee_base_msat[edge])
+                    self.fee_proportional_millionths.append(fee_proportional_millionths[edge])
+                    self.cltv_expiry_delta.append(cltv_expiry_delta[edge])
+                    self.htlc_minimum_msat.append(htlc_minimum_msat[edge])
+                    self.htlc_maximum_msat.append(htlc_maximum_msat[edge])
+                while len(degree) < len(self.node_ids):
+                    degree.append(0)
+                degree[n1] += 1
+                degree[n2] += 1
+            # CSR: prefix sums of the degrees, then fill in the slots
+            adj_start = array('i', [0]) * (len(self.node_ids) + 1)
+            for node, d in enumerate(degree):
+                adj_start[node + 1] = adj_start[node] + d
+            adj_chans = array('i', [0]) * adj_start[-1]
+            fill = array('i', adj_start[:-1])
+            for chan in range(len(self.scids)):
+                for node in (self.node1[chan], self.node2[chan]):
+                    adj_chans[fill[node]] = chan
+                    fill[node] += 1
+            self._adj_start = adj_start
+            self._adj_chans = adj_chans
+
+    def get_edge(self, chan: int, start_node: int) -> int:
+        return 2 * chan if self.node1[chan] == start_node else 2 * chan + 1
+
+    def other_node(self, chan: int, node: int) -> int:
+        n1 = self.node1[chan]
+        return self.node2[chan] if n1 == node else n1
+
@@ -282,7 +282,7 @@ class HTLCManager:
             ctn_idx = self.ctn_latest(REMOTE)
         else:
             ctn_idx = self.ctn_latest(REMOTE) + 1
-        l = self.log['unacked_local_updates2'].get(ctn_idx, [])
+        l = list(self.log['unacked_local_updates2'].get(ctn_idx, []))
         l.append(raw_update_msg.hex())
         self.log['unacked_local_updates2'][ctn_idx] = l
 
@@ -1,7 +1,8 @@
 import os
 import csv
 import io
-from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional
+import struct
+from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional, NamedTuple
 from collections import OrderedDict
 
 from .lnutil import OnionFailureCodeMetaFlag
@@ -17,21 +18,6 @@ class MsgInvalidFieldOrder(MalformedMsg): pass
 class UnexpectedFieldSizeForEncoder(MalformedMsg): pass
 
 
-def _num_remaining_bytes_to_read(fd: io.BytesIO) -> int:
-    cur_pos = fd.tell()
-    end_pos = fd.seek(0, io.SEEK_END)
-    fd.seek(cur_pos)
-    return end_pos - cur_pos
-
-
-def _assert_can_read_at_least_n_bytes(fd: io.BytesIO, n: int) -> None:
-    # note: it's faster to read n bytes and then check if we read n, than
-    #       to assert we can read at least n and then read n bytes.
-    nremaining = _num_remaining_bytes_to_read(fd)
-    if nremaining < n:
-        raise UnexpectedEndOfStream(f"wants to read {n} bytes but only {nremaining} bytes left")
-
-
 def write_bigsize_int(i: int) -> bytes:
     assert i >= 0, i
     if i < 0xfd:
@@ -78,196 +64,240 @@ def read_bigsize_int(fd: io.BytesIO) -> Optional[int]:
     raise Exception()
 
 
-# TODO: maybe if field_type is not "byte", we could return a list of type_len sized chunks?
-#       if field_type is a numeric, we could return a list of ints?
-def _read_field(*, fd: io.BytesIO, field_type: str, count: Union[int, str]) -> Union[bytes, int]:
-    if not fd: raise Exception()
-    if isinstance(count, int):
-        assert count >= 0, f"{count!r} must be non-neg int"
-    elif count == "...":
-        pass
-    else:
-        raise Exception(f"unexpected field count: {count!r}")
-    if count == 0:
-        return b""
-    type_len = None
-    if field_type == 'byte':
-        type_len = 1
-    elif field_type in ('u8', 'u16', 'u32', 'u64'):
-        if field_type == 'u8':
-            type_len = 1
-        elif field_type == 'u16':
-            type_len = 2
-        elif field_type == 'u32':
-            type_len = 4
-        else:
-            assert field_type == 'u64'
-            type_len = 8
-        assert count == 1, count
-        buf = fd.read(type_len)
-        if len(buf) != type_len:
-            raise UnexpectedEndOfStream()
-        return int.from_bytes(buf, byteorder="big", signed=False)
-    elif field_type in ('tu16', 'tu32', 'tu64'):
-        if field_type == 'tu16':
-            type_len = 2
-        elif field_type == 'tu32':
-            type_len = 4
-        else:
-            assert field_type == 'tu64'
-            type_len = 8
-        assert count == 1, count
-        raw = fd.read(type_len)
-        if len(raw) > 0 and raw[0] == 0x00:
-            raise FieldEncodingNotMinimal()
-        return int.from_bytes(raw, byteorder="big", signed=False)
-    elif field_type == 'varint':
-        assert count == 1, count
-        val = read_bigsize_int(fd)
-        if val is None:
-            raise UnexpectedEndOfStream()
-        return val
-    elif field_type == 'chain_hash':
-        type_len = 32
-    elif field_type == 'channel_id':
-        type_len = 32
-    elif field_type == 'sha256':
-        type_len = 32
-    elif field_type == 'signature':
-        type_len = 64
-    elif field_type == 'point':
-        type_len = 33
-    elif field_type == 'short_channel_id':
-        type_len = 8
-
-    if count == "...":
-        total_len = -1  # read all
+def _read_bigsize_int_at(data: bytes, offset: int) -> Tuple[Optional[int], int]:
+    """Like read_bigsize_int, but reads from data at offset.
+    Returns the value (None at end of data) and the offset after it.
+    """
+    try:
+        first = data[offset]
+    except IndexError:
+        return None, offset  # end of data
+    if first < 0xfd:
+        return first, offset + 1
+    if first == 0xfd:
+        size, min_val = 2, 0xfd
+    elif first == 0xfe:
+        size, min_val = 4, 0x1_0000
     else:
-        if type_len is None:
-            raise UnknownMsgFieldType(f"unknown field type: {field_type!r}")
-        total_len = count * type_len
-
-    buf = fd.read(total_len)
-    if total_len >= 0 and len(buf) != total_len:
+        size, min_val = 8, 0x1_0000_0000
+    end = offset + 1 + size
+    if end > len(data):
         raise UnexpectedEndOfStream()
-    return buf
+    val = int.from_bytes(data[offset+1:end], byteorder="big", signed=False)
+    if val < min_val:
+        raise FieldEncodingNotMinimal()
+    return val, end
+
+
+# sizes of the field types, per item
+_INT_TYPE_LEN = {'u8': 1, 'u16': 2, 'u32': 4, 'u64': 8}
+_TRUNCATED_INT_TYPE_LEN = {'tu16': 2, 'tu32': 4, 'tu64': 8}
+_BYTES_TYPE_LEN = {
+    'byte': 1,
+    'chain_hash': 32,
+    'channel_id': 32,
+    'sha256': 32,
+    'signature': 64,
+    'point': 33,
+    'short_channel_id': 8,
+}
+_STRUCT_INT_FORMAT = {'u8': 'B', 'u16': 'H', 'u32': 'I', 'u64': 'Q'}
+
+
+class _FieldScheme(NamedTuple):
+    name: str
+    type: str
+    count: Union[int, str]  # int, "...", or the name of the field holding the count
+    optional: bool  # optional feature field, which may be missing at the end of a message
+
+
+def _parse_field_count(field_count_str: str) -> Union[int, str]:
+    if field_count_str == "":
+        return 1
+    try:
+        field_count = int(field_count_str)
+    except ValueError:
+        return field_count_str  # "..." or name of a previous field
+    assert field_count >= 0, f"{field_count!r} must be non-neg int"
+    return field_count
 
 
-# TODO: maybe for "value" we could accept a list with len "count" of appropriate items
-def _write_field(*, fd: io.BytesIO, field_type: str, count: Union[int, str],
-                 value: Union[bytes, int]) -> None:
-    if not fd: raise Exception()
-    if isinstance(count, int):
-        assert count >= 0, f"{count!r} must be non-neg int"
-    elif count == "...":
-        pass
+def _resolve_field_count(field_count: Union[int, str], *, vars_dict: dict) -> int:
+    if isinstance(field_count, int):
+        return field_count
+    field_count = vars_dict[field_count]
+    if isinstance(field_count, (bytes, bytearray)):
+        field_count = int.from_bytes(field_count, byteorder="big")
+    assert isinstance(field_count, int)
+    return field_count
+
+
+# A field reader takes (data, offset, count) and returns (value, offset after the value).
+# A field writer takes (value, count) and returns the serialized value.
+# Both are specialized for a field type once, when the CSV is loaded.
+
+def _make_field_reader(field_type: str) -> Callable[[bytes, int, int], Tuple[Union[bytes, int], int]]:
+    if field_type in _INT_TYPE_LEN:
+        type_len = _INT_TYPE_LEN[field_type]
+        def read_field(data: bytes, offset: int, count: int):
+            assert count == 1, count
+            end = offset + type_len
+            if end > len(data):
+                raise UnexpectedEndOfStream()
+            return int.from_bytes(data[offset:end], byteorder="big", signed=False), end
+    elif field_type in _TRUNCATED_INT_TYPE_LEN:
+        type_len = _TRUNCATED_INT_TYPE_LEN[field_type]
+        def read_field(data: bytes, offset: int, count: int):
+            assert count == 1, count
+            raw = data[offset:offset+type_len]
+            if len(raw) > 0 and raw[0] == 0x00:
+                raise FieldEncodingNotMinimal()
+            return int.from_bytes(raw, byteorder="big", signed=False), offset + len(raw)
+    elif field_type == 'varint':
+        def read_field(data: bytes, offset: int, count: int):
+            assert count == 1, count
+            val, offset = _read_bigsize_int_at(data, offset)
+            if val is None:
+                raise UnexpectedEndOfStream()
+            return val, offset
+    elif field_type in _BYTES_TYPE_LEN:
+        type_len = _BYTES_TYPE_LEN[field_type]
+        def read_field(data: bytes, offset: int, count: int):
+            end = offset + count * type_len
+            if end > len(data):
+                raise UnexpectedEndOfStream()
+            return data[offset:end], end
     else:
-        raise Exception(f"unexpected field count: {count!r}")
-    if count == 0:
-        return
-    type_len = None
-    if field_type == 'byte':
-        type_len = 1
-    elif field_type == 'u8':
-        type_len = 1
-    elif field_type == 'u16':
-        type_len = 2
-    elif field_type == 'u32':
-        type_len = 4
-    elif field_type == 'u64':
-        type_len = 8
-    elif field_type in ('tu16', 'tu32', 'tu64'):
-        if field_type == 'tu16':
-            type_len = 2
-        elif field_type == 'tu32':
-            type_len = 4
-        else:
-            assert field_type == 'tu64'
-            type_len = 8
-        assert count == 1, count
-        if isinstance(value, int):
-            value = int.to_bytes(value, length=type_len, byteorder="big", signed=False)
-        if not isinstance(value, (bytes, bytearray)):
-            raise Exception(f"can only write bytes into fd. got: {value!r}")
-        while len(value) > 0 and value[0] == 0x00:
-            value = value[1:]
-        nbytes_written = fd.write(value)
-        if nbytes_written != len(value):
-            raise Exception(f"tried to write {len(value)} bytes, but only wrote {nbytes_written}!?")
-        return
+        def read_field(data: bytes, offset: int, count: int):
+            raise UnknownMsgFieldType(f"unknown field type: {field_type!r}")
+    return read_field
+
+
+def _make_field_writer(field_type: str) -> Callable[[Union[bytes, int], int], bytes]:
+    if field_type in _TRUNCATED_INT_TYPE_LEN:
+        type_len = _TRUNCATED_INT_TYPE_LEN[field_type]
+        def write_field(value, count: int):
+            assert count == 1, count
+            if isinstance(value, int):
+                value = int.to_bytes(value, length=type_len, byteorder="big", signed=False)
+            if not isinstance(value, (bytes, bytearray)):
+                raise Exception(f"can only write bytes into fd. got: {value!r}")
+            return value.lstrip(b"\x00")
     elif field_type == 'varint':
-        assert count == 1, count
-        if isinstance(value, int):
-            value = write_bigsize_int(value)
-        if not isinstance(value, (bytes, bytearray)):
-            raise Exception(f"can only write bytes into fd. got: {value!r}")
-        nbytes_written = fd.write(value)
-        if nbytes_written != len(value):
-            raise Exception(f"tried to write {len(value)} bytes, but only wrote {nbytes_written}!?")
-        return
-    elif field_type == 'chain_hash':
-        type_len = 32
-    elif field_type == 'channel_id':
-        type_len = 32
-    elif field_type == 'sha256':
-        type_len = 32
-    elif field_type == 'signature':
-        type_len = 64
-    elif field_type == 'point':
-        type_len = 33
-    elif field_type == 'short_channel_id':
-        type_len = 8
-    total_len = -1
-    if count != "...":
-        if type_len is None:
+        def write_field(value, count: int):
+            assert count == 1, count
+            if isinstance(value, int):
+                value = write_bigsize_int(value)
+            if not isinstance(value, (bytes, bytearray)):
+                raise Exception(f"can only write bytes into fd. got: {value!r}")
+            return value
+    elif field_type in _INT_TYPE_LEN or field_type in _BYTES_TYPE_LEN:
+        type_len = _INT_TYPE_LEN.get(field_type) or _BYTES_TYPE_LEN[field_type]
+        is_byte = field_type == 'byte'
+        def write_field(value, count: int):
+            total_len = count * type_len
+            if isinstance(value, int) and (count == 1 or is_byte):
+                value = int.to_bytes(value, length=total_len, byteorder="big", signed=False)
+            if not isinstance(value, (bytes, bytearray)):
+                raise Exception(f"can only write bytes into fd. got: {value!r}")
+            if total_len != len(value):
+                raise UnexpectedFieldSizeForEncoder(f"expected: {total_len}, got {len(value)}")
+            return value
+    else:
+        def write_field(value, count: int):
             raise UnknownMsgFieldType(f"unknown field type: {field_type!r}")
-        total_len = count * type_len
-        if isinstance(value, int) and (count == 1 or field_type == 'byte'):
-            value = int.to_bytes(value, length=total_len, byteorder="big", signed=False)
+    return write_field
+
+
+def _write_any_length_field(value, count) -> bytes:
     if not isinstance(value, (bytes, bytearray)):
         raise Exception(f"can only write bytes into fd. got: {value!r}")
-    if count != "..." and total_len != len(value):
-        raise UnexpectedFieldSizeForEncoder(f"expected: {total_len}, got {len(value)}")
-    nbytes_written = fd.write(value)
-    if nbytes_written != len(value):
-        raise Exception(f"tried to write {len(value)} bytes, but only wrote {nbytes_written}!?")
+    return value
 
 
-def _read_tlv_record(*, fd: io.BytesIO) -> Tuple[int, bytes]:
-    if not fd: raise Exception()
-    tlv_type = _read_field(fd=fd, field_type="varint", count=1)
-    tlv_len = _read_field(fd=fd, field_type="varint", count=1)
-    tlv_val = _read_field(fd=fd, field_type="byte", count=tlv_len)
-    return tlv_type, tlv_val
+def _is_fixed_size(field: _FieldScheme) -> bool:
+    if field.optional or not isinstance(field.count, int):
+        return False
+    if field.count == 0:
+        return True
+    return field.type in _BYTES_TYPE_LEN or (field.type in _INT_TYPE_LEN and field.count == 1)
 
 
-def _write_tlv_record(*, fd: io.BytesIO, tlv_type: int, tlv_val: bytes) -> None:
-    if not fd: raise Exception()
-    tlv_len = len(tlv_val)
-    _write_field(fd=fd, field_type="varint", count=1, value=tlv_type)
-    _write_field(fd=fd, field_type="varint", count=1, value=tlv_len)
-    _write_field(fd=fd, field_type="byte", count=tlv_len, value=tlv_val)
+def _compile_fixed_size_reader(fields: Sequence[_FieldScheme]):
+    """Reads consecutive fixed-size fields with a single struct."""
+    fmt = ">"
+    for field in fields:
+        if field.type in _INT_TYPE_LEN and field.count == 1:
+            fmt += _STRUCT_INT_FORMAT[field.type]
+        else:
+            fmt += f"{field.count * _BYTES_TYPE_LEN.get(field.type, 0)}s"
+    layout = struct.Struct(fmt)
+    size = layout.size
+    unpack_from = layout.unpack_from
+    names = [field.name for field in fields]
+    def read_fields(data: bytes, offset: int, parsed: dict) -> int:
+        end = offset + size
+        if end > len(data):
+            raise UnexpectedEndOfStream()
+        parsed.update(zip(names, unpack_from(data, offset)))
+        return end
+    return read_fields
 
 
-def _resolve_field_count(field_count_str: str, *, vars_dict: dict, allow_any=False) -> Union[int, str]:
-    """Returns an evaluated field count, typically an int.
-    If allow_any is True, the return value can be a str with value=="...".
-    """
-    if field_count_str == "":
-        field_count = 1
-    elif field_count_str == "...":
+def _compile_reader(field: _FieldScheme, *, allow_any: bool):
+    name = field.name
+    field_count = field.count
+    if field_count == "...":
         if not allow_any:
-            raise Exception("field count is '...' but allow_any is False")
-        return field_count_str
+            def read_any(data: bytes, offset: int, parsed: dict) -> int:
+                raise Exception("field count is '...' but allow_any is False")
+            return read_any
+        assert field.type not in _TRUNCATED_INT_TYPE_LEN and field.type != 'varint', field
+        def read_all(data: bytes, offset: int, parsed: dict) -> int:
+            parsed[name] = data[offset:]
+            return len(data)
+        return read_all
+    read_field = _make_field_reader(field.type)
+    def read(data: bytes, offset: int, parsed: dict) -> Optional[int]:
+        count = _resolve_field_count(field_count, vars_dict=parsed)
+        if count == 0:
+            parsed[name] = b""
+            return offset
+        parsed[name], offset = read_field(data, offset, count)
+        return offset
+    if not field.optional:
+        return read
+    def read_optional(data: bytes, offset: int, parsed: dict) -> Optional[int]:
+        try:
+            return read(data, offset, parsed)
+        except UnexpectedEndOfStream:
+            return None  # optional feature field not present
+    return read_optional
+
+
+def _compile_writer(field: _FieldScheme, *, default_to_zero: bool):
+    name = field.name
+    field_count = field.count
+    optional = field.optional
+    if field_count == "...":
+        assert field.type not in _TRUNCATED_INT_TYPE_LEN and field.type != 'varint', field
+        write_field = _write_any_length_field
     else:
+        write_field = _make_field_writer(field.type)
+    def write(parts: list, values: dict) -> bool:
+        count = field_count if field_count == "..." else _resolve_field_count(field_count, vars_dict=values)
         try:
-            field_count = int(field_count_str)
-        except ValueError:
-            field_count = vars_dict[field_count_str]
-            if isinstance(field_count, (bytes, bytearray)):
-                field_count = int.from_bytes(field_count, byteorder="big")
-    assert isinstance(field_count, int)
-    return field_count
+            value = values[name]
+        except KeyError:
+            if not default_to_zero:
+                raise
+            if optional:
+                return False  # optional feature field not present
+            value = 0  # default mandatory fields to zero
+        if count != 0:
+            parts.append(write_field(value, count))
+        return True
+    return write
 
 
 def _parse_msgtype_intvalue_for_onion_wire(value: str) -> int:
@@ -281,6 +311,12 @@ def _parse_msgtype_intvalue_for_onion_wire(value: str) -> int:
 
 
 class LNSerializer:
+    """Encodes and decodes the messages and TLV streams described in a CSV file.
+
+    Each message and TLV record scheme is compiled once, when the CSV is loaded,
+    into a list of field readers and writers. Runs of consecutive fixed-size
+    fields are read with a single struct.Struct.
+    """
 
     def __init__(self, *, for_onion_wire: bool = False):
         # TODO msg_type could be 'int' everywhere...
@@ -343,47 +379,105 @@ class LNSerializer:
                 else:
                     pass  # TODO
 
-    def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
-        scheme_map = self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name]
-        for tlv_record_type, scheme in scheme_map.items():  # note: tlv_record_type is monotonically increasing
-            tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
-            if tlv_record_name not in kwargs:
+        self._compile()
+
+    def _compile(self) -> None:
+        self._msg_readers = {}  # type: Dict[bytes, Tuple[str, List[Callable]]]
+        self._msg_writers = {}  # type: Dict[str, Tuple[bytes, List[Callable]]]
+        for msg_type_bytes, scheme in self.msg_scheme_from_type.items():
+            # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+            fields = [_FieldScheme(name=row[2], type=row[3], count=_parse_field_count(row[4]), optional=len(row) > 5)
+                      for row in scheme[1:]]
+            msg_type_name = scheme[0][1]
+            self._msg_readers[msg_type_bytes] = msg_type_name, self._compile_readers(fields, allow_any=False)
+            self._msg_writers[msg_type_name] = msg_type_bytes, self._compile_writers(fields, default_to_zero=True)
+        self._tlv_record_readers = {}  # type: Dict[str, Dict[int, Tuple[str, List[Callable]]]]
+        self._tlv_record_writers = {}  # type: Dict[str, List[Tuple[int, str, List[Callable]]]]
+        for tlv_stream_name, scheme_map in self.in_tlv_stream_get_tlv_record_scheme_from_type.items():
+            self._tlv_record_readers[tlv_stream_name] = {}
+            self._tlv_record_writers[tlv_stream_name] = []
+            for tlv_record_type, scheme in scheme_map.items():  # note: tlv_record_type is monotonically increasing
+                # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
+                fields = [_FieldScheme(name=row[3], type=row[4], count=_parse_field_count(row[5]), optional=False)
+                          for row in scheme[1:]]
+                tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
+                self._tlv_record_readers[tlv_stream_name][tlv_record_type] = (
+                    tlv_record_name, self._compile_readers(fields, allow_any=True))
+                self._tlv_record_writers[tlv_stream_name].append(
+                    (tlv_record_type, tlv_record_name, self._compile_writers(fields, default_to_zero=False)))
+
+    def _compile_readers(self, fields: Sequence[_FieldScheme], *, allow_any: bool) -> List[Callable]:
+        readers = []
+        fixed_size_fields = []
+        for field in fields:
+            if _is_fixed_size(field):
+                fixed_size_fields.append(field)
                 continue
-            with io.BytesIO() as tlv_record_fd:
-                for row in scheme:
-                    if row[0] == "tlvtype":
-                        pass
-                    elif row[0] == "tlvdata":
-                        # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
-                        assert tlv_stream_name == row[1]
-                        assert tlv_record_name == row[2]
-                        field_name = row[3]
-                        field_type = row[4]
-                        field_count_str = row[5]
-                        field_count = _resolve_field_count(field_count_str,
-                                                           vars_dict=kwargs[tlv_record_name],
-                                                           allow_any=True)
-                        field_value = kwargs[tlv_record_name][field_name]
-                        _write_field(fd=tlv_record_fd,
-                                     field_type=field_type,
-                                     count=field_count,
-                                     value=field_value)
-                    else:
-                        raise Exception(f"unexpected row in scheme: {row!r}")
-                _write_tlv_record(fd=fd, tlv_type=tlv_record_type, tlv_val=tlv_record_fd.getvalue())
-
-    def read_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+            if fixed_size_fields:
+                readers.append(_compile_fixed_size_reader(fixed_size_fields))
+                fixed_size_fields = []
+            if field.name == "tlvs":
+                readers.append(self._compile_tlv_stream_reader(tlv_stream_name=field.type))
+            else:
+                readers.append(_compile_reader(field, allow_any=allow_any))
+        if fixed_size_fields:
+            readers.append(_compile_fixed_size_reader(fixed_size_fields))
+        return readers
+
+    def _compile_writers(self, fields: Sequence[_FieldScheme], *, default_to_zero: bool) -> List[Callable]:
+        writers = []
+        for field in fields:
+            if field.name == "tlvs":
+                writers.append(self._compile_tlv_stream_writer(tlv_stream_name=field.type))
+            else:
+                writers.append(_compile_writer(field, default_to_zero=default_to_zero))
+        return writers
+
+    def _compile_tlv_stream_reader(self, *, tlv_stream_name: str):
+        def read_tlv_stream(data: bytes, offset: int, parsed: dict) -> int:
+            parsed[tlv_stream_name] = self._read_tlv_stream(data, offset, tlv_stream_name=tlv_stream_name)
+            return len(data)
+        return read_tlv_stream
+
+    def _compile_tlv_stream_writer(self, *, tlv_stream_name: str):
+        def write_tlv_stream(parts: list, values: dict) -> bool:
+            if tlv_stream_name in values:
+                parts.append(self._write_tlv_stream(tlv_stream_name=tlv_stream_name, values=values[tlv_stream_name]))
+            return True
+        return write_tlv_stream
+
+    def _write_tlv_stream(self, *, tlv_stream_name: str, values: dict) -> bytes:
+        parts = []
+        for tlv_record_type, tlv_record_name, writers in self._tlv_record_writers[tlv_stream_name]:
+            if tlv_record_name not in values:
+                continue
+            tlv_record_parts = []
+            for write in writers:
+                write(tlv_record_parts, values[tlv_record_name])
+            tlv_val = b"".join(tlv_record_parts)
+            parts += [write_bigsize_int(tlv_record_type), write_bigsize_int(len(tlv_val)), tlv_val]
+        return b"".join(parts)
+
+    def _read_tlv_stream(self, data: bytes, offset: int, *, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
         parsed = {}  # type: Dict[str, Dict[str, Any]]
-        scheme_map = self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name]
+        record_readers = self._tlv_record_readers[tlv_stream_name]
         last_seen_tlv_record_type = -1  # type: int
-        while _num_remaining_bytes_to_read(fd) > 0:
-            tlv_record_type, tlv_record_val = _read_tlv_record(fd=fd)
+        while offset < len(data):
+            tlv_record_type, offset = _read_bigsize_int_at(data, offset)
+            tlv_len, offset = _read_bigsize_int_at(data, offset)
+            if tlv_len is None:
+                raise UnexpectedEndOfStream()
+            end = offset + tlv_len
+            if end > len(data):
+                raise UnexpectedEndOfStream()
+            tlv_record_val = data[offset:end]
+            offset = end
             if not (tlv_record_type > last_seen_tlv_record_type):
                 raise MsgInvalidFieldOrder(f"TLV records must be monotonically increasing by type. "
                                            f"cur: {tlv_record_type}. prev: {last_seen_tlv_record_type}")
             last_seen_tlv_record_type = tlv_record_type
             try:
-                scheme = scheme_map[tlv_record_type]
+                tlv_record_name, readers = record_readers[tlv_record_type]
             except KeyError:
                 if tlv_record_type % 2 == 0:
                     # unknown "even" type: hard fail
@@ -391,74 +485,31 @@ class LNSerializer:
                 else:
                     # unknown "odd" type: skip it
                     continue
-            tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
-            parsed[tlv_record_name] = {}
-            with io.BytesIO(tlv_record_val) as tlv_record_fd:
-                for row in scheme:
-                    #print(f"row: {row!r}")
-                    if row[0] == "tlvtype":
-                        pass
-                    elif row[0] == "tlvdata":
-                        # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
-                        assert tlv_stream_name == row[1]
-                        assert tlv_record_name == row[2]
-                        field_name = row[3]
-                        field_type = row[4]
-                        field_count_str = row[5]
-                        field_count = _resolve_field_count(field_count_str,
-                                                           vars_dict=parsed[tlv_record_name],
-                                                           allow_any=True)
-                        #print(f">> count={field_count}. parsed={parsed}")
-                        parsed[tlv_record_name][field_name] = _read_field(fd=tlv_record_fd,
-                                                                          field_type=field_type,
-                                                                          count=field_count)
-                    else:
-                        raise Exception(f"unexpected row in scheme: {row!r}")
-                if _num_remaining_bytes_to_read(tlv_record_fd) > 0:
-                    raise MsgTrailingGarbage(f"TLV record ({tlv_stream_name}/{tlv_record_name}) has extra trailing garbage")
+            parsed[tlv_record_name] = record = {}
+            pos = 0
+            for read in readers:
+                pos = read(tlv_record_val, pos, record)
+            if pos < len(tlv_record_val):
+                raise MsgTrailingGarbage(f"TLV record ({tlv_stream_name}/{tlv_record_name}) has extra trailing garbage")
         return parsed
 
+    def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
+        fd.write(self._write_tlv_stream(tlv_stream_name=tlv_stream_name, values=kwargs))
+
+    def read_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+        return self._read_tlv_stream(fd.read(), 0, tlv_stream_name=tlv_stream_name)
+
     def encode_msg(self, msg_type: str, **kwargs) -> bytes:
         """
         Encode kwargs into a Lightning message (bytes)
         of the type given in the msg_type string
         """
-        #print(f">>> encode_msg. msg_type={msg_type}, payload={kwargs!r}")
-        msg_type_bytes = self.msg_type_from_name[msg_type]
-        scheme = self.msg_scheme_from_type[msg_type_bytes]
-        with io.BytesIO() as fd:
-            fd.write(msg_type_bytes)
-            for row in scheme:
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    #print(f">>> encode_msg. msgdata. field_name={field_name!r}. field_type={field_type!r}. field_count_str={field_count_str!r}")
-                    field_count = _resolve_field_count(field_count_str, vars_dict=kwargs)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        if tlv_stream_name in kwargs:
-                            self.write_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name, **(kwargs[tlv_stream_name]))
-                        continue
-                    try:
-                        field_value = kwargs[field_name]
-                    except KeyError:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            field_value = 0  # default mandatory fields to zero
-                    #print(f">>> encode_msg. writing field: {field_name}. value={field_value!r}. field_type={field_type!r}. count={field_count!r}")
-                    _write_field(fd=fd,
-                                 field_type=field_type,
-                                 count=field_count,
-                                 value=field_value)
-                    #print(f">>> encode_msg. so far: {fd.getvalue().hex()}")
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
-            return fd.getvalue()
+        msg_type_bytes, writers = self._msg_writers[msg_type]
+        parts = [msg_type_bytes]
+        for write in writers:
+            if not write(parts, kwargs):
+                break
+        return b"".join(parts)
 
     def decode_msg(self, data: bytes) -> Tuple[str, dict]:
         """
@@ -467,41 +518,15 @@ class LNSerializer:
 
         Returns message type string and parsed message contents dict
         """
-        #print(f"decode_msg >>> {data.hex()}")
         assert len(data) >= 2
-        msg_type_bytes = data[:2]
-        msg_type_int = int.from_bytes(msg_type_bytes, byteorder="big", signed=False)
-        scheme = self.msg_scheme_from_type[msg_type_bytes]
-        assert scheme[0][2] == msg_type_int
-        msg_type_name = scheme[0][1]
+        data = bytes(data)
+        msg_type_name, readers = self._msg_readers[data[:2]]
         parsed = {}
-        with io.BytesIO(data[2:]) as fd:
-            for row in scheme:
-                #print(f"row: {row!r}")
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    field_count = _resolve_field_count(field_count_str, vars_dict=parsed)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        d = self.read_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name)
-                        parsed[tlv_stream_name] = d
-                        continue
-                    #print(f">> count={field_count}. parsed={parsed}")
-                    try:
-                        parsed[field_name] = _read_field(fd=fd,
-                                                         field_type=field_type,
-                                                         count=field_count)
-                    except UnexpectedEndOfStream as e:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            raise
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
+        offset = 2
+        for read in readers:
+            offset = read(data, offset, parsed)
+            if offset is None:
+                break  # optional feature field not present
         return msg_type_name, parsed
 
 
@@ -48,6 +48,7 @@ from .lnutil import (Outpoint, LocalConfig, RECEIVED, UpdateAddHtlc,
 from .lnutil import FeeUpdate, channel_id_from_funding_tx
 from .lntransport import LNTransport, LNTransportBase
 from .lnmsg import encode_msg, decode_msg
+from .lngossip_pipeline import get_gossip_msg_type
 from .interface import GracefulDisconnect, NetworkException
 from .lnrouter import fee_for_edge_msat
 from .lnutil import ln_dummy_address
@@ -120,7 +121,7 @@ class Peer(Logger):
         chan.hm.store_local_update_raw_msg(raw_msg, is_commitment_signed=is_commitment_signed)
         if is_commitment_signed:
             # saving now, to ensure replaying updates works (in case of channel reestablishment)
-            self.lnworker.save_channel(chan)
+            self.lnworker.save_channel(chan, flush=True)
 
     def maybe_set_initialized(self):
         if self.initialized.done():
@@ -168,10 +169,16 @@ class Peer(Logger):
             self.ping_time = time.time()
 
     def process_message(self, message):
-        message_type, payload = decode_msg(message)
         # only process INIT if we are a backup
         from .lnworker import LNBackups
-        if isinstance(self.lnworker, LNBackups) and message_type != 'init':
+        is_backup = isinstance(self.lnworker, LNBackups)
+        gossip_msg_type = get_gossip_msg_type(message)
+        if gossip_msg_type is not None:
+            if not is_backup:
+                self.on_gossip_message(gossip_msg_type, message)
+            return
+        message_type, payload = decode_msg(message)
+        if is_backup and message_type != 'init':
             return
         if message_type in self.ordered_messages:
             chan_id = payload.get('channel_id') or payload["temporary_channel_id"]
@@ -189,9 +196,6 @@ class Peer(Logger):
             except AttributeError:
                 #self.logger.info("Received '%s'" % message_type.upper(), payload)
                 return
-            # raw message is needed to check signature
-            if message_type in ['node_announcement', 'channel_announcement', 'channel_update']:
-                payload['raw'] = message
             execution_result = f(*args)
             if asyncio.iscoroutinefunction(f):
                 asyncio.ensure_future(execution_result)
@@ -246,15 +250,16 @@ class Peer(Logger):
         self._received_init = True
         self.maybe_set_initialized()
 
-    def on_node_announcement(self, payload):
-        self.gossip_queue.put_nowait(('node_announcement', payload))
-
-    def on_channel_announcement(self, payload):
-        self.gossip_queue.put_nowait(('channel_announcement', payload))
-
-    def on_channel_update(self, payload):
-        self.maybe_save_remote_update(payload)
-        self.gossip_queue.put_nowait(('channel_update', payload))
+    def on_gossip_message(self, message_type: str, message: bytes):
+        # gossip is decoded and verified in batches by process_gossip,
+        # except updates for our own channels, which we need right away
+        if message_type == 'channel_update':
+            short_channel_id = message[2+64+32:2+64+32+8]
+            if any(chan.short_channel_id == short_channel_id for chan in self.channels.values()):
+                message_type, payload = decode_msg(message)
+                payload['raw'] = message  # raw message is what we store
+                self.maybe_save_remote_update(payload)
+        self.gossip_queue.put_nowait(message)
 
     def maybe_save_remote_update(self, payload):
         for chan in self.channels.values():
@@ -296,31 +301,27 @@ class Peer(Logger):
         # verify in peer's TaskGroup so that we fail the connection
         while True:
             await asyncio.sleep(5)
-            chan_anns = []
-            chan_upds = []
-            node_anns = []
+            msgs = []
             while True:
-                name, payload = await self.gossip_queue.get()
-                if name == 'channel_announcement':
-                    chan_anns.append(payload)
-                elif name == 'channel_update':
-                    chan_upds.append(payload)
-                elif name == 'node_announcement':
-                    node_anns.append(payload)
-                else:
-                    raise Exception('unknown message')
+                msgs.append(await self.gossip_queue.get())
                 if self.gossip_queue.empty():
                     break
+            # decoding and signature checks happen off the event loop
+            batch = await self.network.gossip_pipeline.process(msgs)
+            if batch.num_invalid:
+                raise Exception(f'{batch.num_invalid} invalid gossip messages')
+            chan_anns, node_anns, chan_upds = batch.chan_anns, batch.node_anns, batch.chan_upds
             self.logger.debug(f'process_gossip {len(chan_anns)} {len(node_anns)} {len(chan_upds)}')
-            # note: data processed in chunks to avoid taking sql lock for too long
+            # note: data processed in chunks to avoid taking sql lock for too long,
+            #       and we yield to the event loop between chunks
             # channel announcements
             for chan_anns_chunk in chunks(chan_anns, 300):
-                self.verify_channel_announcements(chan_anns_chunk)
                 self.channel_db.add_channel_announcement(chan_anns_chunk)
+                await asyncio.sleep(0)
             # node announcements
             for node_anns_chunk in chunks(node_anns, 100):
-                self.verify_node_announcements(node_anns_chunk)
                 self.channel_db.add_node_announcement(node_anns_chunk)
+                await asyncio.sleep(0)
             # channel updates
             for chan_upds_chunk in chunks(chan_upds, 1000):
                 categorized_chan_upds = self.channel_db.add_channel_updates(
@@ -340,23 +341,7 @@ class Peer(Logger):
                             self.orphan_channel_updates.popitem(last=False)
                 if categorized_chan_upds.good:
                     self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
-
-    def verify_channel_announcements(self, chan_anns):
-        for payload in chan_anns:
-            h = sha256d(payload['raw'][2+256:])
-            pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
-            sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
-            for pubkey, sig in zip(pubkeys, sigs):
-                if not ecc.verify_signature(pubkey, sig, h):
-                    raise Exception('signature failed')
-
-    def verify_node_announcements(self, node_anns):
-        for payload in node_anns:
-            pubkey = payload['node_id']
-            signature = payload['signature']
-            h = sha256d(payload['raw'][66:])
-            if not ecc.verify_signature(pubkey, signature, h):
-                raise Exception('signature failed')
+                await asyncio.sleep(0)
 
     async def query_gossip(self):
         try:
@@ -934,7 +919,7 @@ class Peer(Logger):
                                 f"remote is ahead of us! They should force-close. Remote PCP: {bh2u(their_local_pcp)}")
             # data_loss_protect_remote_pcp is used in lnsweep
             chan.set_data_loss_protect_remote_pcp(their_next_local_ctn - 1, their_local_pcp)
-            self.lnworker.save_channel(chan)
+            self.lnworker.save_channel(chan, flush=True)
             chan.peer_state = PeerState.BAD
             return
         elif we_are_ahead:
@@ -1121,7 +1106,8 @@ class Peer(Logger):
     def send_revoke_and_ack(self, chan: Channel):
         self.logger.info(f'send_revoke_and_ack. chan {chan.short_channel_id}. ctn: {chan.get_oldest_unrevoked_ctn(LOCAL)}')
         rev = chan.revoke_current_commitment()
-        self.lnworker.save_channel(chan)
+        # the new state must be on disk before we reveal the old secret
+        self.lnworker.save_channel(chan, flush=True)
         self.send_message("revoke_and_ack",
             channel_id=chan.channel_id,
             per_commitment_secret=rev.per_commitment_secret,
@@ -1361,7 +1347,8 @@ class Peer(Logger):
         self.logger.info(f'on_revoke_and_ack. chan {chan.short_channel_id}. ctn: {chan.get_oldest_unrevoked_ctn(REMOTE)}')
         rev = RevokeAndAck(payload["per_commitment_secret"], payload["next_per_commitment_point"])
         chan.receive_revocation(rev)
-        self.lnworker.save_channel(chan)
+        # we need their secret to punish them if they broadcast the revoked state
+        self.lnworker.save_channel(chan, flush=True)
         self.maybe_send_commitment(chan)
 
     def on_update_fee(self, chan: Channel, payload):
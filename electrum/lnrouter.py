@@ -23,9 +23,10 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import queue
-from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+import heapq
+import threading
+from collections import defaultdict, OrderedDict
+from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Hashable, Any, Iterable
 import time
 import attr
 
@@ -34,6 +35,7 @@ from .logging import Logger
 from .lnutil import (NUM_MAX_EDGES_IN_PAYMENT_PATH, ShortChannelID, LnFeatures,
                      NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE)
 from .channel_db import ChannelDB, Policy, NodeInfo
+from .lngraph import CompactChannelGraph
 
 if TYPE_CHECKING:
     from .lnchannel import Channel
@@ -135,25 +137,168 @@ def is_fee_sane(fee_msat: int, *, payment_amount_msat: int) -> bool:
     return False
 
 
+def edge_cost_for_amount(payment_amt_msat: int, *, fee_base_msat: int, fee_proportional_millionths: int,
+                         cltv_expiry_delta: int, htlc_minimum_msat: int, htlc_maximum_msat: Optional[int],
+                         capacity_sat: Optional[int], ignore_costs=False) -> Tuple[float, int]:
+    """Heuristic cost (distance metric) of forwarding payment_amt_msat over a
+    channel with the given policy. Returns (heuristic_cost, fee_for_edge_msat).
+    Whether the policy exists and is enabled is for the caller to check.
+    """
+    if payment_amt_msat < htlc_minimum_msat:
+        return float('inf'), 0  # payment amount too little
+    if capacity_sat is not None and payment_amt_msat // 1000 > capacity_sat:
+        return float('inf'), 0  # payment amount too large
+    if htlc_maximum_msat is not None and payment_amt_msat > htlc_maximum_msat:
+        return float('inf'), 0  # payment amount too large
+    # same checks as RouteEdge.is_sane_to_use, without creating the RouteEdge
+    if cltv_expiry_delta > 14 * 144:
+        return float('inf'), 0
+    fee_msat = fee_for_edge_msat(payment_amt_msat, fee_base_msat, fee_proportional_millionths)
+    if not is_fee_sane(fee_msat, payment_amount_msat=payment_amt_msat):
+        return float('inf'), 0  # thanks but no thanks
+
+    # Distance metric notes:  # TODO constants are ad-hoc
+    # ( somewhat based on https://github.com/lightningnetwork/lnd/pull/1358 )
+    # - Edges have a base cost. (more edges -> less likely none will fail)
+    # - The larger the payment amount, and the longer the CLTV,
+    #   the more irritating it is if the HTLC gets stuck.
+    # - Paying lower fees is better. :)
+    base_cost = 500  # one more edge ~ paying 500 msat more fees
+    if ignore_costs:
+        return base_cost, 0
+    cltv_cost = cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
+    overall_cost = base_cost + fee_msat + cltv_cost
+    return overall_cost, fee_msat
+
+
+class RouteCache:
+    """LRU cache of the paths found by LNPathFinder.find_path_for_payment.
+
+    An entry is dropped as soon as one of the channels on its path changes
+    (see invalidate_channel). New channels do not invalidate anything, so
+    entries also expire after MAX_AGE, to let better paths be found.
+    Only successful searches are cached.
+    """
+
+    MAX_SIZE = 1000
+    MAX_AGE = 600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._paths = OrderedDict()  # type: Dict[Hashable, Tuple[LNPaymentPath, float]]  # key -> (path, timestamp)
+        self._keys_for_channel = defaultdict(set)  # type: Dict[ShortChannelID, Set[Hashable]]
+        # incremented on every invalidation, so that paths found
+        # concurrently with an invalidation are not put in the cache
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[LNPaymentPath]:
+        with self.lock:
+            item = self._paths.get(key)
+            if item is not None and time.time() - item[1] > self.MAX_AGE:
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._paths.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, path: LNPaymentPath, generation: int) -> None:
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._remove(key)
+            self._paths[key] = (path, time.time())
+            for edge in path:
+                self._keys_for_channel[edge.short_channel_id].add(key)
+            while len(self._paths) > self.MAX_SIZE:
+                self._remove(next(iter(self._paths)))
+
+    def discard(self, key: Hashable) -> None:
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: Hashable) -> None:
+        item = self._paths.pop(key, None)
+        if item is None:
+            return
+        for edge in item[0]:
+            keys = self._keys_for_channel.get(edge.short_channel_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_for_channel[edge.short_channel_id]
+
+    def invalidate_channel(self, short_channel_id: ShortChannelID) -> None:
+        with self.lock:
+            self.generation += 1
+            for key in list(self._keys_for_channel.get(short_channel_id, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self._paths.clear()
+            self._keys_for_channel.clear()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self._paths),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
 BLACKLIST_DURATION = 3600
 
+def _backtrack_labels(prev_node: dict, end_label) -> Iterable[tuple]:
+    """Yields the (node, edge) pairs of the path ending at end_label,
+    in a search over (node, num_hops) labels.
+    """
+    while end_label in prev_node:
+        edge, next_label = prev_node[end_label]
+        yield end_label[0], edge
+        end_label = next_label
+
+
 class LNPathFinder(Logger):
 
     def __init__(self, channel_db: ChannelDB):
         Logger.__init__(self)
         self.channel_db = channel_db
         self.blacklist = dict() # short_chan_id -> timestamp
+        self.route_cache = RouteCache()
+        channel_db.register_channel_changed_callback(self.route_cache.invalidate_channel)
 
     def add_to_blacklist(self, short_channel_id: ShortChannelID):
         self.logger.info(f'blacklisting channel {short_channel_id}')
         now = int(time.time())
         self.blacklist[short_channel_id] = now
+        self.route_cache.invalidate_channel(short_channel_id)
 
     def is_blacklisted(self, short_channel_id: ShortChannelID) -> bool:
         now = int(time.time())
         t = self.blacklist.get(short_channel_id, 0)
         return now - t < BLACKLIST_DURATION
 
+    def get_blacklisted_channels(self) -> Set[ShortChannelID]:
+        now = int(time.time())
+        return set(scid for scid, t in list(self.blacklist.items()) if now - t < BLACKLIST_DURATION)
+
+    def get_graph_completeness(self) -> float:
+        """Returns the fraction of the channel graph that paths are searched in.
+        Below 1, the channel db is still loading: paths can be found, but
+        may not be the cheapest, and some destinations may not be reachable yet.
+        """
+        return self.channel_db.get_load_progress()
+
     def _edge_cost(self, short_channel_id: bytes, start_node: bytes, end_node: bytes,
                    payment_amt_msat: int, ignore_costs=False, is_mine=False, *,
                    my_channels: Dict[ShortChannelID, 'Channel'] = None) -> Tuple[float, int]:
@@ -172,64 +317,92 @@ class LNPathFinder(Logger):
             return float('inf'), 0
         if channel_policy.is_disabled():
             return float('inf'), 0
-        if payment_amt_msat < channel_policy.htlc_minimum_msat:
-            return float('inf'), 0  # payment amount too little
-        if channel_info.capacity_sat is not None and \
-                payment_amt_msat // 1000 > channel_info.capacity_sat:
-            return float('inf'), 0  # payment amount too large
-        if channel_policy.htlc_maximum_msat is not None and \
-                payment_amt_msat > channel_policy.htlc_maximum_msat:
-            return float('inf'), 0  # payment amount too large
-        node_info = self.channel_db.get_node_info_for_node_id(node_id=end_node)
-        route_edge = RouteEdge.from_channel_policy(channel_policy, short_channel_id, end_node,
-                                                   node_info=node_info)
-        if not route_edge.is_sane_to_use(payment_amt_msat):
-            return float('inf'), 0  # thanks but no thanks
-
-        # Distance metric notes:  # TODO constants are ad-hoc
-        # ( somewhat based on https://github.com/lightningnetwork/lnd/pull/1358 )
-        # - Edges have a base cost. (more edges -> less likely none will fail)
-        # - The larger the payment amount, and the longer the CLTV,
-        #   the more irritating it is if the HTLC gets stuck.
-        # - Paying lower fees is better. :)
-        base_cost = 500  # one more edge ~ paying 500 msat more fees
-        if ignore_costs:
-            return base_cost, 0
-        fee_msat = route_edge.fee_for_edge(payment_amt_msat)
-        cltv_cost = route_edge.cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
-        overall_cost = base_cost + fee_msat + cltv_cost
-        return overall_cost, fee_msat
+        return edge_cost_for_amount(
+            payment_amt_msat,
+            fee_base_msat=channel_policy.fee_base_msat,
+            fee_proportional_millionths=channel_policy.fee_proportional_millionths,
+            cltv_expiry_delta=channel_policy.cltv_expiry_delta,
+            htlc_minimum_msat=channel_policy.htlc_minimum_msat,
+            htlc_maximum_msat=channel_policy.htlc_maximum_msat,
+            capacity_sat=channel_info.capacity_sat,
+            ignore_costs=ignore_costs)
+
+    def _graph_edge_cost(self, graph: CompactChannelGraph, chan: int, start_node: int,
+                         payment_amt_msat: int, ignore_costs=False) -> Tuple[float, int]:
+        """Same as _edge_cost, for a public channel of the compact graph."""
+        edge = graph.get_edge(chan, start_node)
+        # channels that did not publish both policies often return temporary channel failure
+        if not graph.has_policy[edge] or not graph.has_policy[edge ^ 1]:
+            return float('inf'), 0
+        if graph.disabled[edge]:
+            return float('inf'), 0
+        capacity_sat = graph.capacity_sat[chan]
+        htlc_maximum_msat = graph.htlc_maximum_msat[edge]
+        return edge_cost_for_amount(
+            payment_amt_msat,
+            fee_base_msat=graph.fee_base_msat[edge],
+            fee_proportional_millionths=graph.fee_proportional_millionths[edge],
+            cltv_expiry_delta=graph.cltv_expiry_delta[edge],
+            htlc_minimum_msat=graph.htlc_minimum_msat[edge],
+            htlc_maximum_msat=htlc_maximum_msat if htlc_maximum_msat >= 0 else None,
+            capacity_sat=capacity_sat if capacity_sat >= 0 else None,
+            ignore_costs=ignore_costs)
 
     def get_distances(self, nodeA: bytes, nodeB: bytes,
                       invoice_amount_msat: int, *,
-                      my_channels: Dict[ShortChannelID, 'Channel'] = None
+                      my_channels: Dict[ShortChannelID, 'Channel'] = None,
+                      max_hops: int = None
                       ) -> Dict[bytes, PathEdge]:
+        """Returns the edge to take from each node, towards nodeB.
+        If max_hops is set, the search is over (node, number of hops) pairs
+        instead, so that it finds the cheapest path with at most max_hops
+        edges; then, only the edges of that path are returned.
+        """
+        if my_channels is None:
+            my_channels = {}
+        if self.channel_db.graph is not None:
+            return self._get_distances_from_graph(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                                  max_hops=max_hops)
+        return self._get_distances_from_dicts(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                              max_hops=max_hops)
+
+    def _get_distances_from_dicts(self, nodeA: bytes, nodeB: bytes,
+                                  invoice_amount_msat: int, *,
+                                  my_channels: Dict[ShortChannelID, 'Channel'],
+                                  max_hops: Optional[int]
+                                  ) -> Dict[bytes, PathEdge]:
         # note: we don't lock self.channel_db, so while the path finding runs,
         #       the underlying graph could potentially change... (not good but maybe ~OK?)
 
         # run Dijkstra
         # The search is run in the REVERSE direction, from nodeB to nodeA,
         # to properly calculate compound routing fees.
-        distance_from_start = defaultdict(lambda: float('inf'))
-        distance_from_start[nodeB] = 0
-        prev_node = {}  # type: Dict[bytes, PathEdge]
-        nodes_to_explore = queue.PriorityQueue()
-        nodes_to_explore.put((0, invoice_amount_msat, nodeB))  # order of fields (in tuple) matters!
-
+        blacklist = self.get_blacklisted_channels()
+        inf = float('inf')
+        # search states are nodes, or (node, num_hops) pairs if max_hops is set
+        by_hops = max_hops is not None
+        distance_from_start = {(nodeB, 0) if by_hops else nodeB: 0}  # type: Dict[Any, float]
+        prev_node = {}  # type: Dict[Any, Tuple[PathEdge, Any]]
+        end_label = None
+        nodes_to_explore = [(0, invoice_amount_msat, nodeB, 0)]  # order of fields (in tuple) matters!
 
         # main loop of search
-        while nodes_to_explore.qsize() > 0:
-            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
+        while nodes_to_explore:
+            dist_to_edge_endnode, amount_msat, edge_endnode, num_hops = heapq.heappop(nodes_to_explore)
+            endnode_label = (edge_endnode, num_hops) if by_hops else edge_endnode
             if edge_endnode == nodeA:
+                end_label = endnode_label
                 break
-            if dist_to_edge_endnode != distance_from_start[edge_endnode]:
-                # queue.PriorityQueue does not implement decrease_priority,
+            if dist_to_edge_endnode != distance_from_start[endnode_label]:
+                # heapq does not implement decrease_priority,
                 # so instead of decreasing priorities, we add items again into the queue.
                 # so there are duplicates in the queue, that we discard now:
                 continue
+            if by_hops and num_hops >= max_hops:
+                continue
             for edge_channel_id in self.channel_db.get_channels_for_node(edge_endnode, my_channels=my_channels):
                 assert isinstance(edge_channel_id, bytes)
-                if self.is_blacklisted(edge_channel_id):
+                if edge_channel_id in blacklist:
                     continue
                 channel_info = self.channel_db.get_channel_info(edge_channel_id, my_channels=my_channels)
                 edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
@@ -250,35 +423,219 @@ class LNPathFinder(Logger):
                     ignore_costs=(edge_startnode == nodeA),
                     is_mine=is_mine,
                     my_channels=my_channels)
-                alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
-                if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
-                    distance_from_start[edge_startnode] = alt_dist_to_neighbour
-                    prev_node[edge_startnode] = PathEdge(node_id=edge_endnode,
-                                                         short_channel_id=ShortChannelID(edge_channel_id))
+                alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
+                startnode_label = (edge_startnode, num_hops + 1) if by_hops else edge_startnode
+                if alt_dist_to_neighbour < distance_from_start.get(startnode_label, inf):
+                    distance_from_start[startnode_label] = alt_dist_to_neighbour
+                    prev_node[startnode_label] = (PathEdge(node_id=edge_endnode,
+                                                           short_channel_id=ShortChannelID(edge_channel_id)),
+                                                  endnode_label)
                     amount_to_forward_msat = amount_msat + fee_for_edge_msat
-                    nodes_to_explore.put((alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
-
-        return prev_node
+                    heapq.heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode, num_hops + 1))
+
+        if not by_hops:
+            return {node: edge for node, (edge, _) in prev_node.items()}
+        return {node: edge for node, edge in _backtrack_labels(prev_node, end_label)}
+
+    def _get_distances_from_graph(self, nodeA: bytes, nodeB: bytes,
+                                  invoice_amount_msat: int, *,
+                                  my_channels: Dict[ShortChannelID, 'Channel'],
+                                  max_hops: Optional[int]
+                                  ) -> Dict[bytes, PathEdge]:
+        """Same search as _get_distances_from_dicts, over channel_db.graph.
+        Nodes are integers: graph indices, or negative numbers for nodes
+        that we only know about through our own channels.
+        """
+        if not self.channel_db.data_partially_loaded.is_set():
+            raise Exception("channelDB data not loaded yet!")
+        graph = self.channel_db.graph
+        blacklist = self.get_blacklisted_channels()
+        # our own channels might not be public, or have unpublished policies.
+        # they go through _edge_cost, which knows where to look.
+        my_channels_for_node = defaultdict(list)  # type: Dict[bytes, List[ShortChannelID]]
+        for chan in my_channels.values():
+            my_channels_for_node[chan.node_id].append(chan.short_channel_id)
+            my_channels_for_node[chan.get_local_pubkey()].append(chan.short_channel_id)
+        other_node_ids = []  # type: List[bytes]
+        other_node_idx = {}  # type: Dict[bytes, int]
+
+        def node_index(node_id: bytes) -> int:
+            idx = graph.node_index(node_id)
+            if idx is None:
+                idx = other_node_idx.get(node_id)
+                if idx is None:
+                    other_node_ids.append(node_id)
+                    idx = other_node_idx[node_id] = -len(other_node_ids)
+            return idx
+
+        def node_id_of(idx: int) -> bytes:
+            return graph.node_ids[idx] if idx >= 0 else other_node_ids[-idx - 1]
+
+        with graph.lock:
+            graph.maybe_compact()
+            idx_A = node_index(nodeA)
+            idx_B = node_index(nodeB)
+            inf = float('inf')
+            by_hops = max_hops is not None
+            distance_from_start = {(idx_B, 0) if by_hops else idx_B: 0}  # type: Dict[Any, float]
+            prev_node = {}  # type: Dict[Any, Tuple[Tuple[int, ShortChannelID], Any]]
+            end_label = None
+            nodes_to_explore = [(0, invoice_amount_msat, idx_B, 0)]
+
+            while nodes_to_explore:
+                dist_to_edge_endnode, amount_msat, edge_endnode, num_hops = heapq.heappop(nodes_to_explore)
+                endnode_label = (edge_endnode, num_hops) if by_hops else edge_endnode
+                if edge_endnode == idx_A:
+                    end_label = endnode_label
+                    break
+                if dist_to_edge_endnode != distance_from_start[endnode_label]:
+                    continue  # duplicate, see _get_distances_from_dicts
+                if by_hops and num_hops >= max_hops:
+                    continue
+                edges = []  # type: List[Tuple[int, ShortChannelID, float, int]]
+                if edge_endnode >= 0:
+                    for chan in graph.channels_for_node(edge_endnode):
+                        short_channel_id = graph.scids[chan]
+                        if short_channel_id in my_channels or short_channel_id in blacklist:
+                            continue
+                        edge_startnode = graph.other_node(chan, edge_endnode)
+                        edge_cost, fee_for_edge_msat = self._graph_edge_cost(
+                            graph, chan,
+                            start_node=edge_startnode,
+                            payment_amt_msat=amount_msat,
+                            ignore_costs=(edge_startnode == idx_A))
+                        edges.append((edge_startnode, short_channel_id, edge_cost, fee_for_edge_msat))
+                endnode_id = node_id_of(edge_endnode)
+                for short_channel_id in my_channels_for_node.get(endnode_id, ()):
+                    if short_channel_id in blacklist:
+                        continue
+                    chan = my_channels[short_channel_id]
+                    local_pubkey = chan.get_local_pubkey()
+                    startnode_id = chan.node_id if endnode_id == local_pubkey else local_pubkey
+                    if startnode_id == nodeA:  # payment outgoing, on our channel
+                        if not chan.can_pay(amount_msat, check_frozen=True):
+                            continue
+                    else:  # payment incoming, on our channel. (funny business, cycle weirdness)
+                        assert endnode_id == nodeA, (bh2u(startnode_id), bh2u(endnode_id))
+                        if not chan.can_receive(amount_msat, check_frozen=True):
+                            continue
+                    edge_cost, fee_for_edge_msat = self._edge_cost(
+                        short_channel_id,
+                        start_node=startnode_id,
+                        end_node=endnode_id,
+                        payment_amt_msat=amount_msat,
+                        ignore_costs=(startnode_id == nodeA),
+                        is_mine=True,
+                        my_channels=my_channels)
+                    edges.append((node_index(startnode_id), short_channel_id, edge_cost, fee_for_edge_msat))
+                for edge_startnode, short_channel_id, edge_cost, fee_for_edge_msat in edges:
+                    alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
+                    startnode_label = (edge_startnode, num_hops + 1) if by_hops else edge_startnode
+                    if alt_dist_to_neighbour < distance_from_start.get(startnode_label, inf):
+                        distance_from_start[startnode_label] = alt_dist_to_neighbour
+                        prev_node[startnode_label] = ((edge_endnode, short_channel_id), endnode_label)
+                        amount_to_forward_msat = amount_msat + fee_for_edge_msat
+                        heapq.heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode, num_hops + 1))
+
+            if not by_hops:
+                edges_by_node = ((startnode, edge) for startnode, (edge, _) in prev_node.items())
+            else:
+                edges_by_node = _backtrack_labels(prev_node, end_label)
+            return {node_id_of(startnode): PathEdge(node_id=node_id_of(endnode),
+                                                    short_channel_id=ShortChannelID(short_channel_id))
+                    for startnode, (endnode, short_channel_id) in edges_by_node}
 
     @profiler
     def find_path_for_payment(self, nodeA: bytes, nodeB: bytes,
                               invoice_amount_msat: int, *,
-                              my_channels: Dict[ShortChannelID, 'Channel'] = None) \
+                              my_channels: Dict[ShortChannelID, 'Channel'] = None,
+                              use_cache: bool = False) \
             -> Optional[LNPaymentPath]:
-        """Return a path from nodeA to nodeB."""
+        """Return a path from nodeA to nodeB.
+        If use_cache is set, a path found earlier for a similar amount
+        may be returned, if it is still usable for this amount.
+        """
         assert type(nodeA) is bytes
         assert type(nodeB) is bytes
         assert type(invoice_amount_msat) is int
         if my_channels is None:
             my_channels = {}
+        completeness = self.get_graph_completeness()
+        if completeness < 1:
+            # paths found in a partial graph are not cached, better ones may show up
+            path = self._find_path_for_payment(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+            if not path:
+                self.logger.info(f'no path found, channel graph only {completeness:.0%} loaded')
+            return path
+        if not use_cache:
+            return self._find_path_for_payment(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+
+        # our channels that can be used at all for this amount; the search depends on that
+        usable_channels = frozenset(
+            scid for scid, chan in my_channels.items()
+            if chan.can_pay(invoice_amount_msat, check_frozen=True) or chan.can_receive(invoice_amount_msat, check_frozen=True))
+        # amounts are bucketed by powers of two
+        key = (nodeA, nodeB, invoice_amount_msat.bit_length(), usable_channels)
+        path = self.route_cache.get(key)
+        if path is not None:
+            if self.is_path_usable(path, nodeA, invoice_amount_msat, my_channels=my_channels):
+                return path
+            self.route_cache.discard(key)
+        generation = self.route_cache.generation
+        path = self._find_path_for_payment(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+        if path:
+            self.route_cache.put(key, path, generation)
+        return path
 
+    def is_path_usable(self, path: LNPaymentPath, nodeA: bytes, invoice_amount_msat: int, *,
+                       my_channels: Dict[ShortChannelID, 'Channel']) -> bool:
+        """Checks that every edge of path can forward the amount, as the search would."""
+        blacklist = self.get_blacklisted_channels()
+        amount_msat = invoice_amount_msat
+        for i in reversed(range(len(path))):
+            edge_startnode = path[i-1].node_id if i > 0 else nodeA
+            edge_endnode = path[i].node_id
+            short_channel_id = path[i].short_channel_id
+            if short_channel_id in blacklist:
+                return False
+            is_mine = short_channel_id in my_channels
+            if is_mine:
+                chan = my_channels[short_channel_id]
+                if edge_startnode == nodeA:
+                    if not chan.can_pay(amount_msat, check_frozen=True):
+                        return False
+                elif not chan.can_receive(amount_msat, check_frozen=True):
+                    return False
+            edge_cost, fee_for_edge_msat = self._edge_cost(
+                short_channel_id,
+                start_node=edge_startnode,
+                end_node=edge_endnode,
+                payment_amt_msat=amount_msat,
+                ignore_costs=(i == 0),
+                is_mine=is_mine,
+                my_channels=my_channels)
+            if edge_cost == float('inf'):
+                return False
+            amount_msat += fee_for_edge_msat
+        return True
+
+    def _find_path_for_payment(self, nodeA: bytes, nodeB: bytes, invoice_amount_msat: int, *,
+                               my_channels: Dict[ShortChannelID, 'Channel']) -> Optional[LNPaymentPath]:
         prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+        path = self._backtrack(prev_node, nodeA, nodeB)
+        if path and len(path) > NUM_MAX_EDGES_IN_PAYMENT_PATH:
+            # paths cannot be longer than this (onion packet). This is rare,
+            # so we only then pay for the slower search bounded by hops.
+            prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                           max_hops=NUM_MAX_EDGES_IN_PAYMENT_PATH)
+            path = self._backtrack(prev_node, nodeA, nodeB)
+        return path
 
+    @staticmethod
+    def _backtrack(prev_node: Dict[bytes, PathEdge], nodeA: bytes, nodeB: bytes) -> Optional[LNPaymentPath]:
         if nodeA not in prev_node:
             return None  # no path found
-
         # backtrack from search_end (nodeA) to search_start (nodeB)
-        # FIXME paths cannot be longer than 20 edges (onion packet)...
         edge_startnode = nodeA
         path = []
         while edge_startnode != nodeB:
@@ -23,16 +23,15 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import asyncio
 import threading
-from typing import TYPE_CHECKING, Dict, Set
+from typing import TYPE_CHECKING, Dict, Set, Sequence, List
 
 import aiorpcx
 
 from . import bitcoin
 from . import ecc
 from . import constants
-from .util import bh2u, bfh, NetworkJobOnDefaultServer
+from .util import bh2u, bfh, NetworkJobOnDefaultServer, register_callback, unregister_callback
 from .lnutil import funding_output_script_from_keys, ShortChannelID
 from .verifier import verify_tx_is_in_block, MerkleVerificationFailure
 from .transaction import Transaction
@@ -59,6 +58,7 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
         # channel announcements that seem to be invalid:
         self.blacklist = set()  # type: Set[ShortChannelID]
         NetworkJobOnDefaultServer.__init__(self, network)
+        register_callback(self._on_blockchain_updated, ['blockchain_updated', 'network_updated'])
 
     def _reset(self):
         super()._reset()
@@ -72,16 +72,26 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
             return False
         with self.lock:
             self.unverified_channel_info[short_channel_id] = msg
-            return True
+        self.wakeup()
+        return True
 
     async def _start_tasks(self):
         async with self.taskgroup as group:
             await group.spawn(self.main)
 
+    async def stop(self):
+        unregister_callback(self._on_blockchain_updated)
+        await super().stop()
+
+    def _on_blockchain_updated(self, event, *args):
+        # headers of more blocks might be available
+        self._wakeup.set()
+
     async def main(self):
         while True:
+            self._wakeup.clear()
             await self._verify_some_channels()
-            await asyncio.sleep(0.1)
+            await self._wakeup.wait()
 
     async def _verify_some_channels(self):
         blockchain = self.network.blockchain()
@@ -97,15 +107,19 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
             # only resolve short_channel_id if headers are available.
             if block_height <= 0 or block_height > local_height:
                 continue
-            header = blockchain.read_header(block_height)
+            header = blockchain.read_header_view(block_height)
             if header is None:
                 if block_height < constants.net.max_checkpoint():
-                    await self.taskgroup.spawn(self.network.request_chunk(block_height, None, can_return_early=True))
+                    await self.taskgroup.spawn(self._request_chunk(block_height))
                 continue
             self.started_verifying_channel.add(short_channel_id)
             await self.taskgroup.spawn(self.verify_channel(block_height, short_channel_id))
             #self.logger.info(f'requested short_channel_id {bh2u(short_channel_id)}')
 
+    async def _request_chunk(self, height: int):
+        await self.network.request_chunk(height, None, can_return_early=True)
+        self._wakeup.set()
+
     async def verify_channel(self, block_height: int, short_channel_id: ShortChannelID):
         # we are verifying channel announcements as they are from untrusted ln peers.
         # we use electrum servers to do this. however we don't trust electrum servers either...
@@ -176,10 +190,14 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
 
 
 def verify_sig_for_channel_update(chan_upd: dict, node_id: bytes) -> bool:
-    msg_bytes = chan_upd['raw']
-    pre_hash = msg_bytes[2+64:]
-    h = sha256d(pre_hash)
-    sig = chan_upd['signature']
-    if not ecc.verify_signature(node_id, sig, h):
-        return False
-    return True
+    return verify_sigs_for_channel_updates([chan_upd], [node_id])[0]
+
+
+def verify_sigs_for_channel_updates(chan_upds: Sequence[dict], node_ids: Sequence[bytes]) -> List[bool]:
+    """Batched verify_sig_for_channel_update."""
+    items = []
+    for chan_upd, node_id in zip(chan_upds, node_ids):
+        msg_bytes = chan_upd['raw']
+        pre_hash = msg_bytes[2+64:]
+        items.append((node_id, chan_upd['signature'], sha256d(pre_hash)))
+    return ecc.verify_signatures(items)
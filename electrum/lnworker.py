@@ -311,7 +311,7 @@ class LNWorker(Logger, NetworkRetryManager[LNPeerAddr]):
 
     async def _get_next_peers_to_try(self) -> Sequence[LNPeerAddr]:
         now = time.time()
-        await self.channel_db.data_loaded.wait()
+        await self.channel_db.data_partially_loaded.wait()
         # first try from recent peers
         recent_peers = self.channel_db.get_recent_peers()
         for peer in recent_peers:
@@ -465,6 +465,8 @@ class LNGossip(LNWorker):
             await asyncio.sleep(120)
 
     async def add_new_ids(self, ids):
+        # channels that are not loaded yet are not unknown
+        await self.channel_db.data_loaded.wait()
         known = self.channel_db.get_channel_ids()
         new = set(ids) - set(known)
         self.unknown_ids.update(new)
@@ -769,11 +771,14 @@ class LNWallet(LNWorker):
         self.save_channel(chan)
         util.trigger_callback('channel', self.wallet, chan)
 
-    def save_channel(self, chan: Channel):
+    def save_channel(self, chan: Channel, *, flush: bool = False):
+        """Saves the channel state. Use flush=True if the state must be on disk
+        before we proceed, e.g. before sending revoke_and_ack.
+        """
         assert type(chan) is Channel
         if chan.config[REMOTE].next_per_commitment_point == chan.config[REMOTE].current_per_commitment_point:
             raise Exception("Tried to save channel with next_point == current_point, this should not happen")
-        self.wallet.save_db()
+        self.wallet.save_db(flush=flush)
         util.trigger_callback('channel', self.wallet, chan)
 
     def channel_by_txo(self, txo: str) -> Optional[Channel]:
@@ -838,7 +843,8 @@ class LNWallet(LNWorker):
         channels_db[chan.channel_id.hex()] = chan.storage
         for addr in chan.get_wallet_addresses_channel_might_want_reserved():
             self.wallet.set_reserved_state_of_address(addr, reserved=True)
-        self.save_channel(chan)
+        # the channel must be on disk before its funding tx gets broadcast
+        self.save_channel(chan, flush=True)
         self.wallet.save_backup()
 
     def mktx_for_open_channel(self, *, coins: Sequence[PartialTxInput], funding_sat: int,
@@ -1095,7 +1101,7 @@ class LNWallet(LNWorker):
             else:
                 # find path now on public graph, to border node
                 path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, border_node_pubkey, amount_msat,
-                                                                      my_channels=scid_to_my_channels)
+                                                                      my_channels=scid_to_my_channels, use_cache=True)
             if not path:
                 continue
             try:
@@ -1139,7 +1145,7 @@ class LNWallet(LNWorker):
                 path = full_path
             else:  # find path now
                 path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, invoice_pubkey, amount_msat,
-                                                                      my_channels=scid_to_my_channels)
+                                                                      my_channels=scid_to_my_channels, use_cache=True)
             if not path:
                 raise NoPathFound()
             route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey,
@@ -1201,7 +1207,8 @@ class LNWallet(LNWorker):
     def save_preimage(self, payment_hash: bytes, preimage: bytes):
         assert sha256(preimage) == payment_hash
         self.preimages[bh2u(payment_hash)] = bh2u(preimage)
-        self.wallet.save_db()
+        # we might lose funds if we forget a preimage we have revealed
+        self.wallet.save_db(flush=True)
 
     def get_preimage(self, payment_hash: bytes) -> Optional[bytes]:
         r = self.preimages.get(bh2u(payment_hash))
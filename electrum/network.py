@@ -32,7 +32,7 @@ import socket
 import json
 import sys
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any, Union
 import traceback
 import concurrent
 from concurrent import futures
@@ -56,6 +56,7 @@ from .blockchain import Blockchain, HEADER_SIZE
 from .interface import (Interface, PREFERRED_NETWORK_PROTOCOL,
                         RequestTimedOut, NetworkTimeout, BUCKET_NAME_OF_ONION_SERVERS,
                         NetworkException, RequestCorrupted, ServerAddr)
+from .shared_sync import SharedSync
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
 from .i18n import _
@@ -63,6 +64,7 @@ from .logging import get_logger, Logger
 
 if TYPE_CHECKING:
     from .channel_db import ChannelDB
+    from .lngossip_pipeline import GossipPipeline
     from .lnworker import LNGossip
     from .lnwatcher import WatchTower
     from .daemon import Daemon
@@ -330,8 +332,12 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self._set_status('disconnected')
         self._has_ever_managed_to_connect_to_server = False
 
+        # txs and merkle proofs shared by the wallets synchronizing on this network
+        self.shared_sync = SharedSync(self)
+
         # lightning network
         self.channel_db = None  # type: Optional[ChannelDB]
+        self.gossip_pipeline = None  # type: Optional[GossipPipeline]
         self.lngossip = None  # type: Optional[LNGossip]
         self.local_watchtower = None  # type: Optional[WatchTower]
         if self.config.get('run_local_watchtower', False):
@@ -351,9 +357,12 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         if self.channel_db is None:
             from . import lnrouter
             from . import channel_db
+            from .lngossip_pipeline import GossipPipeline
             self.channel_db = channel_db.ChannelDB(self)
+            self.gossip_pipeline = GossipPipeline(self.config)
             self.path_finder = lnrouter.LNPathFinder(self.channel_db)
-            self.channel_db.load_data()
+            # loads in the background, see ChannelDB.load_data
+            asyncio.run_coroutine_threadsafe(self.channel_db.load_data(), self.asyncio_loop)
 
     def start_gossip(self):
         if self.lngossip is None:
@@ -846,6 +855,15 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
         return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
 
+    @best_effort_reliable
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List[Union[dict, UntrustedServerReturnedError]]:
+        """Batched get_merkle_for_transaction. Errors returned by the server
+        for individual txs are returned as UntrustedServerReturnedError.
+        """
+        results = await self.interface.get_merkle_for_transactions(txs)
+        return [UntrustedServerReturnedError(original_exception=res) if isinstance(res, aiorpcx.jsonrpc.CodeMessageError) else res
+                for res in results]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
         if timeout is None:
@@ -1018,9 +1036,19 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     async def request_chunk(self, height: int, tip=None, *, can_return_early=False):
         return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
+    async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
+        """Returns the raw tx, from the tx cache if we have it there."""
+        raw_tx = (await self.shared_sync.get_cached_txs([tx_hash])).get(tx_hash)
+        if raw_tx is not None:
+            return raw_tx
+        raw_tx = await self._get_transaction(tx_hash, timeout=timeout)
+        # note: the interface checked the txid
+        await self.shared_sync.add_tx(tx_hash, raw_tx)
+        return raw_tx
+
     @best_effort_reliable
     @catch_server_exceptions
-    async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
+    async def _get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         return await self.interface.get_transaction(tx_hash=tx_hash, timeout=timeout)
 
     @best_effort_reliable
@@ -1167,7 +1195,11 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interface = None
         self.interfaces = {}
         self._connecting.clear()
-        if not full_shutdown:
+        if full_shutdown:
+            blockchain.sync_headers_files()
+            if self.gossip_pipeline:
+                self.gossip_pipeline.stop()
+        else:
             util.trigger_callback('network_updated')
 
     def stop(self):
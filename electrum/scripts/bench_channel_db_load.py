@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# Times ChannelDB.load_data on a synthetic gossip database, and compares it
+# with decoding the raw messages, which is what load_data did before the
+# decoded fields were stored. The database is first written in the old
+# format (raw messages only, in the old file), so the one-time import of
+# it is timed too.
+# Also reports when routing can start, i.e. when the first batch of
+# channels is loaded (ChannelDB.data_partially_loaded).
+
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import tempfile
+
+from electrum import constants, util
+from electrum.channel_db import ChannelDB, ChannelInfo, Policy, NodeInfo
+from electrum.lnmsg import encode_msg
+from electrum.lnutil import ShortChannelID
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop, get_headers_dir
+
+
+def make_old_db(path: str, num_channels: int, num_nodes: int):
+    chain_hash = constants.net.rev_genesis_bytes()
+    node_ids = [bytes([2]) + i.to_bytes(32, 'big') for i in range(num_nodes)]
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE channel_info (short_channel_id BLOB(8), msg BLOB, PRIMARY KEY(short_channel_id))")
+    conn.execute("CREATE TABLE policy (key BLOB(41), msg BLOB, PRIMARY KEY(key))")
+    conn.execute("CREATE TABLE node_info (node_id BLOB(33), msg BLOB, PRIMARY KEY(node_id))")
+    for i in range(num_channels):
+        n1, n2 = sorted([node_ids[i % num_nodes], node_ids[(i * 7 + 1) % num_nodes]])
+        scid = ShortChannelID.from_components(600_000 + i, 1, 0)
+        msg = encode_msg('channel_announcement', len=0, features=b'', chain_hash=chain_hash, short_channel_id=scid,
+                         node_id_1=n1, node_id_2=n2, bitcoin_key_1=n1, bitcoin_key_2=n2, node_signature_1=bytes(64))
+        conn.execute("INSERT OR IGNORE INTO channel_info VALUES (?,?)", (scid, msg))
+        for direction, node_id in enumerate((n1, n2)):
+            msg = encode_msg('channel_update', chain_hash=chain_hash, short_channel_id=scid,
+                             timestamp=1_600_000_000, message_flags=b'\x01', channel_flags=bytes([direction]),
+                             cltv_expiry_delta=40, htlc_minimum_msat=1000, htlc_maximum_msat=10**9,
+                             fee_base_msat=1000, fee_proportional_millionths=i % 1000)
+            conn.execute("INSERT OR IGNORE INTO policy VALUES (?,?)", (scid + node_id, msg))
+    for i, node_id in enumerate(node_ids):
+        msg = encode_msg('node_announcement', flen=0, features=b'', timestamp=1_600_000_000, node_id=node_id,
+                         rgb_color=b'\x00' * 3, alias=b'node'.ljust(32, b'\x00'), addrlen=0, addresses=b'')
+        conn.execute("INSERT INTO node_info VALUES (?,?)", (node_id, msg))
+    conn.commit()
+    conn.close()
+
+
+def decode_raw_messages(path: str):
+    # the loops of the previous ChannelDB.load_data
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    channels, nodes, policies = {}, {}, {}
+    c.execute("SELECT short_channel_id, msg FROM channel_info")
+    for short_channel_id, msg in c:
+        channels[ShortChannelID.normalize(short_channel_id)] = ChannelInfo.from_raw_msg(msg)
+    c.execute("SELECT node_id, msg FROM node_info")
+    for node_id, msg in c:
+        nodes[node_id] = NodeInfo.from_raw_msg(msg)[0]
+    c.execute("SELECT key, msg FROM policy")
+    for key, msg in c:
+        p = Policy.from_raw_msg(key, msg)
+        policies[(p.start_node, p.short_channel_id)] = p
+    conn.close()
+    return channels, nodes, policies
+
+
+def load_channel_db(config, loop):
+    class FakeNetwork:
+        asyncio_loop = loop
+        interface = None
+    FakeNetwork.config = config
+    t0 = time.perf_counter()
+    cdb = ChannelDB(FakeNetwork())
+    async def wait_partially_loaded():
+        await cdb.data_partially_loaded.wait()
+        return time.perf_counter() - t0
+    async def load():
+        partially_loaded = asyncio.ensure_future(wait_partially_loaded())
+        await cdb.load_data()
+        return await partially_loaded
+    dt_partial = asyncio.run_coroutine_threadsafe(load(), loop).result()
+    return cdb, dt_partial, time.perf_counter() - t0
+
+
+def main():
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 40_000
+    num_nodes = num_channels // 4
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    util.callback_mgr.asyncio_loop = loop
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = SimpleConfig({'electrum_path': tmpdir, 'lightning_compact_graph': False})
+        path = os.path.join(get_headers_dir(config), 'gossip_db')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        make_old_db(path, num_channels, num_nodes)
+        print(f"{num_channels} channels, {2 * num_channels} policies, {num_nodes} nodes")
+        t0 = time.perf_counter()
+        decode_raw_messages(path)
+        print(f"decoding raw messages (previous load_data): {time.perf_counter() - t0:.2f}s")
+        cdb, dt_partial, dt = load_channel_db(config, loop)
+        print(f"first start, with migration:               {dt:.2f}s (routing after {dt_partial:.2f}s)")
+        for cdb2, dt_partial, dt in [load_channel_db(config, loop)]:
+            assert cdb2._channels == cdb._channels and cdb2._policies == cdb._policies
+            print(f"load_data from decoded columns:            {dt:.2f}s (routing after {dt_partial:.2f}s)")
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join()
+
+
+if __name__ == '__main__':
+    main()
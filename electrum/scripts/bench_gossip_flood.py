@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Measures how late the event loop gets while a flood of gossip is decoded
+# and verified: synthetic signed channel announcements, node announcements
+# and channel updates, processed either on the event loop itself or with
+# lngossip_pipeline.GossipPipeline. A ticker task wakes up every
+# millisecond and records how late it was woken up.
+
+import sys
+import time
+import asyncio
+import tempfile
+
+from electrum import ecc
+from electrum.crypto import sha256d
+from electrum.lngossip_pipeline import GossipPipeline, process_gossip_batch
+from electrum.lnmsg import encode_msg
+from electrum.simple_config import SimpleConfig
+from electrum.util import chunks
+
+
+def make_msgs(num_chan_anns: int, num_nodes: int):
+    nodes = [ecc.ECPrivkey(sha256d(b'node %d' % i)) for i in range(num_nodes)]
+    msgs = []
+    for i in range(num_chan_anns):
+        keys = [nodes[i % num_nodes], nodes[(i * 7 + 1) % num_nodes]]
+        keys += [ecc.ECPrivkey(sha256d(b'bitcoin key %d %d' % (i, j))) for j in range(2)]
+        pubkeys = [key.get_public_key_bytes() for key in keys]
+        fields = dict(
+            len=0, features=b'', chain_hash=bytes(32), short_channel_id=i.to_bytes(8, 'big'),
+            node_id_1=pubkeys[0], node_id_2=pubkeys[1], bitcoin_key_1=pubkeys[2], bitcoin_key_2=pubkeys[3])
+        h = sha256d(encode_msg('channel_announcement', **fields)[2+256:])
+        sigs = [key.sign(h, ecc.sig_string_from_r_and_s) for key in keys]
+        msgs.append(encode_msg('channel_announcement', node_signature_1=sigs[0], node_signature_2=sigs[1],
+                               bitcoin_signature_1=sigs[2], bitcoin_signature_2=sigs[3], **fields))
+        for direction in range(2):
+            msgs.append(encode_msg(
+                'channel_update', signature=bytes(64), chain_hash=bytes(32),
+                short_channel_id=i.to_bytes(8, 'big'), timestamp=1_600_000_000, message_flags=b'\x00',
+                channel_flags=bytes([direction]), cltv_expiry_delta=144, htlc_minimum_msat=1000,
+                fee_base_msat=1000, fee_proportional_millionths=1))
+    for i, key in enumerate(nodes):
+        fields = dict(flen=0, features=b'', timestamp=1_600_000_000, node_id=key.get_public_key_bytes(),
+                      rgb_color=b'\x00' * 3, alias=b'node %d' % i + b'\x00' * (32 - len(b'node %d' % i)),
+                      addrlen=0, addresses=b'')
+        h = sha256d(encode_msg('node_announcement', **fields)[66:])
+        msgs.append(encode_msg('node_announcement', signature=key.sign(h, ecc.sig_string_from_r_and_s), **fields))
+    return msgs
+
+
+async def ticker(lateness, stopped):
+    loop = asyncio.get_event_loop()
+    while not stopped.is_set():
+        t = loop.time()
+        await asyncio.sleep(0.001)
+        lateness.append(loop.time() - t - 0.001)
+
+
+async def process_inline(msgs):
+    # what Peer.process_gossip did before the pipeline, yielding between chunks
+    for chunk in chunks(msgs, 500):
+        process_gossip_batch(chunk)
+        await asyncio.sleep(0)
+
+
+async def run(process, msgs):
+    lateness = []
+    stopped = asyncio.Event()
+    ticker_task = asyncio.ensure_future(ticker(lateness, stopped))
+    await asyncio.sleep(0.01)
+    t0 = time.perf_counter()
+    await process(msgs)
+    dt = time.perf_counter() - t0
+    stopped.set()
+    await ticker_task
+    lateness.sort()
+    return dt, lateness[len(lateness) * 99 // 100], lateness[-1]
+
+
+def main():
+    num_chan_anns = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000
+    num_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000
+    msgs = make_msgs(num_chan_anns, num_nodes)
+    print(f"{len(msgs)} gossip messages: {num_chan_anns} channel announcements, "
+          f"{2 * num_chan_anns} channel updates, {num_nodes} node announcements")
+    print(f"{'processing':>12} {'time':>8} {'p99 lateness':>13} {'max lateness':>13}")
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dt, p99, worst = loop.run_until_complete(run(process_inline, msgs))
+        print(f"{'event loop':>12} {dt:>7.2f}s {p99 * 1000:>11.1f}ms {worst * 1000:>11.1f}ms")
+        for num_workers in (0, 1, 4):
+            pipeline = GossipPipeline(SimpleConfig({'electrum_path': tmpdir, 'lightning_gossip_workers': num_workers}))
+            # start the workers before measuring
+            loop.run_until_complete(pipeline.process(msgs))
+            dt, p99, worst = loop.run_until_complete(run(pipeline.process, msgs))
+            pipeline.stop()
+            name = f'{num_workers} workers' if num_workers else 'threads'
+            print(f"{name:>12} {dt:>7.2f}s {p99 * 1000:>11.1f}ms {worst * 1000:>11.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
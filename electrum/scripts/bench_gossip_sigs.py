@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+#
+# Verifies the signatures of synthetic channel announcements, as
+# lngossip_pipeline.verify_channel_announcements does: four signatures per
+# announcement, node keys shared by many channels. Compares calling
+# ecc.verify_signature for each signature with ecc.verify_signatures.
+
+import sys
+import time
+import random
+
+from electrum import ecc
+from electrum.crypto import sha256d
+
+
+def make_items(num_anns: int, num_nodes: int, rand: random.Random):
+    nodes = [ecc.ECPrivkey(sha256d(b'node %d' % i)) for i in range(num_nodes)]
+    weights = [1 / (i + 1) for i in range(num_nodes)]
+    items = []
+    for i in range(num_anns):
+        h = sha256d(b'announcement %d' % i)
+        keys = rand.choices(nodes, weights=weights, k=2)
+        keys += [ecc.ECPrivkey(sha256d(b'bitcoin key %d %d' % (i, j))) for j in range(2)]
+        for key in keys:
+            items.append((key.get_public_key_bytes(), key.sign(h, ecc.sig_string_from_r_and_s), h))
+    return items
+
+
+def main():
+    num_anns = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    num_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    items = make_items(num_anns, num_nodes, random.Random(0))
+    t0 = time.perf_counter()
+    results1 = [ecc.verify_signature(*item) for item in items]
+    t1 = time.perf_counter()
+    results2 = ecc.verify_signatures(items)
+    t2 = time.perf_counter()
+    assert results1 == results2 and all(results2)
+    print(f"{num_anns} channel announcements, {len(items)} signatures")
+    print(f"verify_signature:  {t1 - t0:.2f}s, {len(items) / (t1 - t0):,.0f} sigs/s")
+    print(f"verify_signatures: {t2 - t1:.2f}s, {len(items) / (t2 - t1):,.0f} sigs/s")
+
+
+if __name__ == '__main__':
+    main()
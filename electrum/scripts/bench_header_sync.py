@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Measures initial header sync (Interface.sync_until) against a stand-in
+# server that answers blockchain.block.headers after a fixed latency,
+# with one chunk request in flight at a time versus several.
+# Runs on regtest, with synthetic headers.
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+from electrum import blockchain, constants
+from electrum.crypto import sha256, sha256d
+from electrum.interface import Interface, ServerAddr
+from electrum.simple_config import SimpleConfig
+from electrum.util import bfh
+
+
+class StandInSession:
+
+    def __init__(self, headers, latency: float):
+        self.headers = headers
+        self.latency = latency
+
+    async def send_request(self, method, params, timeout=None):
+        assert method == 'blockchain.block.headers', method
+        await asyncio.sleep(self.latency)
+        start, count = params
+        headers = self.headers[start:start + count]
+        return {'count': len(headers), 'hex': b''.join(headers).hex(), 'max': 2016}
+
+    def is_closing(self):
+        return False
+
+
+class FakeTaskGroup:
+    async def spawn(self, x):
+        x.close()
+
+
+def make_headers(num_headers):
+    headers = [bfh("0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff7f2002000000")]
+    for i in range(1, num_headers):
+        headers.append((0x20000000).to_bytes(4, 'little') + sha256d(headers[-1]) + sha256(str(i))
+                       + (1296688602 + i).to_bytes(4, 'little') + bfh('ffff7f20') + bytes(4))
+    return headers
+
+
+def run_sync(loop, tmpdir: str, headers, latency: float, in_flight: int) -> float:
+    class fake_network:
+        config = SimpleConfig({'electrum_path': os.path.join(tmpdir, str(in_flight)),
+                               'network_chunk_requests_in_flight': in_flight})
+        asyncio_loop = loop
+        taskgroup = FakeTaskGroup()
+        interfaces = {}
+    interface = Interface(network=fake_network(), server=ServerAddr.from_str('localhost:50001:t'), proxy=None)
+    chain = blockchain.Blockchain(config=fake_network.config, forkpoint=0, parent=None,
+                                  forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+    blockchain.blockchains = {constants.net.GENESIS: chain}
+    with open(chain.path(), 'wb') as f:
+        f.write(headers[0])
+    chain.update_size()
+    interface.blockchain = chain
+    interface.session = StandInSession(headers, latency)
+    interface.tip = len(headers) - 1
+    t0 = time.perf_counter()
+    loop.run_until_complete(interface.sync_until(1, next_height=interface.tip))
+    dt = time.perf_counter() - t0
+    assert chain.height() == interface.tip
+    return dt
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    constants.set_regtest()
+    headers = make_headers(num_headers)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print(f"{num_headers} headers, {latency * 1000:.0f}ms latency")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for in_flight in (1, 2, 4, 8):
+            dt = run_sync(loop, tmpdir, headers, latency, in_flight)
+            print(f"{in_flight:>3} in flight: {dt:.2f}s, {num_headers / dt:,.0f} headers/s")
+
+
+if __name__ == '__main__':
+    main()
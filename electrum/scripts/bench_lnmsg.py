@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+#
+# Times lnmsg.encode_msg and lnmsg.decode_msg for each message type of
+# peer_wire.csv. Sample messages are built from the CSV itself: variable
+# length fields get a few items, and TLV streams are left out.
+
+import sys
+import timeit
+
+from electrum import lnmsg
+
+
+def make_sample_msg(lnser: lnmsg.LNSerializer, msg_type_bytes: bytes) -> bytes:
+    scheme = lnser.msg_scheme_from_type[msg_type_bytes]
+    # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+    count_fields = {row[4] for row in scheme[1:]}
+    kwargs = {}
+    for row in scheme[1:]:
+        field_name, field_type, field_count = row[2], row[3], row[4]
+        if field_name == 'tlvs':
+            continue
+        if field_name in count_fields:
+            kwargs[field_name] = 3
+        elif field_type in ('u8', 'u16', 'u32', 'u64', 'tu16', 'tu32', 'tu64', 'varint'):
+            kwargs[field_name] = 42
+        else:
+            count = kwargs[field_count] if field_count in kwargs else int(field_count or 1)
+            kwargs[field_name] = bytes(count * lnmsg._BYTES_TYPE_LEN[field_type])
+    return lnser.encode_msg(scheme[0][1], **kwargs)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    lnser = lnmsg._inst
+    print(f"{'message':>28} {'size':>6} {'decode':>9} {'encode':>9}")
+    for msg_type_bytes, scheme in lnser.msg_scheme_from_type.items():
+        msg = make_sample_msg(lnser, msg_type_bytes)
+        msg_type, payload = lnser.decode_msg(msg)
+        assert lnser.encode_msg(msg_type, **payload) == msg
+        t_decode = timeit.timeit(lambda: lnser.decode_msg(msg), number=number) / number
+        t_encode = timeit.timeit(lambda: lnser.encode_msg(msg_type, **payload), number=number) / number
+        print(f"{msg_type:>28} {len(msg):>6} {t_decode * 1e6:>7.2f}us {t_encode * 1e6:>7.2f}us")
+
+
+if __name__ == '__main__':
+    main()
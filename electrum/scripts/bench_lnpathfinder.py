@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+# Compares the dict-based gossip graph of ChannelDB with the compact
+# array-backed one (lngraph.CompactChannelGraph): memory used to hold
+# the graph, and latency of LNPathFinder.find_path_for_payment on it.
+# The graph is synthetic, with random fees and a skewed degree distribution.
+
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+from electrum import constants
+from electrum.channel_db import ChannelDB
+from electrum.lngraph import CompactChannelGraph
+from electrum.lnrouter import LNPathFinder
+from electrum.lnutil import ShortChannelID, NUM_MAX_EDGES_IN_PAYMENT_PATH
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop
+
+
+def populate(cdb: ChannelDB, num_nodes: int, num_channels: int, rand: random.Random):
+    node_ids = [bytes([2]) + rand.getrandbits(256).to_bytes(32, 'big') for i in range(num_nodes)]
+    # a few nodes have most of the channels
+    weights = [1 / (i + 1) for i in range(num_nodes)]
+    genesis = constants.net.rev_genesis_bytes()
+    for i in range(num_channels):
+        n1, n2 = rand.choices(node_ids, weights=weights, k=2)
+        if n1 == n2:
+            continue
+        n1, n2 = sorted([n1, n2])
+        scid = ShortChannelID.from_components(500_000 + i // 1000, i % 1000, 0)
+        cdb.add_channel_announcement({'node_id_1': n1, 'node_id_2': n2, 'bitcoin_key_1': n1, 'bitcoin_key_2': n2,
+                                      'short_channel_id': scid, 'chain_hash': genesis,
+                                      'len': 0, 'features': b''}, trusted=True)
+        for direction in (0, 1):
+            cdb.add_channel_update({'short_channel_id': scid, 'message_flags': b'\x01',
+                                    'channel_flags': bytes([direction]),
+                                    'cltv_expiry_delta': rand.choice([18, 40, 144]),
+                                    'htlc_minimum_msat': 1000,
+                                    'htlc_maximum_msat': rand.choice([10**8, 10**9, 10**10]),
+                                    'fee_base_msat': rand.choice([0, 1000]),
+                                    'fee_proportional_millionths': rand.randrange(1, 2000),
+                                    'chain_hash': genesis, 'timestamp': 0},
+                                   verbose=False)
+    return node_ids
+
+
+def build_graph(cdb: ChannelDB, graph: CompactChannelGraph):
+    for channel_info in cdb._channels.values():
+        graph.add_channel(channel_info)
+    for (node_id, short_channel_id), policy in cdb._policies.items():
+        graph.update_policy(short_channel_id, node_id, policy)
+    graph.compact()
+
+
+def main():
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+    num_channels = int(sys.argv[2]) if len(sys.argv) > 2 else 40_000
+    num_queries = 100
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        class fake_network:
+            config = SimpleConfig({'electrum_path': tmpdir, 'lightning_compact_graph': False})
+            asyncio_loop = loop
+            interface = None
+        cdb = ChannelDB(fake_network())
+        cdb.data_partially_loaded.set()
+        cdb.data_loaded.set()
+        rand = random.Random(0)
+        tracemalloc.start()
+        node_ids = populate(cdb, num_nodes, num_channels, rand)
+        dict_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        graph = CompactChannelGraph()
+        build_graph(cdb, graph)
+        cdb.graph = graph
+        compact_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        queries = [(rand.choice(node_ids), rand.choice(node_ids), rand.choice([10**4, 10**6, 10**8]))
+                   for i in range(num_queries)]
+        path_finder = LNPathFinder(cdb)
+
+        def run_queries() -> float:
+            t0 = time.perf_counter()
+            for a, b, amount_msat in queries:
+                path = path_finder.find_path_for_payment(a, b, amount_msat)
+                assert len(path or []) <= NUM_MAX_EDGES_IN_PAYMENT_PATH
+            return (time.perf_counter() - t0) / num_queries
+
+        t_compact = run_queries()
+        cdb.graph = None
+        t_dict = run_queries()
+        cdb.graph = graph
+
+        print(f"{graph.num_nodes()} nodes, {graph.num_channels()} channels")
+        print(f"{'':>8} {'memory':>10} {'route':>10}")
+        print(f"{'dict':>8} {dict_size / 2**20:>8.1f}MB {t_dict * 1000:>8.1f}ms")
+        print(f"{'compact':>8} {compact_size / 2**20:>8.1f}MB {t_compact * 1000:>8.1f}ms")
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
+        cdb.sql_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
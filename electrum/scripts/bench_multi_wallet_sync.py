@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# Synchronizes N wallets at once against a local fake server, with and
+# without the state shared between wallets (shared_sync.SharedSync),
+# and reports the requests the server got, the time it took and the
+# memory used. Neighbouring wallets have half of their addresses in
+# common, and each tx pays to two consecutive addresses.
+
+import sys
+import time
+import asyncio
+import tempfile
+import tracemalloc
+from collections import defaultdict
+
+import aiorpcx
+from aiorpcx import RPCSession
+
+from electrum import bitcoin
+from electrum.crypto import sha256
+from electrum.interface import Interface, NotificationSession, ServerAddr
+from electrum.logging import Logger
+from electrum.shared_sync import SharedSync
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import Synchronizer, history_status
+from electrum.transaction import Transaction
+from electrum.util import SilentTaskGroup
+from electrum.wallet import restore_wallet_from_text
+
+
+def make_raw_tx(i: int, addresses) -> str:
+    raw = '02000000' + '01' + sha256(b'prevout %d' % i).hex() + '00000000' + '00' + 'ffffffff'
+    raw += '%02x' % len(addresses)
+    for addr in addresses:
+        script = bitcoin.address_to_script(addr)
+        raw += (10_000 + i).to_bytes(8, 'little').hex() + '%02x' % (len(script) // 2) + script
+    return raw + '00000000'
+
+
+def make_server_data(num_addresses: int):
+    addresses = [bitcoin.hash_to_segwit_addr(sha256(b'addr %d' % i)[:20], witver=0) for i in range(num_addresses)]
+    histories = defaultdict(list)
+    txs = {}
+    for i in range(num_addresses):
+        tx_addresses = [addresses[i], addresses[(i + 1) % num_addresses]]
+        raw_tx = make_raw_tx(i, tx_addresses)
+        txid = Transaction(raw_tx).txid()
+        txs[txid] = raw_tx
+        for addr in tx_addresses:
+            histories[bitcoin.address_to_scripthash(addr)].append({'tx_hash': txid, 'height': 100 + i})
+    return addresses, histories, txs
+
+
+def session_factory(histories, txs, num_requests):
+    class Session(RPCSession):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.cost_hard_limit = 0
+
+        async def handle_request(self, request):
+            num_requests[request.method] += 1
+            if request.method == 'blockchain.scripthash.subscribe':
+                history = histories[request.args[0]]
+                return history_status([(item['tx_hash'], item['height']) for item in history])
+            if request.method == 'blockchain.scripthash.get_history':
+                return histories[request.args[0]]
+            if request.method == 'blockchain.transaction.get':
+                return txs[request.args[0]]
+            raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+    return Session
+
+
+class FakeInterface(Interface):
+    def __init__(self, network):
+        self.network = network
+        self.server = ServerAddr.from_str('localhost:50001:t')
+        Logger.__init__(self)
+        self.debug = False
+        self.session = None
+        self.taskgroup = SilentTaskGroup()
+
+
+class FakeNetwork:
+    debug = False
+
+    def __init__(self, config):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.config = config
+        self.interface = None
+        self.shared_sync = SharedSync(self)
+
+    def notify(self, key):
+        pass
+
+
+async def sync_wallets(config, wallets, histories, txs):
+    num_requests = defaultdict(int)
+    network = FakeNetwork(config)
+    interface = FakeInterface(network)
+    factory = session_factory(histories, txs, num_requests)
+    async with await aiorpcx.serve_rs(factory, 'localhost', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        client_factory = lambda *args, **kwargs: NotificationSession(*args, interface=interface, **kwargs)
+        async with aiorpcx.connect_rs('localhost', port, session_factory=client_factory) as session:
+            interface.session = session
+            network.interface = interface
+            t0 = time.perf_counter()
+            synchronizers = []
+            for wallet in wallets:
+                wallet.network = network
+                synchronizers.append(Synchronizer(wallet))
+            while not all(wallet.is_up_to_date() for wallet in wallets):
+                await asyncio.sleep(0.01)
+            dt = time.perf_counter() - t0
+            for synchronizer in synchronizers:
+                await synchronizer.stop()
+            await interface.taskgroup.cancel_remaining()
+    return num_requests, dt
+
+
+def run(tmpdir: str, num_wallets: int, addresses_per_wallet: int, shared: bool):
+    half = addresses_per_wallet // 2
+    addresses, histories, txs = make_server_data(half * (num_wallets + 1))
+    config = SimpleConfig({'electrum_path': tmpdir, 'network_shared_sync': shared})
+    wallets = [restore_wallet_from_text(' '.join(addresses[i * half:i * half + addresses_per_wallet]),
+                                        path=f'{tmpdir}/wallet_{num_wallets}_{shared}_{i}', config=config)['wallet']
+               for i in range(num_wallets)]
+    tracemalloc.start()
+    num_requests, dt = asyncio.get_event_loop().run_until_complete(sync_wallets(config, wallets, histories, txs))
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return num_requests, dt, memory
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1, 5, 10]
+    addresses_per_wallet = 200
+    print(f"{addresses_per_wallet} addresses per wallet")
+    print(f"{'wallets':>8} {'shared':>7} {'subscribe':>10} {'history':>8} {'tx.get':>8} {'time':>8} {'peak memory':>12}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in sizes:
+            for shared in (False, True):
+                num_requests, dt, memory = run(tmpdir, n, addresses_per_wallet, shared)
+                print(f"{n:>8} {str(shared):>7} {num_requests['blockchain.scripthash.subscribe']:>10} "
+                      f"{num_requests['blockchain.scripthash.get_history']:>8} "
+                      f"{num_requests['blockchain.transaction.get']:>8} {dt:>7.2f}s {memory / 2**20:>10.1f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Measures header chunk verification throughput: the per-header
+# dict-based checks (deserialize_header + verify_header) versus
+# Blockchain.verify_raw_headers working on the serialized chunk.
+# The headers are synthetic, mined against an easy target, and there
+# are as many of them as on mainnet by default.
+
+import sys
+import time
+
+from electrum.blockchain import Blockchain, HEADER_SIZE, deserialize_header, hash_header
+from electrum.crypto import sha256d
+
+
+# same as regtest: about every other hash is a valid PoW
+TARGET = 0x7fffff << (8 * (0x20 - 3))
+BITS = Blockchain.target_to_bits(TARGET)
+
+
+def make_headers(num_headers: int) -> bytes:
+    headers = bytearray()
+    prev_hash = bytes(32)
+    for i in range(num_headers):
+        header = bytearray(4 + 32 + 32 + 4 + 4 + 4)
+        header[0:4] = (0x20000000).to_bytes(4, 'little')
+        header[4:36] = prev_hash
+        header[36:68] = sha256d(b'%d' % i)
+        header[68:72] = (1_231_006_505 + 600 * i).to_bytes(4, 'little')
+        header[72:76] = BITS.to_bytes(4, 'little')
+        nonce = 0
+        while True:
+            header[76:80] = nonce.to_bytes(4, 'little')
+            h = sha256d(bytes(header))
+            if int.from_bytes(h, 'little') <= TARGET:
+                break
+            nonce += 1
+        headers += header
+        prev_hash = h
+    return bytes(headers)
+
+
+def verify_per_header(data: bytes, prev_hash: str, target: int) -> str:
+    for i in range(len(data) // HEADER_SIZE):
+        header = deserialize_header(data[i*HEADER_SIZE:(i+1)*HEADER_SIZE], i)
+        Blockchain.verify_header(header, prev_hash, target)
+        prev_hash = hash_header(header)
+    return prev_hash
+
+
+def verify_raw(data: bytes, prev_hash: str, target: int) -> str:
+    for i in range(0, len(data), 2016 * HEADER_SIZE):
+        prev_hash = Blockchain.verify_raw_headers(data[i:i + 2016*HEADER_SIZE], prev_hash, target)
+    return prev_hash
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 650_000
+    t0 = time.perf_counter()
+    data = make_headers(num_headers)
+    print(f"{num_headers} headers, {len(data) / 2**20:.1f}MB, generated in {time.perf_counter() - t0:.1f}s")
+    genesis_prev = '00' * 32
+    for name, f in (('per header', verify_per_header), ('raw', verify_raw)):
+        t0 = time.perf_counter()
+        tip = f(data, genesis_prev, TARGET)
+        dt = time.perf_counter() - t0
+        print(f"{name:>12}: {dt:.2f}s, {num_headers / dt:,.0f} headers/s, tip {tip}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Measures the time it takes to open a large wallet: parsing the file
+# into a WalletDB, and constructing the Wallet on top of it.
+# The wallet is a synthetic watch-only wallet with a given number of txs.
+
+import os
+import sys
+import json
+import time
+import tempfile
+
+from electrum.bitcoin import hash_to_segwit_addr
+from electrum.crypto import sha256
+from electrum.simple_config import SimpleConfig
+from electrum.storage import WalletStorage
+from electrum.wallet import Wallet
+from electrum.wallet_db import WalletDB, FINAL_SEED_VERSION
+
+
+# any tx will do: on load, transactions are not deserialized
+RAW_TX = ('0200000001f4eb2c5d1e5bb41e0a7a6f1c1cd9b2ef1ba2cd5b7e2d9f79b9d1ee0f6b61a5b30000000000fdffffff'
+          '01a08601000000000016001428f3a2d1e1b6b0e2e3c9fb5a3f8e3e4e06b06f8d00000000')
+
+
+def make_wallet_data(num_txs: int) -> dict:
+    num_addrs = max(1, num_txs // 10)
+    addrs = [hash_to_segwit_addr(sha256(b'%d' % i)[:20], witver=0) for i in range(num_addrs)]
+    txid = lambda i: sha256(b'tx%d' % i).hex()
+    data = {
+        'seed_version': FINAL_SEED_VERSION,
+        'wallet_type': 'imported',
+        'addresses': {addr: {} for addr in addrs},
+        'transactions': {},
+        'txi': {},
+        'txo': {},
+        'spent_outpoints': {},
+        'verified_tx3': {},
+        'addr_history': {addr: [] for addr in addrs},
+    }
+    for i in range(num_txs):
+        h = txid(i)
+        addr = addrs[i % num_addrs]
+        data['transactions'][h] = RAW_TX
+        data['txo'][h] = {addr: {'0': [100_000, False]}}
+        if i > 0:
+            prev = txid(i - 1)
+            prev_addr = addrs[(i - 1) % num_addrs]
+            data['txi'][h] = {prev_addr: {prev + ':0': 100_000}}
+            data['spent_outpoints'][prev] = {'0': h}
+            data['addr_history'][prev_addr].append([h, 600_000 + i])
+        data['verified_tx3'][h] = [600_000 + i, 1_600_000_000 + i, i, '00' * 32]
+        data['addr_history'][addr].append([h, 600_000 + i])
+    return data
+
+
+def main():
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'wallet')
+        with open(path, 'w') as f:
+            json.dump(make_wallet_data(num_txs), f)
+        config = SimpleConfig({'electrum_path': tmpdir})
+        t0 = time.perf_counter()
+        storage = WalletStorage(path)
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        t1 = time.perf_counter()
+        wallet = Wallet(db, storage, config=config)
+        t2 = time.perf_counter()
+        print(f"{num_txs} txs, file size {os.path.getsize(path)}")
+        print(f"WalletDB: {t1 - t0:.2f}s, Wallet: {t2 - t1:.2f}s, total: {t2 - t0:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#
+# Measures wallet save latency against wallet size: a full rewrite of
+# the wallet file versus appending only the changed keys.
+
+import os
+import sys
+import time
+import tempfile
+
+from electrum.storage import WalletStorage
+from electrum.wallet_db import WalletDB
+
+
+def make_db(num_txs: int) -> WalletDB:
+    db = WalletDB('', manual_upgrades=False)
+    txo = db.get_dict('txo')
+    verified_tx = db.get_dict('verified_tx3')
+    labels = db.get_dict('labels')
+    for i in range(num_txs):
+        txid = '%064x' % i
+        txo[txid] = {'bc1qaddress%d' % i: {'0': (100_000 + i, False)}}
+        verified_tx[txid] = (600_000 + i, 1_600_000_000 + i, i, '%064x' % (i + 1))
+        labels[txid] = 'payment %d' % i
+    return db
+
+
+def timed_write(db: WalletDB, storage: WalletStorage) -> float:
+    t0 = time.perf_counter()
+    db.write(storage)
+    return time.perf_counter() - t0
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1_000, 10_000, 100_000]
+    print(f"{'txs':>8} {'file size':>12} {'full write':>12} {'append':>12}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in sizes:
+            path = os.path.join(tmpdir, 'wallet_%d' % n)
+            storage = WalletStorage(path)
+            db = make_db(n)
+            t_full = timed_write(db, storage)
+            db.get_dict('labels')['%064x' % 0] = 'new label'
+            t_append = timed_write(db, storage)
+            size = os.path.getsize(path)
+            print(f"{n:>8} {size:>12} {t_full * 1000:>10.1f}ms {t_append * 1000:>10.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Restores a wallet of N addresses against a local fake server, and
+# reports the time it took to synchronize, the requests the server got
+# and the round trips the client made (requests are sent in batches).
+# Then synchronizes it again, after 1% of the addresses got a new tx:
+# only the histories whose status changed are requested.
+# The fake server is the one of bench_multi_wallet_sync.py.
+
+import sys
+import time
+import asyncio
+import tempfile
+from collections import defaultdict
+
+import aiorpcx
+
+from electrum.bitcoin import address_to_scripthash
+from electrum.interface import NotificationSession
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import Synchronizer
+from electrum.transaction import Transaction
+from electrum.wallet import restore_wallet_from_text
+
+from bench_multi_wallet_sync import make_raw_tx, make_server_data, session_factory, FakeInterface, FakeNetwork
+
+
+class CountingSession(NotificationSession):
+    num_round_trips = 0
+
+    async def send_request(self, *args, **kwargs):
+        CountingSession.num_round_trips += 1
+        return await super().send_request(*args, **kwargs)
+
+    async def send_batch_request(self, *args, **kwargs):
+        CountingSession.num_round_trips += 1
+        return await super().send_batch_request(*args, **kwargs)
+
+
+async def sync_wallet(config, wallet, histories, txs):
+    num_requests = defaultdict(int)
+    network = FakeNetwork(config)
+    interface = FakeInterface(network)
+    factory = session_factory(histories, txs, num_requests)
+    CountingSession.num_round_trips = 0
+    async with await aiorpcx.serve_rs(factory, 'localhost', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        client_factory = lambda *args, **kwargs: CountingSession(*args, interface=interface, **kwargs)
+        async with aiorpcx.connect_rs('localhost', port, session_factory=client_factory) as session:
+            interface.session = session
+            network.interface = interface
+            wallet.network = network
+            wallet.set_up_to_date(False)
+            t0 = time.perf_counter()
+            synchronizer = Synchronizer(wallet)
+            while not wallet.is_up_to_date():
+                await asyncio.sleep(0.01)
+            dt = time.perf_counter() - t0
+            await synchronizer.stop()
+            await interface.taskgroup.cancel_remaining()
+    return num_requests, CountingSession.num_round_trips, dt
+
+
+def print_row(name, num_requests, num_round_trips, dt):
+    print(f"{name:>10} {num_requests['blockchain.scripthash.subscribe']:>10} "
+          f"{num_requests['blockchain.scripthash.get_history']:>8} "
+          f"{num_requests['blockchain.transaction.get']:>8} {num_round_trips:>12} {dt:>7.2f}s")
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [300, 1000]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_addresses in sizes:
+            addresses, histories, txs = make_server_data(num_addresses)
+            config = SimpleConfig({'electrum_path': tmpdir})
+            wallet = restore_wallet_from_text(' '.join(addresses), path=f'{tmpdir}/wallet_{num_addresses}',
+                                              config=config)['wallet']
+            print(f"{num_addresses} addresses, {len(txs)} txs")
+            print(f"{'':>10} {'subscribe':>10} {'history':>8} {'tx.get':>8} {'round trips':>12} {'time':>8}")
+            loop = asyncio.get_event_loop()
+            print_row('restore', *loop.run_until_complete(sync_wallet(config, wallet, histories, txs)))
+            changed = addresses[:max(1, num_addresses // 100)]
+            raw_tx = make_raw_tx(num_addresses, changed)
+            txid = Transaction(raw_tx).txid()
+            txs[txid] = raw_tx
+            for addr in changed:
+                histories[address_to_scripthash(addr)].append({'tx_hash': txid, 'height': 100 + num_addresses})
+            print_row('reconnect', *loop.run_until_complete(sync_wallet(config, wallet, histories, txs)))
+
+
+if __name__ == '__main__':
+    main()
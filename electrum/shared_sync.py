@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Synchronization state shared by all the wallets of a Network.
+
+A daemon may have many wallets open, each with its own Synchronizer and
+SPV. Wallets often have transactions in common (e.g. a payment from one
+to another, or several watch-only views of the same keys), which would
+then be downloaded and SPV-verified once per wallet. SharedSync sits
+between those jobs and the server:
+
+- raw transactions and merkle proofs are kept in LRU caches, so the
+  second wallet asking for them does not go to the server. If
+  'tx_cache_size' is set, raw txs are also written to an on-disk cache
+  (see tx_cache.TxCache), which is consulted before asking the server,
+  and survives restarts. It is off by default: the files are not
+  encrypted, and would reveal the history of encrypted wallets,
+- a request for an item that another wallet is already fetching waits
+  for that request instead of sending a new one. This also applies to
+  the history of an address watched by several wallets, keyed by the
+  status the history was requested for.
+
+Only data that a wallet has validated is cached: the txid of a raw tx
+was checked, and a merkle proof was verified against a header of our
+chain. Cached proofs are only served while that header is still in the
+chain, so a reorg simply turns them into misses.
+
+Scripthash subscriptions are shared at the session level, see
+NotificationSession.subscribe.
+"""
+
+import os
+import asyncio
+from collections import OrderedDict
+from typing import (Sequence, List, Dict, Tuple, Union, Callable, Awaitable, Hashable,
+                    Any, Optional, TYPE_CHECKING)
+
+from aiorpcx import run_in_thread
+from aiorpcx.jsonrpc import RPCError
+
+from .logging import Logger
+from .tx_cache import TxCache
+
+if TYPE_CHECKING:
+    from .network import Network, UntrustedServerReturnedError
+    from .interface import Interface
+    from .blockchain import Blockchain
+
+
+DEFAULT_TX_MEMORY_CACHE_SIZE = 5 * 1024 * 1024  # in bytes of hex
+DEFAULT_PROOF_CACHE_SIZE = 10_000  # number of proofs
+
+_FAILED = object()  # result of a fetch that raised
+
+
+class SharedSync(Logger):
+
+    def __init__(self, network: 'Network'):
+        Logger.__init__(self)
+        self.network = network
+        config = network.config
+        self.enabled = config.get('network_shared_sync', True)
+        self.max_tx_cache_size = config.get('network_tx_cache_size', DEFAULT_TX_MEMORY_CACHE_SIZE)
+        self.max_proof_cache_size = config.get('network_proof_cache_size', DEFAULT_PROOF_CACHE_SIZE)
+        self._txs = OrderedDict()  # type: OrderedDict[str, str]  # txid -> raw tx, least recently used first
+        self._txs_size = 0
+        self._proofs = OrderedDict()  # type: OrderedDict[str, Tuple[str, dict]]  # txid -> (header hash, proof)
+        tx_cache_size = config.get('tx_cache_size', 0)  # bytes on disk
+        self.tx_cache = None  # type: Optional[TxCache]
+        if self.enabled and tx_cache_size:
+            self.tx_cache = TxCache(os.path.join(config.path, 'tx_cache'), tx_cache_size)
+        self._pending_txs = {}  # type: Dict[str, asyncio.Future]
+        self._pending_proofs = {}  # type: Dict[Tuple[str, int], asyncio.Future]
+        self._pending_histories = {}  # type: Dict[Tuple[str, str], asyncio.Future]
+        self.txs_requested = 0
+        self.txs_fetched = 0
+        self.proofs_requested = 0
+        self.proofs_fetched = 0
+
+    def get_stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'txs_in_memory': len(self._txs),
+            'tx_memory_size': self._txs_size,
+            'txs_requested': self.txs_requested,
+            'txs_fetched': self.txs_fetched,
+            'proofs_cached': len(self._proofs),
+            'proofs_requested': self.proofs_requested,
+            'proofs_fetched': self.proofs_fetched,
+            'tx_cache': self.tx_cache.get_stats() if self.tx_cache is not None else None,
+        }
+
+    def clear(self) -> None:
+        self._txs.clear()
+        self._txs_size = 0
+        self._proofs.clear()
+
+    async def _fetch_once(self, keys: Sequence[Hashable], pending: Dict[Hashable, asyncio.Future],
+                          fetch: Callable[[List], Awaitable[Sequence[Any]]]) -> Dict[Hashable, Any]:
+        """Returns {key: result} where results are obtained with
+        a single call to fetch(list_of_keys), except for the keys that
+        another caller is already fetching: their results are shared.
+        """
+        loop = asyncio.get_event_loop()
+        to_fetch = {}  # type: Dict[Hashable, asyncio.Future]
+        waiting = {}  # type: Dict[Hashable, asyncio.Future]
+        for key in keys:
+            if key in pending:
+                waiting[key] = pending[key]
+            else:
+                to_fetch[key] = pending[key] = loop.create_future()
+        results = {}
+        if to_fetch:
+            try:
+                results.update(zip(to_fetch, await fetch(list(to_fetch))))
+            finally:
+                for key, fut in to_fetch.items():
+                    del pending[key]
+                    fut.set_result(results.get(key, _FAILED))
+        retry = []
+        for key, fut in waiting.items():
+            # shield: if we get cancelled, the other caller should still get its result
+            res = await asyncio.shield(fut)
+            if res is _FAILED:
+                retry.append(key)
+            else:
+                results[key] = res
+        if retry:
+            # the other caller failed (e.g. its interface went away). try ourselves
+            results.update(await self._fetch_once(retry, pending, fetch))
+        return results
+
+    # transactions
+
+    async def get_cached_txs(self, tx_hashes: Sequence[str]) -> Dict[str, str]:
+        """Returns the raw txs we have in memory or on disk, as {tx_hash: raw_tx}."""
+        if not self.enabled:
+            return {}
+        results = {}
+        missing = []
+        for tx_hash in tx_hashes:
+            raw_tx = self._txs.get(tx_hash)
+            if raw_tx is not None:
+                self._txs.move_to_end(tx_hash)
+                results[tx_hash] = raw_tx
+            else:
+                missing.append(tx_hash)
+        if missing and self.tx_cache is not None:
+            tx_cache = self.tx_cache
+            raw_txs = await run_in_thread(lambda: [tx_cache.get(tx_hash) for tx_hash in missing])
+            for tx_hash, raw_tx in zip(missing, raw_txs):
+                if raw_tx is not None:
+                    self._add_tx_to_memory(tx_hash, raw_tx)
+                    results[tx_hash] = raw_tx
+        return results
+
+    async def add_tx(self, tx_hash: str, raw_tx: str) -> None:
+        """Caches a raw tx. The caller must have checked that tx_hash is its txid."""
+        if not self.enabled:
+            return
+        self._add_tx_to_memory(tx_hash, raw_tx)
+        if self.tx_cache is not None:
+            await run_in_thread(self.tx_cache.put, tx_hash, raw_tx)
+
+    def _add_tx_to_memory(self, tx_hash: str, raw_tx: str) -> None:
+        if tx_hash in self._txs or len(raw_tx) > self.max_tx_cache_size:
+            return
+        self._txs[tx_hash] = raw_tx
+        self._txs_size += len(raw_tx)
+        while self._txs_size > self.max_tx_cache_size:
+            _, evicted = self._txs.popitem(last=False)
+            self._txs_size -= len(evicted)
+
+    async def get_transactions(self, interface: 'Interface', tx_hashes: Sequence[str]) -> List[Union[str, RPCError]]:
+        """Same as interface.get_transactions, but served from the cache when possible.
+        Note: results that were not cached are untrusted, as with the interface.
+        """
+        if not self.enabled:
+            return await interface.get_transactions(tx_hashes)
+        self.txs_requested += len(tx_hashes)
+        results = await self.get_cached_txs(tx_hashes)  # type: Dict[str, Union[str, RPCError]]
+        missing = [tx_hash for tx_hash in tx_hashes if tx_hash not in results]
+        if missing:
+            async def fetch(keys):
+                self.txs_fetched += len(keys)
+                return await interface.get_transactions(keys)
+            results.update(await self._fetch_once(missing, self._pending_txs, fetch))
+        return [results[tx_hash] for tx_hash in tx_hashes]
+
+    # address histories
+
+    async def get_histories(self, interface: 'Interface',
+                            scripthashes_and_statuses: Sequence[Tuple[str, str]]) -> List[Union[list, RPCError]]:
+        """Same as interface.get_history_for_scripthashes, for given (scripthash, status) pairs.
+        Histories are not cached, but concurrent requests for the same status are only sent once.
+        """
+        if not self.enabled:
+            return await interface.get_history_for_scripthashes([sh for sh, status in scripthashes_and_statuses])
+        async def fetch(keys):
+            return await interface.get_history_for_scripthashes([sh for sh, status in keys])
+        results = await self._fetch_once(scripthashes_and_statuses, self._pending_histories, fetch)
+        return [results[key] for key in scripthashes_and_statuses]
+
+    # merkle proofs
+
+    def _get_cached_proof(self, tx_hash: str, tx_height: int, chain: 'Blockchain') -> Optional[dict]:
+        item = self._proofs.get(tx_hash)
+        if item is None:
+            return None
+        header_hash, proof = item
+        if proof['block_height'] != tx_height or not chain.check_hash(tx_height, header_hash):
+            return None
+        self._proofs.move_to_end(tx_hash)
+        return proof
+
+    def add_verified_proof(self, tx_hash: str, header_hash: str, proof: dict) -> None:
+        """Caches a merkle proof that was verified against the block header with given hash."""
+        if not self.enabled:
+            return
+        self._proofs[tx_hash] = (header_hash, proof)
+        self._proofs.move_to_end(tx_hash)
+        while len(self._proofs) > self.max_proof_cache_size:
+            self._proofs.popitem(last=False)
+
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List[Union[dict, 'UntrustedServerReturnedError']]:
+        """Same as network.get_merkle_for_transactions, but served from the cache when possible."""
+        if not self.enabled:
+            return await self.network.get_merkle_for_transactions(txs)
+        self.proofs_requested += len(txs)
+        chain = self.network.blockchain()
+        results = {}  # type: Dict[Tuple[str, int], Union[dict, UntrustedServerReturnedError]]
+        missing = []
+        for tx_hash, tx_height in txs:
+            proof = self._get_cached_proof(tx_hash, tx_height, chain)
+            if proof is not None:
+                results[(tx_hash, tx_height)] = proof
+            else:
+                missing.append((tx_hash, tx_height))
+        if missing:
+            async def fetch(keys):
+                self.proofs_fetched += len(keys)
+                return await self.network.get_merkle_for_transactions(keys)
+            results.update(await self._fetch_once(missing, self._pending_proofs, fetch))
+        return [results[(tx_hash, tx_height)] for tx_hash, tx_height in txs]
@@ -74,6 +74,8 @@ class WalletStorage(Logger):
         else:
             self.raw = ''
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        # file size, and file size after the last full write
+        self.pos = self.init_pos = len(self.raw)
 
     def read(self):
         return self.decrypted if self.is_encrypted() else self.raw
@@ -98,8 +100,34 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self.pos = self.init_pos = len(s)
         self.logger.info(f"saved {self.path}")
 
+    @profiler
+    def append(self, data: str) -> None:
+        """Appends data to the end of the wallet file.
+        Only for plaintext files: encrypted files are always rewritten.
+        """
+        assert not self.is_encrypted()
+        assert self.file_exists()
+        size = os.path.getsize(self.path)
+        try:
+            with open(self.path, "a", encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            # do not leave an incomplete patch in front of the next ones
+            os.truncate(self.path, size)
+            raise
+        self.pos += len(data)
+
+    def needs_consolidation(self) -> bool:
+        """Whether the appended changes outgrew the last full write,
+        in which case the file should be rewritten from scratch.
+        """
+        return self.pos > 2 * self.init_pos
+
     def file_exists(self) -> bool:
         return self._file_exists
 
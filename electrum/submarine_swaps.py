@@ -307,6 +307,8 @@ class SwapManager(Logger):
         )
         self.swaps[payment_hash.hex()] = swap
         self.add_lnwatcher_callback(swap)
+        # we need the swap data to get a refund: save it before funding
+        self.wallet.save_db(flush=True)
         await self.network.broadcast_transaction(tx)
         return tx.txid()
 
@@ -400,6 +402,8 @@ class SwapManager(Logger):
         self.swaps[preimage_hash.hex()] = swap
         # add callback to lnwatcher
         self.add_lnwatcher_callback(swap)
+        # we need the swap data to claim the funds: save it before paying
+        self.wallet.save_db(flush=True)
         # initiate payment.
         if fee_invoice:
             self.prepayments[prepay_hash] = preimage_hash
@@ -24,7 +24,7 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple
+from typing import Dict, List, TYPE_CHECKING, Tuple, Sequence
 from collections import defaultdict
 import logging
 
@@ -58,6 +58,10 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
     """
+
+    # max number of requests sent in a single JSON-RPC batch
+    MAX_REQUESTS_PER_BATCH = 100
+
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
         self._reset_request_counters()
@@ -100,29 +104,44 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         """Handle the change of the status of an address."""
         raise NotImplementedError()  # implemented by subclasses
 
+    async def _on_address_statuses(self, statuses: Dict[str, str]):
+        """Handle the change of the status of several addresses (addr -> status)."""
+        for addr, status in statuses.items():
+            await self.taskgroup.spawn(self._on_address_status, addr, status)
+
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
+        async def subscribe_to_addresses(addrs):
+            hashes = [address_to_scripthash(addr) for addr in addrs]
+            for h, addr in zip(hashes, addrs):
+                self.scripthash_to_address[h] = addr
+            self._requests_sent += len(addrs)
             try:
-                await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
+                await self.session.subscribe_batch('blockchain.scripthash.subscribe', [[h] for h in hashes], self.status_queue)
             except RPCError as e:
                 if e.message == 'history too large':  # no unique error code
                     raise GracefulDisconnect(e, log_level=logging.ERROR) from e
                 raise
-            self._requests_answered += 1
-            self.requested_addrs.remove(addr)
+            self._requests_answered += len(addrs)
+            self.requested_addrs.difference_update(addrs)
+            self._wakeup.set()
 
         while True:
-            addr = await self.add_queue.get()
-            await self.taskgroup.spawn(subscribe_to_address, addr)
+            # subscribe to all addresses added so far in one go
+            addrs = [await self.add_queue.get()]
+            while len(addrs) < self.MAX_REQUESTS_PER_BATCH and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            await self.taskgroup.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
+            # handle all pending notifications together;
+            # if the status of an address changed several times, only the last one matters
             h, status = await self.status_queue.get()
-            addr = self.scripthash_to_address[h]
-            await self.taskgroup.spawn(self._on_address_status, addr, status)
+            statuses = {self.scripthash_to_address[h]: status}
+            while not self.status_queue.empty():
+                h, status = self.status_queue.get_nowait()
+                statuses[self.scripthash_to_address[h]] = status
+            await self.taskgroup.spawn(self._on_address_statuses, statuses)
             self._processed_some_notifications = True
 
     def num_requests_sent_and_answered(self) -> Tuple[int, int]:
@@ -158,37 +177,53 @@ class Synchronizer(SynchronizerBase):
                 and not self.requested_tx)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
-            return
-        if (addr, status) in self.requested_histories:
-            return
-        # request address history
-        self.requested_histories.add((addr, status))
-        h = address_to_scripthash(addr)
-        self._requests_sent += 1
-        result = await self.interface.get_history_for_scripthash(h)
-        self._requests_answered += 1
-        self.logger.info(f"receiving history {addr} {len(result)}")
-        hashes = set(map(lambda item: item['tx_hash'], result))
-        hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
-        # tx_fees
-        tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
-        tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
-        # Check that txids are unique
-        if len(hashes) != len(result):
-            self.logger.info(f"error: server history has non-unique txids: {addr}")
-        # Check that the status corresponds to what was announced
-        elif history_status(hist) != status:
-            self.logger.info(f"error: status mismatch: {addr}")
-        else:
-            # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
-            # Request transactions we don't have
-            await self._request_missing_txs(hist)
-
-        # Remove request; this allows up_to_date to be True
-        self.requested_histories.discard((addr, status))
+        await self._on_address_statuses({addr: status})
+
+    async def _on_address_statuses(self, statuses: Dict[str, str]):
+        to_request = []  # type: List[Tuple[str, str]]
+        for addr, status in statuses.items():
+            if self.wallet.get_address_history_status(addr) == status:
+                continue
+            if (addr, status) in self.requested_histories:
+                continue
+            self.requested_histories.add((addr, status))
+            to_request.append((addr, status))
+        # request address histories
+        for i in range(0, len(to_request), self.MAX_REQUESTS_PER_BATCH):
+            await self.taskgroup.spawn(self._request_histories, to_request[i:i + self.MAX_REQUESTS_PER_BATCH])
+        self._wakeup.set()
+
+    async def _request_histories(self, addrs_and_statuses: Sequence[Tuple[str, str]]):
+        scripthashes = [(address_to_scripthash(addr), status) for addr, status in addrs_and_statuses]
+        self._requests_sent += len(scripthashes)
+        results = await self.network.shared_sync.get_histories(self.interface, scripthashes)
+        self._requests_answered += len(scripthashes)
+        missing_txs = []
+        for (addr, status), result in zip(addrs_and_statuses, results):
+            if isinstance(result, Exception):
+                raise result
+            self.logger.info(f"receiving history {addr} {len(result)}")
+            hashes = set(map(lambda item: item['tx_hash'], result))
+            hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
+            # tx_fees
+            tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
+            tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
+            # Check that txids are unique
+            if len(hashes) != len(result):
+                self.logger.info(f"error: server history has non-unique txids: {addr}")
+            # Check that the status corresponds to what was announced
+            elif history_status(hist) != status:
+                self.logger.info(f"error: status mismatch: {addr}")
+            else:
+                # Store received history
+                self.wallet.receive_history_callback(addr, hist, tx_fees, status=status)
+                missing_txs += hist
+        # Request transactions we don't have
+        await self._request_missing_txs(missing_txs)
+        # Remove requests; this allows up_to_date to be True
+        for addr, status in addrs_and_statuses:
+            self.requested_histories.discard((addr, status))
+        self._wakeup.set()
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -204,46 +239,52 @@ class Synchronizer(SynchronizerBase):
 
         if not transaction_hashes: return
         async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
+            for i in range(0, len(transaction_hashes), self.MAX_REQUESTS_PER_BATCH):
+                await group.spawn(self._get_transactions(transaction_hashes[i:i + self.MAX_REQUESTS_PER_BATCH],
+                                                         allow_server_not_finding_tx=allow_server_not_finding_tx))
 
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        self._requests_sent += 1
+    async def _get_transactions(self, tx_hashes: Sequence[str], *, allow_server_not_finding_tx=False):
+        self._requests_sent += len(tx_hashes)
         try:
-            raw_tx = await self.interface.get_transaction(tx_hash)
-        except RPCError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
+            results = await self.network.shared_sync.get_transactions(self.interface, tx_hashes)
         finally:
-            self._requests_answered += 1
-        tx = Transaction(raw_tx)
-        if tx_hash != tx.txid():
-            raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
-        tx_height = self.requested_tx.pop(tx_hash)
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(raw_tx)}")
-        # callbacks
-        util.trigger_callback('new_transaction', self.wallet, tx)
+            self._requests_answered += len(tx_hashes)
+        for tx_hash, raw_tx in zip(tx_hashes, results):
+            if isinstance(raw_tx, RPCError):
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx:
+                    self.requested_tx.pop(tx_hash)
+                    continue
+                else:
+                    raise raw_tx
+            tx = Transaction(raw_tx)
+            if tx_hash != tx.txid():
+                raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
+            await self.network.shared_sync.add_tx(tx_hash, raw_tx)
+            tx_height = self.requested_tx.pop(tx_hash)
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(raw_tx)}")
+            # callbacks
+            util.trigger_callback('new_transaction', self.wallet, tx)
+        self._wakeup.set()
 
     async def main(self):
         self.wallet.set_up_to_date(False)
         # request missing txns, if any
+        missing_txs = []
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
             # Old electrum servers returned ['*'] when all history for the address
             # was pruned. This no longer happens but may remain in old wallets.
             if history == ['*']: continue
-            await self._request_missing_txs(history, allow_server_not_finding_tx=True)
+            missing_txs += history
+        await self._request_missing_txs(missing_txs, allow_server_not_finding_tx=True)
         # add addresses to bootstrap
         for addr in random_shuffled_copy(self.wallet.get_addresses()):
             await self._add_address(addr)
-        # main loop
+        # main loop: runs whenever our requests progressed
         while True:
-            await asyncio.sleep(0.1)
+            self._wakeup.clear()
             await run_in_thread(self.wallet.synchronize)
             up_to_date = self.is_up_to_date()
             if (up_to_date != self.wallet.is_up_to_date()
@@ -253,6 +294,7 @@ class Synchronizer(SynchronizerBase):
                     self._reset_request_counters()
                 self.wallet.set_up_to_date(up_to_date)
                 util.trigger_callback('wallet_updated', self.wallet)
+            await self._wakeup.wait()
 
 
 class Notifier(SynchronizerBase):
@@ -216,6 +216,29 @@ class Test_bitcoin(ElectrumTestCase):
             self.assertEqual(plaintext, key.decrypt_message(ciphertext2))
             self.assertNotEqual(ciphertext1, ciphertext2)
 
+    def test_verify_signatures(self):
+        keys = [ecc.ECPrivkey(sha256d(b'key %d' % i)) for i in range(3)]
+        items = []
+        for i in range(10):
+            key = keys[i % 3]
+            h = sha256d(b'msg %d' % i)
+            items.append((key.get_public_key_bytes(), key.sign(h, ecc.sig_string_from_r_and_s), h))
+        pubkey, sig, h = items[0]
+        bad_items = [
+            (pubkey, sig, sha256d(b'other msg')),                  # wrong message
+            (keys[1].get_public_key_bytes(), sig, h),              # wrong pubkey
+            (keys[0].get_public_key_bytes(compressed=False), sig, h),  # uncompressed pubkey is fine
+            (b'\x02' + bytes(32), sig, h),                        # not a point
+            (None, sig, h),
+            (pubkey, sig[:63], h),                                 # bad lengths
+            (pubkey, sig, h[:31]),
+            (pubkey, b'\xff' * 64, h),                            # sig does not parse
+        ]
+        expected = [True] * 10 + [False, False, True, False, False, False, False, False]
+        self.assertEqual(expected, ecc.verify_signatures(items + bad_items))
+        self.assertEqual(expected, [ecc.verify_signature(*item) for item in items + bad_items])
+        self.assertEqual([], ecc.verify_signatures([]))
+
     def test_sign_transaction(self):
         eckey1 = ecc.ECPrivkey(bfh('7e1255fddb52db1729fc3ceb21a46f95b8d9fe94cc83425e936a6c5223bb679d'))
         sig1 = eckey1.sign_transaction(bfh('5a548b12369a53faaa7e51b5081829474ebdd9c924b3a8230b69aa0be254cd94'))
@@ -1,10 +1,11 @@
 import shutil
 import tempfile
 import os
+from unittest import mock
 
 from electrum import constants, blockchain
 from electrum.simple_config import SimpleConfig
-from electrum.blockchain import Blockchain, deserialize_header, hash_header
+from electrum.blockchain import Blockchain, deserialize_header, hash_header, serialize_header, HeaderView
 from electrum.util import bh2u, bfh, make_dir
 
 from . import ElectrumTestCase
@@ -66,6 +67,79 @@ class TestBlockchain(ElectrumTestCase):
         self.assertTrue(chain.can_connect(header))
         chain.save_header(header)
 
+    def test_cached_hashes_follow_writes(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        for name in 'ABCDEFO':
+            self._append_header(chain, self.HEADERS[name])
+        self.assertEqual(hash_header(self.HEADERS['O']), chain.get_hash(6))
+        self.assertEqual(hash_header(self.HEADERS['O']), chain.read_header_view(6).hash())
+        # replace the tip
+        chain.write(bfh(serialize_header(self.HEADERS['G'])), 6 * 80)
+        self.assertEqual(hash_header(self.HEADERS['G']), chain.get_hash(6))
+        self.assertEqual(self.HEADERS['G'], chain.read_header(6))
+        # truncate
+        chain.write(b'', 5 * 80)
+        self.assertEqual(4, chain.height())
+        self.assertIsNone(chain.read_header_view(5))
+        with self.assertRaises(blockchain.MissingHeader):
+            chain.get_hash(5)
+
+    def test_cached_hashes_are_bounded(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        for name in 'ABCDEFO':
+            self._append_header(chain, self.HEADERS[name])
+        chain._hashes.clear()
+        with mock.patch.object(blockchain, 'MAX_CACHED_HASHES', 3):
+            for height in (1, 2, 3, 1, 4):
+                chain.get_hash(height)
+            # 2 was the least recently used
+            self.assertEqual([3, 1, 4], list(chain._hashes))
+            self.assertEqual(hash_header(self.HEADERS['C']), chain.get_hash(2))
+            self.assertEqual([1, 4, 2], list(chain._hashes))
+
+    def test_invalid_tail_truncated_on_startup(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        with mock.patch.object(blockchain.os, 'fsync') as fsync:
+            for name in 'ABCDEF':
+                self._append_header(chain, self.HEADERS[name])
+            self.assertEqual(0, fsync.call_count)
+            chain.sync_headers_file()
+            self.assertEqual(1, fsync.call_count)
+        # a crash garbled some of the headers written after the last fsync
+        chain.write(bfh(serialize_header(self.HEADERS['O']) + 'ff' * 80 + serialize_header(self.HEADERS['P'])), 6 * 80)
+        self.assertEqual(8, chain.height())
+        blockchain.blockchains = {}
+        blockchain.read_blockchains(self.config)
+        chain = blockchain.get_best_chain()
+        self.assertEqual(6, chain.height())
+        self.assertEqual(hash_header(self.HEADERS['O']), chain.get_hash(6))
+
+    def test_verify_chunk(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        self._append_header(chain, self.HEADERS['A'])
+        chunk = bfh(''.join(serialize_header(self.HEADERS[name]) for name in 'ABCDEF'))
+        chain.verify_chunk(0, chunk)
+        # headers we already have must match
+        self._append_header(chain, self.HEADERS['B'])
+        self._append_header(chain, self.HEADERS['C'])
+        chain.write(bfh(serialize_header(self.HEADERS['L'])), 2 * 80)
+        with self.assertRaises(Exception):
+            chain.verify_chunk(0, chunk)
+        with self.assertRaises(Exception):
+            chain.verify_chunk(0, bfh(''.join(serialize_header(self.HEADERS[name]) for name in 'ABDE')))
+
     def test_get_height_of_last_common_block_with_chain(self):
         blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
             config=self.config, forkpoint=0, parent=None,
@@ -399,6 +473,13 @@ class TestVerifyHeader(ElectrumTestCase):
     def test_valid_header(self):
         Blockchain.verify_header(self.header, self.prev_hash, self.target)
 
+    def test_header_view(self):
+        view = HeaderView(bfh(self.valid_header), 100)
+        self.assertEqual(self.header, view.to_dict())
+        for key in ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce', 'block_height'):
+            self.assertEqual(self.header[key], getattr(view, key))
+        self.assertEqual(hash_header(self.header), view.hash())
+
     def test_expected_hash_mismatch(self):
         with self.assertRaises(Exception):
             Blockchain.verify_header(self.header, self.prev_hash, self.target,
@@ -417,3 +498,21 @@ class TestVerifyHeader(ElectrumTestCase):
         with self.assertRaises(Exception):
             self.header["nonce"] = 42
             Blockchain.verify_header(self.header, self.prev_hash, self.target)
+
+    def test_raw_headers(self):
+        raw = bfh(self.valid_header)
+        self.assertEqual(hash_header(self.header),
+                         Blockchain.verify_raw_headers(raw, self.prev_hash, self.target))
+        Blockchain.verify_raw_headers(raw, self.prev_hash, self.target,
+                                      expected_hashes={0: hash_header(self.header)})
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(raw, self.prev_hash, self.target, expected_hashes={0: "00" * 32})
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(raw, "00" * 32, self.target)
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(raw, self.prev_hash, Blockchain.bits_to_target(0x1d00eeee))
+        with self.assertRaises(Exception):
+            self.header["nonce"] = 42
+            Blockchain.verify_raw_headers(bfh(serialize_header(self.header)), self.prev_hash, self.target)
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(raw[:-1], self.prev_hash, self.target)
@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from unittest import mock
+
+from electrum.channel_db import ChannelDB, ChannelInfo, Policy, NodeInfo, sort_channels_for_loading, LEGACY_DB_GRACE_PERIOD
+from electrum import util
+from electrum.constants import BitcoinTestnet
+from electrum.lnmsg import encode_msg, decode_msg
+from electrum.lnrouter import LNPathFinder
+from electrum.lnutil import ShortChannelID, LNPeerAddr
+from electrum.simple_config import SimpleConfig
+from electrum.sql_db import sql
+from electrum.util import create_and_start_event_loop, get_headers_dir
+
+from . import TestCaseForTestnet
+
+
+def make_gossip(i: int):
+    """Returns a channel_announcement, a channel_update and a node_announcement (unsigned)."""
+    node_ids = sorted([bytes([2]) + bytes([i]) * 32, bytes([3]) + bytes([i]) * 32])
+    short_channel_id = ShortChannelID.from_components(600_000 + i, 1, 0)
+    chan_ann = encode_msg('channel_announcement', len=0, features=b'', chain_hash=BitcoinTestnet.rev_genesis_bytes(),
+                          short_channel_id=short_channel_id, node_id_1=node_ids[0], node_id_2=node_ids[1],
+                          bitcoin_key_1=node_ids[0], bitcoin_key_2=node_ids[1])
+    chan_upd = encode_msg('channel_update', chain_hash=BitcoinTestnet.rev_genesis_bytes(),
+                          short_channel_id=short_channel_id, timestamp=1_600_000_000 + i, message_flags=b'\x01',
+                          channel_flags=b'\x01', cltv_expiry_delta=40 + i, htlc_minimum_msat=1000,
+                          fee_base_msat=1000 + i, fee_proportional_millionths=i, htlc_maximum_msat=2**64 - 1)
+    node_ann = encode_msg('node_announcement', flen=0, features=b'', timestamp=1_600_000_000 + i,
+                          node_id=node_ids[1], rgb_color=b'\x00' * 3, alias=b'node %d' % i + bytes(32 - len(b'node %d' % i)),
+                          addrlen=0, addresses=b'')
+    return chan_ann, chan_upd, node_ann
+
+
+def make_channel_gossip(i: int, node1_id: bytes, node2_id: bytes):
+    """Returns a channel_announcement and a channel_update in each direction (unsigned)."""
+    short_channel_id = ShortChannelID.from_components(700_000 + i, 1, 0)
+    chan_ann = encode_msg('channel_announcement', len=0, features=b'', chain_hash=BitcoinTestnet.rev_genesis_bytes(),
+                          short_channel_id=short_channel_id, node_id_1=node1_id, node_id_2=node2_id,
+                          bitcoin_key_1=node1_id, bitcoin_key_2=node2_id)
+    chan_upds = [encode_msg('channel_update', chain_hash=BitcoinTestnet.rev_genesis_bytes(),
+                            short_channel_id=short_channel_id, timestamp=1_600_000_000, message_flags=b'\x01',
+                            channel_flags=bytes([direction]), cltv_expiry_delta=40, htlc_minimum_msat=1000,
+                            fee_base_msat=1000, fee_proportional_millionths=1, htlc_maximum_msat=10**10)
+                 for direction in range(2)]
+    return chan_ann, chan_upds
+
+
+class TestChannelDB(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.legacy_path = os.path.join(get_headers_dir(self.config), 'gossip_db')
+        self._channel_dbs = []
+        # load_data triggers callbacks from the sql thread
+        patcher = mock.patch.object(util.callback_mgr, 'asyncio_loop', self.asyncio_loop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        for cdb in self._channel_dbs:
+            cdb.sql_thread.join(timeout=1)
+        super().tearDown()
+
+    def _create_channel_db(self) -> ChannelDB:
+        class fake_network:
+            config = self.config
+            asyncio_loop = self.asyncio_loop
+            trigger_callback = lambda *args: None
+            register_callback = lambda *args: None
+            interface = None
+        cdb = ChannelDB(fake_network())
+        self._channel_dbs.append(cdb)
+        return cdb
+
+    def _wait(self, fut):
+        async def wait():
+            return await fut
+        return asyncio.run_coroutine_threadsafe(wait(), self.asyncio_loop).result(timeout=5)
+
+    def _expected_data(self, msgs):
+        channels, policies, nodes = {}, {}, {}
+        for chan_ann, chan_upd, node_ann in msgs:
+            ci = ChannelInfo.from_raw_msg(chan_ann)
+            channels[ci.short_channel_id] = ci
+            p = Policy.from_raw_msg(ci.short_channel_id + ci.node2_id, chan_upd)
+            policies[(p.start_node, p.short_channel_id)] = p
+            node_info, _ = NodeInfo.from_raw_msg(node_ann)
+            nodes[node_info.node_id] = node_info
+        return channels, policies, nodes
+
+    def test_import_legacy_database(self):
+        msgs = [make_gossip(i) for i in range(5)]
+        # database as created by previous versions: raw messages only
+        os.makedirs(os.path.dirname(self.legacy_path), exist_ok=True)
+        conn = sqlite3.connect(self.legacy_path)
+        conn.execute("CREATE TABLE channel_info (short_channel_id BLOB(8), msg BLOB, PRIMARY KEY(short_channel_id))")
+        conn.execute("CREATE TABLE policy (key BLOB(41), msg BLOB, PRIMARY KEY(key))")
+        conn.execute("CREATE TABLE node_info (node_id BLOB(33), msg BLOB, PRIMARY KEY(node_id))")
+        for chan_ann, chan_upd, node_ann in msgs:
+            ci = ChannelInfo.from_raw_msg(chan_ann)
+            conn.execute("INSERT INTO channel_info VALUES (?,?)", (ci.short_channel_id, chan_ann))
+            conn.execute("INSERT INTO policy VALUES (?,?)", (ci.short_channel_id + ci.node2_id, chan_upd))
+            conn.execute("INSERT INTO node_info VALUES (?,?)", (ci.node2_id, node_ann))
+        conn.execute("INSERT INTO policy VALUES (?,?)", (bytes(41), b'\x01\x02garbage'))
+        # a node with features we do not understand
+        bad_node_id = bytes([3]) + bytes([99]) * 32
+        bad_node_ann = encode_msg('node_announcement', flen=13, features=(1 << 100).to_bytes(13, 'big'),
+                                  timestamp=1_600_000_000, node_id=bad_node_id, rgb_color=b'\x00' * 3,
+                                  alias=bytes(32), addrlen=0, addresses=b'')
+        conn.execute("INSERT INTO node_info VALUES (?,?)", (bad_node_id, bad_node_ann))
+        conn.commit()
+        legacy_rows = {table: conn.execute(f"SELECT * FROM {table}").fetchall()
+                       for table in ('channel_info', 'policy', 'node_info')}
+        conn.close()
+        cdb = self._create_channel_db()
+        self._wait(cdb.load_data())
+        channels, policies, nodes = self._expected_data(msgs)
+        self.assertEqual(channels, cdb._channels)
+        self.assertEqual({k: p._replace(htlc_maximum_msat=2**63 - 1) for k, p in policies.items()}, cdb._policies)
+        self.assertEqual(nodes, cdb._nodes)
+        # u64 amounts that do not fit in sqlite are capped
+        self.assertEqual({2**63 - 1}, {p.htlc_maximum_msat for p in cdb._policies.values()})
+        # the raw messages are kept, the invalid row is gone
+        rows = self._wait(sql(lambda self: self.conn.execute("SELECT key, msg, timestamp FROM policy").fetchall())(cdb))
+        self.assertEqual(sorted(chan_upd for _, chan_upd, _ in msgs), sorted(msg for key, msg, timestamp in rows))
+        self.assertTrue(all(timestamp is not None for key, msg, timestamp in rows))
+        # the node with unknown features is not loaded, but kept
+        rows = self._wait(sql(lambda self: self.conn.execute("SELECT node_id, timestamp FROM node_info").fetchall())(cdb))
+        self.assertIn((bad_node_id, 1_600_000_000), rows)
+        # the old database is left as it was, for older versions
+        conn = sqlite3.connect(self.legacy_path)
+        for table, expected_rows in legacy_rows.items():
+            self.assertEqual(expected_rows, conn.execute(f"SELECT * FROM {table}").fetchall())
+        conn.close()
+
+    def test_legacy_database_is_removed_after_grace_period(self):
+        os.makedirs(os.path.dirname(self.legacy_path), exist_ok=True)
+        conn = sqlite3.connect(self.legacy_path)
+        conn.execute("CREATE TABLE channel_info (short_channel_id BLOB(8), msg BLOB, PRIMARY KEY(short_channel_id))")
+        conn.commit()
+        conn.close()
+        long_ago = time.time() - LEGACY_DB_GRACE_PERIOD - 100
+        os.utime(self.legacy_path, (long_ago, long_ago))
+        cdb = self._create_channel_db()
+        self._wait(cdb.load_data())
+        # the import starts the grace period
+        self.assertGreater(os.path.getmtime(self.legacy_path), long_ago + 100)
+        self._create_channel_db()
+        self.assertTrue(os.path.exists(self.legacy_path))
+        os.utime(self.legacy_path, (long_ago, long_ago))
+        self._create_channel_db()
+        self.assertFalse(os.path.exists(self.legacy_path))
+
+    def test_saved_data_is_loaded_without_decoding(self):
+        msgs = [make_gossip(i) for i in range(5)]
+        cdb = self._create_channel_db()
+        self._wait(cdb.load_data())
+        for chan_ann, chan_upd, node_ann in msgs:
+            for msg, add in ((chan_ann, cdb.add_channel_announcement), (chan_upd, cdb.add_channel_update),
+                             (node_ann, cdb.add_node_announcement)):
+                payload = decode_msg(msg)[1]
+                payload['raw'] = msg
+                add(payload)
+        self._wait(sql(lambda self: self.conn.commit())(cdb))
+        cdb2 = self._create_channel_db()
+        with mock.patch('electrum.channel_db.decode_msg', side_effect=AssertionError('decode_msg called')):
+            self._wait(cdb2.load_data())
+        channels, policies, nodes = self._expected_data(msgs)
+        self.assertEqual(channels, cdb2._channels)
+        self.assertEqual({k: p._replace(htlc_maximum_msat=2**63 - 1) for k, p in policies.items()}, cdb2._policies)
+        self.assertEqual(nodes, cdb2._nodes)
+
+    def test_sort_channels_for_loading(self):
+        node_ids = [bytes([2]) + bytes([i]) * 32 for i in range(8)]
+        peer, neighbour, hub = node_ids[:3]
+        channels = [ChannelInfo(ShortChannelID.from_components(700_000 + i, 1, 0), node1_id, node2_id, None)
+                    for i, (node1_id, node2_id) in enumerate([
+                        (hub, node_ids[4]), (node_ids[6], node_ids[7]), (neighbour, node_ids[3]),
+                        (hub, node_ids[5]), (hub, node_ids[6]), (peer, neighbour)])]
+        # channels of our peers, then of their neighbours, then of the best connected nodes
+        self.assertEqual([channels[i] for i in (5, 2, 4, 0, 3, 1)],
+                         sort_channels_for_loading(channels, [peer]))
+
+    def test_routing_starts_before_load_is_complete(self):
+        node_ids = [bytes([2]) + bytes([i]) * 32 for i in range(5)]
+        peer = node_ids[0]
+        cdb = self._create_channel_db()
+        self._wait(cdb.load_data())
+        # a path from our peer to node 2, and a channel far away
+        for i, (node1_id, node2_id) in enumerate([(node_ids[3], node_ids[4]), (node_ids[1], node_ids[2]),
+                                                   (node_ids[0], node_ids[1])]):
+            chan_ann, chan_upds = make_channel_gossip(i, node1_id, node2_id)
+            cdb.add_channel_announcement(dict(decode_msg(chan_ann)[1], raw=chan_ann))
+            for chan_upd in chan_upds:
+                cdb.add_channel_update(dict(decode_msg(chan_upd)[1], raw=chan_upd))
+        cdb.add_recent_peer(LNPeerAddr('127.0.0.1', 9735, peer))
+        self._wait(sql(lambda self: self.conn.commit())(cdb))
+
+        cdb2 = self._create_channel_db()
+        cdb2.NUM_CHANNELS_PER_LOAD_BATCH = 2
+        path_finder = LNPathFinder(cdb2)
+        first_batch_loaded = threading.Event()
+        resume = threading.Event()
+        load_channels = cdb2._load_channels
+        async def load_channels_and_pause(*args):
+            if cdb2.data_partially_loaded.is_set():
+                first_batch_loaded.set()
+                await self.asyncio_loop.run_in_executor(None, resume.wait)
+            await load_channels(*args)
+        cdb2._load_channels = load_channels_and_pause
+        load_future = asyncio.run_coroutine_threadsafe(cdb2.load_data(), self.asyncio_loop)
+        self.assertTrue(first_batch_loaded.wait(timeout=5))
+        self.assertFalse(cdb2.data_loaded.is_set())
+        self.assertEqual(2 / 3, path_finder.get_graph_completeness())
+        # the channels near our peer are loaded first
+        path = path_finder.find_path_for_payment(peer, node_ids[2], 100_000, use_cache=True)
+        self.assertEqual([node_ids[1], node_ids[2]], [edge.node_id for edge in path])
+        self.assertIsNone(path_finder.find_path_for_payment(peer, node_ids[4], 100_000))
+        self.assertEqual({'size': 0, 'hits': 0, 'misses': 0, 'invalidations': 0}, path_finder.route_cache.get_stats())
+        resume.set()
+        load_future.result(timeout=5)
+        self.assertTrue(cdb2.data_loaded.is_set())
+        self.assertEqual(1, path_finder.get_graph_completeness())
+        self.assertEqual(cdb._channels, cdb2._channels)
+        self.assertEqual(cdb._policies, cdb2._policies)
+        self.assertEqual(3, cdb2.graph.num_channels())
@@ -1,10 +1,14 @@
 import unittest
 from unittest import mock
 from decimal import Decimal
+from functools import partialmethod
+import asyncio
 
-from electrum.util import create_and_start_event_loop
+from electrum.util import create_and_start_event_loop, TxMinedInfo
 from electrum.commands import Commands, eval_bool
-from electrum import storage, wallet
+from electrum import storage, wallet, keystore
+from electrum.transaction import Transaction
+from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED
 from electrum.wallet import restore_wallet_from_text
 from electrum.simple_config import SimpleConfig
 
@@ -216,3 +220,55 @@ class TestCommandsTestnet(TestCaseForTestnet):
                          cmds._run('getprivatekeyforpath', ("m/0/10000",), wallet=wallet))
         self.assertEqual("p2wpkh:cQAj4WGf1socCPCJNMjXYCJ8Bs5JUAk5pbDr4ris44QdgAXcV24S",
                          cmds._run('getprivatekeyforpath', ("m/5h/100000/88h/7",), wallet=wallet))
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_onchain_history_paging(self, mock_save_db):
+        from .test_wallet_vertical import WalletIntegrityHelper
+        from . import test_wallet_vertical
+        transactions = test_wallet_vertical.TestWalletHistory_SimpleRandomOrder.transactions
+        ks = keystore.from_old_mpk('e9d4b7866dd1e91c862aebf62a49548c7dbf7bcc6e4b7b8c9da820c7737968df9c09d5a3e271dc814a29981f81b3faaf2737b551ef5dcc6189cf0f8252c442b3')
+        w = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=20, config=self.config)
+        w.create_new_address(for_change=True)
+        for raw_tx in transactions.values():
+            tx = Transaction(raw_tx)
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        cmds = Commands(config=self.config)
+        full = cmds._run('onchain_history', (), wallet=w)
+        self.assertEqual(len(transactions), len(full['transactions']))
+        # pages
+        txs = []
+        cursor = None
+        while True:
+            page = cmds._run('onchain_history', (), limit=5, cursor=cursor, wallet=w)
+            txs += page['transactions']
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(full['transactions'], txs)
+        page = cmds._run('onchain_history', (), offset=15, limit=5, wallet=w)
+        self.assertEqual(full['transactions'][15:], page['transactions'])
+        self.assertEqual(None, page['next_cursor'])
+        # no cursor after an exactly full last page
+        num_txs = len(full['transactions'])
+        page = cmds._run('onchain_history', (), offset=num_txs - 5, limit=5, wallet=w)
+        self.assertEqual(5, len(page['transactions']))
+        self.assertEqual(None, page['next_cursor'])
+        with self.assertRaises(Exception):
+            cmds._run('onchain_history', (), limit=5, cursor='garbage', wallet=w)
+        with self.assertRaises(Exception):
+            cmds._run('onchain_history', (), limit=5, stream=True, wallet=w)
+        # stream
+        async def collect(items):
+            return [item async for item in items]
+        with mock.patch.object(wallet.Abstract_Wallet, 'iter_detailed_history',
+                               partialmethod(wallet.Abstract_Wallet.iter_detailed_history, page_size=3)):
+            items = cmds._run('onchain_history', (), stream=True, wallet=w)
+            items = asyncio.run_coroutine_threadsafe(collect(items), self.asyncio_loop).result()
+        self.assertEqual(full['transactions'] + [full['summary']], items)
+        # the tx of the cursor moves to the start of the history, as it gets mined
+        page = cmds._run('onchain_history', (), limit=5, wallet=w)
+        w.add_verified_tx(page['transactions'][-1]['txid'],
+                          TxMinedInfo(height=1000, timestamp=1_600_000_000, txpos=0, header_hash='00' * 32))
+        page2 = cmds._run('onchain_history', (), limit=5, cursor=page['next_cursor'], wallet=w)
+        self.assertEqual([tx['txid'] for tx in full['transactions'][5:10]],
+                         [tx['txid'] for tx in page2['transactions']])
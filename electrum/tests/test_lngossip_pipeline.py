@@ -0,0 +1,101 @@
+import asyncio
+import sys
+from unittest import mock
+
+from electrum import ecc
+from electrum.crypto import sha256d
+from electrum.lngossip_pipeline import GossipPipeline, process_gossip_batch, get_gossip_msg_type
+from electrum.lnmsg import encode_msg
+from electrum.simple_config import SimpleConfig
+
+from . import ElectrumTestCase
+
+
+def make_channel_announcement(i: int, *, valid: bool = True) -> bytes:
+    keys = [ecc.ECPrivkey(sha256d(b'key %d %d' % (i, j))) for j in range(4)]
+    pubkeys = [key.get_public_key_bytes() for key in keys]
+    fields = dict(
+        len=0, features=b'', chain_hash=bytes(32), short_channel_id=i.to_bytes(8, 'big'),
+        node_id_1=pubkeys[0], node_id_2=pubkeys[1], bitcoin_key_1=pubkeys[2], bitcoin_key_2=pubkeys[3])
+    unsigned = encode_msg('channel_announcement', **fields)
+    h = sha256d(unsigned[2+256:])
+    sigs = [key.sign(h, ecc.sig_string_from_r_and_s) for key in keys]
+    if not valid:
+        sigs[3] = keys[0].sign(h, ecc.sig_string_from_r_and_s)
+    return encode_msg('channel_announcement', node_signature_1=sigs[0], node_signature_2=sigs[1],
+                      bitcoin_signature_1=sigs[2], bitcoin_signature_2=sigs[3], **fields)
+
+
+def make_node_announcement(i: int) -> bytes:
+    key = ecc.ECPrivkey(sha256d(b'node %d' % i))
+    fields = dict(flen=0, features=b'', timestamp=1_600_000_000 + i, node_id=key.get_public_key_bytes(),
+                  rgb_color=b'\x00' * 3, alias=b'node'.ljust(32, b'\x00'), addrlen=0, addresses=b'')
+    unsigned = encode_msg('node_announcement', **fields)
+    return encode_msg('node_announcement', signature=key.sign(sha256d(unsigned[66:]), ecc.sig_string_from_r_and_s),
+                      **fields)
+
+
+def make_channel_update(i: int) -> bytes:
+    return encode_msg('channel_update', signature=bytes(64), chain_hash=bytes(32),
+                      short_channel_id=i.to_bytes(8, 'big'), timestamp=1_600_000_000, message_flags=b'\x00',
+                      channel_flags=b'\x00', cltv_expiry_delta=144, htlc_minimum_msat=1000,
+                      fee_base_msat=1000, fee_proportional_millionths=1)
+
+
+class TestGossipPipeline(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.msgs = [make_channel_announcement(i) for i in range(3)]
+        self.msgs += [make_channel_announcement(3, valid=False)]
+        self.msgs += [make_node_announcement(i) for i in range(2)]
+        self.msgs += [make_channel_update(i) for i in range(5)]
+        self.msgs += [b'\x01\x00' + b'truncated']
+
+    def test_get_gossip_msg_type(self):
+        self.assertEqual('channel_announcement', get_gossip_msg_type(self.msgs[0]))
+        self.assertEqual('node_announcement', get_gossip_msg_type(self.msgs[4]))
+        self.assertEqual('channel_update', get_gossip_msg_type(self.msgs[6]))
+        self.assertIsNone(get_gossip_msg_type(encode_msg('ping', num_pong_bytes=4, byteslen=0)))
+
+    def check_batch(self, batch):
+        self.assertEqual([i.to_bytes(8, 'big') for i in range(3)],
+                         [payload['short_channel_id'] for payload in batch.chan_anns])
+        self.assertEqual(self.msgs[:3], [payload['raw'] for payload in batch.chan_anns])
+        self.assertEqual(self.msgs[4:6], [payload['raw'] for payload in batch.node_anns])
+        self.assertEqual(5, len(batch.chan_upds))
+        self.assertEqual(144, batch.chan_upds[0]['cltv_expiry_delta'])
+        # the bad signature and the truncated message
+        self.assertEqual(2, batch.num_invalid)
+
+    def test_process_gossip_batch(self):
+        self.check_batch(process_gossip_batch(self.msgs))
+
+    def test_pipeline_with_threads(self):
+        pipeline = GossipPipeline(SimpleConfig({'electrum_path': self.electrum_path, 'lightning_gossip_workers': 0}))
+        self.check_batch(asyncio.get_event_loop().run_until_complete(pipeline.process(self.msgs)))
+
+    def test_pipeline_with_worker_processes(self):
+        pipeline = GossipPipeline(SimpleConfig({'electrum_path': self.electrum_path, 'lightning_gossip_workers': 2}))
+        try:
+            # small batches, so that they are spread over the workers
+            batches = [self.msgs[i:i+2] for i in range(0, len(self.msgs), 2)]
+            results = asyncio.get_event_loop().run_until_complete(
+                asyncio.gather(*[pipeline.process(batch) for batch in batches]))
+            self.assertEqual(2, sum(batch.num_invalid for batch in results))
+            self.assertEqual(self.msgs[:3], [p['raw'] for batch in results for p in batch.chan_anns])
+            self.check_batch(asyncio.get_event_loop().run_until_complete(pipeline.process(self.msgs)))
+            self.assertEqual(2, pipeline.num_workers)  # did not fall back to threads
+        finally:
+            pipeline.stop()
+
+    def test_no_worker_processes_in_frozen_builds(self):
+        with mock.patch.object(sys, 'frozen', True, create=True):
+            pipeline = GossipPipeline(SimpleConfig({'electrum_path': self.electrum_path}))
+        self.assertEqual(0, pipeline.num_workers)
+
+    def test_fallback_if_workers_cannot_be_created(self):
+        pipeline = GossipPipeline(SimpleConfig({'electrum_path': self.electrum_path, 'lightning_gossip_workers': 2}))
+        with mock.patch('electrum.lngossip_pipeline.ProcessPoolExecutor', side_effect=TypeError('mp_context')):
+            self.check_batch(asyncio.get_event_loop().run_until_complete(pipeline.process(self.msgs)))
+        self.assertEqual(0, pipeline.num_workers)
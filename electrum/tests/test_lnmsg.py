@@ -383,3 +383,45 @@ class TestLNMsg(TestCaseForTestnet):
                                   {'chains': b'CI\x7f\xd7\xf8&\x95q\x08\xf4\xa3\x0f\xd9\xce\xc3\xae\xbay\x97 \x84\xe9\x0e\xad\x01\xea3\t\x00\x00\x00\x00'}
                           }}),
                          decode_msg(bfh("001000022200000302aaa2012043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea330900000000")))
+
+    def test_encode_decode_msg__roundtrip_all_msg_types(self):
+        lnser = LNSerializer()
+        for msg_type_bytes, scheme in lnser.msg_scheme_from_type.items():
+            msg_type = scheme[0][1]
+            with self.subTest(msg_type=msg_type):
+                # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+                count_fields = {row[4] for row in scheme[1:]}
+                kwargs = {}
+                for i, row in enumerate(scheme[1:]):
+                    field_name, field_type, field_count = row[2], row[3], row[4]
+                    if field_name == 'tlvs':
+                        continue
+                    if field_name in count_fields:
+                        kwargs[field_name] = 2
+                    elif field_type in ('u8', 'u16', 'u32', 'u64'):
+                        kwargs[field_name] = 200 + i
+                    else:
+                        count = kwargs[field_count] if field_count in kwargs else int(field_count or 1)
+                        type_len = {'byte': 1, 'point': 33, 'signature': 64, 'short_channel_id': 8}.get(field_type, 32)
+                        kwargs[field_name] = bytes([i]) * (count * type_len)
+                msg = lnser.encode_msg(msg_type, **kwargs)
+                self.assertEqual(msg_type_bytes, msg[:2])
+                decoded_type, decoded = lnser.decode_msg(msg)
+                self.assertEqual(msg_type, decoded_type)
+                self.assertEqual(kwargs, {k: v for k, v in decoded.items() if not k.endswith('tlvs')})
+                self.assertEqual(msg, lnser.encode_msg(msg_type, **decoded))
+                # truncated mandatory fields
+                with self.assertRaises(UnexpectedEndOfStream):
+                    lnser.decode_msg(msg[:3])
+
+    def test_decode_msg__truncated_optional_field(self):
+        msg = encode_msg("open_channel", shutdown_len=3, shutdown_scriptpubkey=b'\x01\x02\x03')
+        msg_type, payload = decode_msg(msg)
+        self.assertEqual(b'\x01\x02\x03', payload['shutdown_scriptpubkey'])
+        # optional fields that are cut short are left out
+        msg_type, payload = decode_msg(msg[:-1])
+        self.assertEqual(3, payload['shutdown_len'])
+        self.assertNotIn('shutdown_scriptpubkey', payload)
+        msg_type, payload = decode_msg(msg[:-4])
+        self.assertNotIn('shutdown_len', payload)
+        self.assertEqual(0, payload['channel_flags'][0])
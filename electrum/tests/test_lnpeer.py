@@ -26,6 +26,7 @@ from electrum.lnutil import PaymentFailure, LnFeatures, HTLCOwner
 from electrum.lnchannel import ChannelState, PeerState, Channel
 from electrum.lnrouter import LNPathFinder, PathEdge, LNPathInconsistent
 from electrum.channel_db import ChannelDB
+from electrum.lngossip_pipeline import GossipPipeline
 from electrum.lnworker import LNWallet, NoPathFound
 from electrum.lnmsg import encode_msg, decode_msg
 from electrum.logging import console_stderr_handler, Logger
@@ -57,8 +58,10 @@ class MockNetwork:
         self.config = simple_config.SimpleConfig(user_config, read_user_dir_function=lambda: user_dir)
         self.asyncio_loop = asyncio.get_event_loop()
         self.channel_db = ChannelDB(self)
+        self.channel_db.data_partially_loaded.set()
         self.channel_db.data_loaded.set()
         self.path_finder = LNPathFinder(self.channel_db)
+        self.gossip_pipeline = GossipPipeline(self.config)
         self.tx_queue = tx_queue
         self._blockchain = MockBlockchain()
 
@@ -94,7 +97,7 @@ class MockWallet:
     def set_label(self, x, y):
         pass
 
-    def save_db(self):
+    def save_db(self, *, flush=False):
         pass
 
     def add_transaction(self, tx):
@@ -153,7 +156,7 @@ class MockLNWallet(Logger, NetworkRetryManager[LNPeerAddr]):
     def channel_state_changed(self, chan):
         pass
 
-    def save_channel(self, chan):
+    def save_channel(self, chan, *, flush=False):
         print("Ignoring channel save")
 
     is_routing = set()
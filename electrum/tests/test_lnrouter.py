@@ -2,6 +2,7 @@ import unittest
 import tempfile
 import shutil
 import asyncio
+import random
 
 from electrum.util import bh2u, bfh, create_and_start_event_loop
 from electrum.lnonion import (OnionHopsDataSingle, new_onion_packet,
@@ -11,6 +12,7 @@ from electrum import bitcoin, lnrouter
 from electrum.constants import BitcoinTestnet
 from electrum.simple_config import SimpleConfig
 from electrum.lnrouter import PathEdge
+from electrum.lnutil import ShortChannelID, NUM_MAX_EDGES_IN_PAYMENT_PATH
 
 from . import TestCaseForTestnet
 from .test_bitcoin import needs_test_with_all_chacha20_implementations
@@ -22,10 +24,14 @@ class Test_LNRouter(TestCaseForTestnet):
         super().setUp()
         self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
         self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self._channel_dbs = []
 
     def tearDown(self):
         self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
         self._loop_thread.join(timeout=1)
+        # the sql threads stop with the event loop
+        for cdb in self._channel_dbs:
+            cdb.sql_thread.join(timeout=1)
         super().tearDown()
 
     def test_find_path_for_payment(self):
@@ -36,6 +42,7 @@ class Test_LNRouter(TestCaseForTestnet):
             register_callback = lambda *args: None
             interface = None
         fake_network.channel_db = lnrouter.ChannelDB(fake_network())
+        fake_network.channel_db.data_partially_loaded.set()
         fake_network.channel_db.data_loaded.set()
         cdb = fake_network.channel_db
         path_finder = lnrouter.LNPathFinder(cdb)
@@ -97,6 +104,191 @@ class Test_LNRouter(TestCaseForTestnet):
         self._loop_thread.join(timeout=1)
         cdb.sql_thread.join(timeout=1)
 
+    def _create_channel_db(self):
+        class fake_network:
+            config = self.config
+            asyncio_loop = asyncio.get_event_loop()
+            trigger_callback = lambda *args: None
+            register_callback = lambda *args: None
+            interface = None
+        cdb = lnrouter.ChannelDB(fake_network())
+        cdb.data_partially_loaded.set()
+        cdb.data_loaded.set()
+        self._channel_dbs.append(cdb)
+        return cdb
+
+    def _add_channel(self, cdb, scid, n1, n2, rand=None):
+        """Adds a channel with random policies, or with the same sane policy
+        in both directions if rand is None."""
+        n1, n2 = sorted([n1, n2])
+        cdb.add_channel_announcement({'node_id_1': n1, 'node_id_2': n2, 'bitcoin_key_1': n1, 'bitcoin_key_2': n2,
+                                      'short_channel_id': scid, 'chain_hash': BitcoinTestnet.rev_genesis_bytes(),
+                                      'len': 0, 'features': b''}, trusted=True)
+        for direction in (0, 1):
+            if rand is None:
+                cdb.add_channel_update({'short_channel_id': scid, 'message_flags': b'\x00',
+                                        'channel_flags': bytes([direction]), 'cltv_expiry_delta': 10,
+                                        'htlc_minimum_msat': 250, 'fee_base_msat': 100, 'fee_proportional_millionths': 150,
+                                        'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 0},
+                                       verbose=False)
+                continue
+            if rand.random() < 0.05:
+                continue  # some channels only have one policy
+            cdb.add_channel_update({'short_channel_id': scid, 'message_flags': b'\x00',
+                                    'channel_flags': bytes([direction | (2 if rand.random() < 0.05 else 0)]),
+                                    'cltv_expiry_delta': rand.choice([9, 18, 40, 144, 3000]),
+                                    'htlc_minimum_msat': rand.choice([1, 1000]),
+                                    'htlc_maximum_msat': rand.choice([10_000_000, 1_000_000_000]),
+                                    'fee_base_msat': rand.randrange(0, 2000),
+                                    'fee_proportional_millionths': rand.randrange(0, 5000),
+                                    'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 0},
+                                   verbose=False)
+
+    def _create_random_channel_db(self, num_nodes: int, num_channels: int, *, seed: int, skewed=False):
+        """Random graph. If skewed, a few nodes have most channels, like on mainnet."""
+        cdb = self._create_channel_db()
+        rand = random.Random(seed)
+        node_ids = [bytes([2]) + rand.getrandbits(256).to_bytes(32, 'big') for i in range(num_nodes)]
+        weights = [1 / (i + 1) for i in range(num_nodes)] if skewed else None
+        for i in range(num_channels):
+            n1, n2 = rand.choices(node_ids, weights=weights, k=2)
+            if n1 == n2:
+                continue
+            self._add_channel(cdb, ShortChannelID.from_components(600_000 + i, 1, 0), n1, n2, rand)
+        return cdb, node_ids
+
+    def test_compact_graph_finds_same_paths(self):
+        cdb, node_ids = self._create_random_channel_db(200, 1000, seed=1)
+        path_finder = lnrouter.LNPathFinder(cdb)
+        rand = random.Random(2)
+        queries = [(rand.sample(node_ids, 2), rand.choice([10_000, 5_000_000, 100_000_000])) for i in range(50)]
+
+        def path_cost(path, start_node, amount_msat):
+            # paths of equal cost are equally good; which one wins depends on iteration order
+            route = path_finder.create_route_from_path(path, start_node)
+            cost = 0
+            for i in reversed(range(len(route))):
+                edge_startnode = route[i-1].node_id if i > 0 else start_node
+                edge_cost, fee_msat = path_finder._edge_cost(
+                    route[i].short_channel_id, edge_startnode, route[i].node_id, amount_msat,
+                    ignore_costs=(i == 0), my_channels={})
+                cost += edge_cost
+                amount_msat += fee_msat
+            return cost
+
+        def find_paths():
+            ret = []
+            for (a, b), amount_msat in queries:
+                path = path_finder.find_path_for_payment(a, b, amount_msat)
+                ret.append((path, path_cost(path, a, amount_msat) if path else None))
+            return ret
+
+        def assert_same_costs(results1, results2):
+            self.assertEqual(len(results1), len(results2))
+            for (path1, cost1), (path2, cost2) in zip(results1, results2):
+                self.assertEqual(path1 is None, path2 is None)
+                if path1 is not None:
+                    self.assertAlmostEqual(cost1, cost2)
+
+        results = find_paths()
+        self.assertTrue(any(path for path, cost in results))
+        graph = cdb.graph
+        cdb.graph = None
+        try:
+            assert_same_costs(find_paths(), results)
+        finally:
+            cdb.graph = graph
+        # remove the channels we used, and compare again, before and after compaction
+        for path, cost in results[:10]:
+            for edge in path or []:
+                cdb.remove_channel(edge.short_channel_id)
+        results = find_paths()
+        cdb.graph = None
+        try:
+            assert_same_costs(find_paths(), results)
+        finally:
+            cdb.graph = graph
+        graph.compact()
+        assert_same_costs(find_paths(), results)
+        self.assertEqual(len(cdb._channels), graph.num_channels())
+
+    def test_path_length_is_limited(self):
+        cdb = self._create_channel_db()
+        path_finder = lnrouter.LNPathFinder(cdb)
+        # a line of nodes, one hop longer than allowed
+        node_ids = [bytes([2]) + bytes([i]) * 32 for i in range(NUM_MAX_EDGES_IN_PAYMENT_PATH + 2)]
+        for i in range(len(node_ids) - 1):
+            self._add_channel(cdb, ShortChannelID.from_components(600_000 + i, 1, 0), node_ids[i], node_ids[i+1])
+        for graph in (cdb.graph, None):
+            cdb.graph = graph
+            self.assertIsNone(path_finder.find_path_for_payment(node_ids[0], node_ids[-1], 10_000))
+            path = path_finder.find_path_for_payment(node_ids[1], node_ids[-1], 10_000)
+            self.assertEqual(NUM_MAX_EDGES_IN_PAYMENT_PATH, len(path))
+        # an expensive shortcut, from the second node to the last one
+        shortcut = ShortChannelID.from_components(700_000, 1, 0)
+        self._add_channel(cdb, shortcut, node_ids[1], node_ids[-1])
+        for direction in (0, 1):
+            cdb.add_channel_update({'short_channel_id': shortcut, 'message_flags': b'\x00',
+                                    'channel_flags': bytes([direction]), 'cltv_expiry_delta': 10,
+                                    'htlc_minimum_msat': 250, 'fee_base_msat': 90_000, 'fee_proportional_millionths': 150,
+                                    'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 100},
+                                   verbose=False)
+        for graph in (cdb.graph, None):
+            cdb.graph = graph
+            # the long path is cheaper, but only the shortcut is short enough
+            path = path_finder.find_path_for_payment(node_ids[0], node_ids[-1], 10_000_000)
+            self.assertEqual(shortcut, path[-1].short_channel_id)
+            self.assertEqual(2, len(path))
+
+    def test_route_cache(self):
+        cdb = self._create_channel_db()
+        path_finder = lnrouter.LNPathFinder(cdb)
+        cache = path_finder.route_cache
+        a, b, c, d, e = [bytes([2]) + bytes([i]) * 32 for i in range(1, 6)]
+        scid = lambda i: ShortChannelID.from_components(600_000 + i, 1, 0)
+        for i, (n1, n2) in enumerate([(a, b), (b, e), (a, c), (c, d), (d, e)]):
+            self._add_channel(cdb, scid(i), n1, n2)
+
+        def update_fee(short_channel_id, fee_base_msat, timestamp):
+            cdb.add_channel_update({'short_channel_id': short_channel_id, 'message_flags': b'\x00',
+                                    'channel_flags': b'\x00', 'cltv_expiry_delta': 10,
+                                    'htlc_minimum_msat': 250, 'fee_base_msat': fee_base_msat, 'fee_proportional_millionths': 150,
+                                    'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': timestamp},
+                                   verbose=False)
+
+        def find_path(amount_msat=100_000):
+            return path_finder.find_path_for_payment(a, e, amount_msat, use_cache=True)
+
+        path = find_path()
+        self.assertEqual([scid(0), scid(1)], [edge.short_channel_id for edge in path])
+        self.assertEqual({'size': 1, 'hits': 0, 'misses': 1, 'invalidations': 0}, cache.get_stats())
+        # same amount bucket
+        self.assertEqual(path, find_path(120_000))
+        self.assertEqual(1, cache.get_stats()['hits'])
+        # other amount bucket
+        self.assertEqual(path, find_path(1_000_000))
+        self.assertEqual({'size': 2, 'hits': 1, 'misses': 2, 'invalidations': 0}, cache.get_stats())
+        # updates of channels that are not on the path do not invalidate it
+        update_fee(scid(3), 1000, timestamp=100)
+        self.assertEqual(path, find_path())
+        self.assertEqual({'size': 2, 'hits': 2, 'misses': 2, 'invalidations': 0}, cache.get_stats())
+        # updates of channels on the path do
+        update_fee(scid(1), 1000, timestamp=100)
+        self.assertEqual({'size': 0, 'hits': 2, 'misses': 2, 'invalidations': 2}, cache.get_stats())
+        self.assertEqual(path, find_path())
+        self.assertEqual(3, cache.get_stats()['misses'])
+        # unchanged policies are ignored
+        update_fee(scid(1), 1000, timestamp=200)
+        self.assertEqual(path, find_path())
+        self.assertEqual(3, cache.get_stats()['hits'])
+        path_finder.add_to_blacklist(scid(0))
+        self.assertEqual(0, cache.get_stats()['size'])
+        self.assertEqual([scid(2), scid(3), scid(4)], [edge.short_channel_id for edge in find_path()])
+        cdb.remove_channel(scid(3))
+        self.assertEqual(0, cache.get_stats()['size'])
+        self.assertIsNone(find_path())
+        self.assertEqual({'size': 0, 'hits': 3, 'misses': 5, 'invalidations': 4}, cache.get_stats())
+
     @needs_test_with_all_chacha20_implementations
     def test_new_onion_packet_legacy(self):
         # test vector from bolt-04
@@ -6,8 +6,8 @@ from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
 from electrum.interface import Interface, ServerAddr
-from electrum.crypto import sha256
-from electrum.util import bh2u
+from electrum.crypto import sha256, sha256d
+from electrum.util import bh2u, bfh
 
 from . import ElectrumTestCase
 
@@ -38,6 +38,39 @@ class MockInterface(Interface):
         assert assert_mode in item['mock'], (assert_mode, item)
         return item
 
+class MockSession:
+    """Serves blockchain.block.headers from a list of raw headers."""
+    def __init__(self, headers, latency=0.01):
+        self.headers = headers
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = []
+    async def send_request(self, method, params, timeout=None):
+        assert method == 'blockchain.block.headers', method
+        self.requests.append(params)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        start, count = params
+        headers = self.headers[start:start + count]
+        return {'count': len(headers), 'hex': b''.join(headers).hex(), 'max': 2016}
+    def is_closing(self):
+        return False
+
+
+def make_regtest_headers(num_headers):
+    # regtest genesis, followed by headers that only link up (no PoW on regtest)
+    headers = [bfh("0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff7f2002000000")]
+    for i in range(1, num_headers):
+        headers.append((0x20000000).to_bytes(4, 'little') + sha256d(headers[-1]) + sha256(str(i))
+                       + (1296688602 + i).to_bytes(4, 'little') + bfh('ffff7f20') + bytes(4))
+    return headers
+
+
 class TestNetwork(ElectrumTestCase):
 
     @classmethod
@@ -116,6 +149,71 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_sync_until_pipelines_chunk_requests(self):
+        headers = make_regtest_headers(3 * 2016 + 100)
+        tip = len(headers) - 1
+        ifa = self.interface
+        ifa.blockchain = chain = blockchain.Blockchain(config=self.config, forkpoint=0, parent=None,
+                                                       forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains = {constants.net.GENESIS: chain}
+        with open(chain.path(), 'wb') as f:
+            f.write(headers[0])
+        chain.update_size()
+        ifa.session = MockSession(headers)
+        ifa.tip = tip
+        self.assertEqual(('catchup', tip + 1), asyncio.get_event_loop().run_until_complete(ifa.sync_until(1, next_height=tip)))
+        self.assertEqual(tip, chain.height())
+        self.assertEqual(bh2u(sha256d(headers[tip])[::-1]), chain.get_hash(tip))
+        self.assertEqual([[0, 2016], [2016, 2016], [4032, 2016], [6048, 100]], ifa.session.requests)
+        self.assertEqual(4, ifa.session.max_in_flight)
+
+    def test_sync_until_stops_at_bad_chunk(self):
+        headers = make_regtest_headers(3 * 2016 + 100)
+        tip = len(headers) - 1
+        headers[2016 + 5] = bytes(80)
+        ifa = self.interface
+        ifa.blockchain = chain = blockchain.Blockchain(config=self.config, forkpoint=0, parent=None,
+                                                       forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains = {constants.net.GENESIS: chain}
+        with open(chain.path(), 'wb') as f:
+            f.write(headers[0])
+        chain.update_size()
+        ifa.session = MockSession(headers)
+        ifa.tip = tip
+        self.assertEqual((True, 2016), asyncio.get_event_loop().run_until_complete(ifa.request_chunks(1, 2015)))
+        self.assertEqual((False, 2016), asyncio.get_event_loop().run_until_complete(ifa.request_chunks(2016, tip)))
+        self.assertEqual(2015, chain.height())
+
+    def test_bad_chunk_from_other_interface_is_refetched(self):
+        headers = make_regtest_headers(2 * 2016 + 100)
+        tip = len(headers) - 1
+        ifa = self.interface
+        ifa.blockchain = chain = blockchain.Blockchain(config=self.config, forkpoint=0, parent=None,
+                                                       forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains = {constants.net.GENESIS: chain}
+        with open(chain.path(), 'wb') as f:
+            f.write(headers[0])
+        chain.update_size()
+        ifa.session = MockSession(headers)
+        ifa.tip = tip
+        bad_headers = list(headers)
+        bad_headers[2016 + 5] = bytes(80)
+        other = MockInterface(self.config)
+        other.session = MockSession(bad_headers)
+        closed = []
+        async def close():
+            closed.append(other)
+        other.close = close
+        async def fetch_chunk_from_any_interface(index, tip):
+            interface = other if index == 1 else ifa
+            return await interface._fetch_chunk(index, tip), interface
+        ifa._fetch_chunk_from_any_interface = fetch_chunk_from_any_interface
+        self.assertEqual((True, tip + 1), asyncio.get_event_loop().run_until_complete(ifa.request_chunks(1, tip)))
+        self.assertEqual(tip, chain.height())
+        self.assertEqual([other], closed)
+        self.assertEqual([[2016, 2016]], other.session.requests)
+        self.assertEqual([[0, 2016], [2016, 2016], [4032, 100]], sorted(ifa.session.requests))
+
 
 if __name__=="__main__":
     constants.set_regtest()
@@ -0,0 +1,264 @@
+import asyncio
+import time
+from collections import defaultdict
+from unittest import mock
+
+import aiorpcx
+from aiorpcx import RPCSession
+
+from electrum import bitcoin
+from electrum.bitcoin import address_to_scripthash
+from electrum.crypto import sha256
+from electrum.interface import Interface, NotificationSession, ServerAddr
+from electrum.logging import Logger
+from electrum.shared_sync import SharedSync
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import Synchronizer, history_status
+from electrum.transaction import Transaction
+from electrum.util import SilentTaskGroup
+from electrum.wallet import restore_wallet_from_text
+
+from . import ElectrumTestCase
+
+
+def make_raw_tx(i: int, addresses) -> str:
+    raw = '02000000' + '01' + sha256(b'prevout %d' % i).hex() + '00000000' + '00' + 'ffffffff'
+    raw += '%02x' % len(addresses)
+    for addr in addresses:
+        script = bitcoin.address_to_script(addr)
+        raw += (10_000 + i).to_bytes(8, 'little').hex() + '%02x' % (len(script) // 2) + script
+    return raw + '00000000'
+
+
+def make_addresses(num_addresses: int):
+    return [bitcoin.hash_to_segwit_addr(sha256(b'addr %d' % i)[:20], witver=0) for i in range(num_addresses)]
+
+
+def make_histories(addresses):
+    """Each tx pays to two consecutive addresses, so each address has two txs."""
+    num_addresses = len(addresses)
+    histories = defaultdict(list)
+    txs = {}
+    for i in range(num_addresses):
+        tx_addresses = [addresses[i], addresses[(i + 1) % num_addresses]]
+        raw_tx = make_raw_tx(i, tx_addresses)
+        txid = Transaction(raw_tx).txid()
+        txs[txid] = raw_tx
+        for addr in tx_addresses:
+            histories[address_to_scripthash(addr)].append({'tx_hash': txid, 'height': 100 + i})
+    for history in histories.values():
+        history.sort(key=lambda item: item['height'])
+    return histories, txs
+
+
+class FakeElectrumX:
+    """Serves the histories of a set of addresses, and counts the requests it gets."""
+
+    def __init__(self, histories, txs):
+        self.histories = histories  # scripthash -> [{'tx_hash', 'height'}]
+        self.txs = txs  # txid -> raw tx
+        self.num_requests = defaultdict(int)  # method -> count
+
+    def session_factory(self, *args, **kwargs):
+        server = self
+
+        class Session(RPCSession):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.cost_hard_limit = 0
+
+            async def handle_request(self, request):
+                server.num_requests[request.method] += 1
+                if request.method == 'blockchain.scripthash.subscribe':
+                    history = server.histories[request.args[0]]
+                    return history_status([(item['tx_hash'], item['height']) for item in history])
+                if request.method == 'blockchain.scripthash.get_history':
+                    return server.histories[request.args[0]]
+                if request.method == 'blockchain.transaction.get':
+                    return server.txs[request.args[0]]
+                raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+        return Session(*args, **kwargs)
+
+
+class CountingSession(NotificationSession):
+    """Counts round trips to the server."""
+    num_round_trips = 0
+
+    async def send_request(self, *args, **kwargs):
+        CountingSession.num_round_trips += 1
+        return await super().send_request(*args, **kwargs)
+
+    async def send_batch_request(self, *args, **kwargs):
+        CountingSession.num_round_trips += 1
+        return await super().send_batch_request(*args, **kwargs)
+
+
+class MockInterface(Interface):
+    def __init__(self, network):
+        self.network = network
+        self.server = ServerAddr.from_str('localhost:50001:t')
+        Logger.__init__(self)
+        self.debug = False
+        self.session = None
+        self.taskgroup = SilentTaskGroup()
+
+
+class MockNetwork:
+    debug = False
+
+    def __init__(self, config):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.config = config
+        self.interface = None
+        self.shared_sync = SharedSync(self)
+
+    def notify(self, key):
+        pass
+
+
+class TestSynchronizer(ElectrumTestCase):
+
+    def test_restore_with_batched_requests(self):
+        num_addresses = 300
+        addresses = make_addresses(num_addresses)
+        histories, txs = make_histories(addresses)
+        server = FakeElectrumX(histories, txs)
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        wallet = restore_wallet_from_text(' '.join(addresses), path=self.electrum_path + '/wallet',
+                                          config=config)['wallet']
+
+        async def run():
+            network = MockNetwork(config)
+            interface = MockInterface(network)
+            async with await aiorpcx.serve_rs(server.session_factory, 'localhost', 0) as electrumx:
+                port = electrumx.sockets[0].getsockname()[1]
+                session_factory = lambda *args, **kwargs: CountingSession(*args, interface=interface, **kwargs)
+                async with aiorpcx.connect_rs('localhost', port, session_factory=session_factory) as session:
+                    interface.session = session
+                    network.interface = interface
+                    wallet.network = network
+                    t0 = time.perf_counter()
+                    synchronizer = Synchronizer(wallet)
+                    while not wallet.is_up_to_date():
+                        await asyncio.sleep(0.01)
+                        self.assertLess(time.perf_counter() - t0, 30)
+                    # once synchronized, the synchronizer sleeps until there is something new
+                    num_round_trips = CountingSession.num_round_trips
+                    with mock.patch.object(wallet, 'synchronize') as synchronize:
+                        await asyncio.sleep(0.3)
+                        self.assertEqual(0, synchronize.call_count)
+                    self.assertEqual(num_round_trips, CountingSession.num_round_trips)
+                    await synchronizer.stop()
+                    await interface.taskgroup.cancel_remaining()
+        asyncio.get_event_loop().run_until_complete(run())
+
+        self.assertEqual(num_addresses, server.num_requests['blockchain.scripthash.subscribe'])
+        self.assertEqual(num_addresses, server.num_requests['blockchain.scripthash.get_history'])
+        # txs are only requested once, even though two addresses have each of them
+        self.assertEqual(len(txs), server.num_requests['blockchain.transaction.get'])
+        self.assertLess(CountingSession.num_round_trips, num_addresses // 10)
+        self.assertEqual(set(txs), set(wallet.db.list_transactions()))
+        for addr in addresses:
+            self.assertEqual(2, len(wallet.get_address_history(addr)))
+
+    def test_wallets_share_requests(self):
+        num_addresses = 300
+        addresses = make_addresses(num_addresses)
+        histories, txs = make_histories(addresses)
+        server = FakeElectrumX(histories, txs)
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        # the two wallets have the addresses in the middle in common
+        wallets = [restore_wallet_from_text(' '.join(addrs), path=self.electrum_path + '/wallet%d' % i,
+                                            config=config)['wallet']
+                   for i, addrs in enumerate([addresses[:200], addresses[100:]])]
+
+        async def run():
+            network = MockNetwork(config)
+            interface = MockInterface(network)
+            async with await aiorpcx.serve_rs(server.session_factory, 'localhost', 0) as electrumx:
+                port = electrumx.sockets[0].getsockname()[1]
+                session_factory = lambda *args, **kwargs: NotificationSession(*args, interface=interface, **kwargs)
+                async with aiorpcx.connect_rs('localhost', port, session_factory=session_factory) as session:
+                    interface.session = session
+                    network.interface = interface
+                    synchronizers = []
+                    for wallet in wallets:
+                        wallet.network = network
+                        synchronizers.append(Synchronizer(wallet))
+                    t0 = time.perf_counter()
+                    while not all(wallet.is_up_to_date() for wallet in wallets):
+                        await asyncio.sleep(0.01)
+                        self.assertLess(time.perf_counter() - t0, 30)
+                    for synchronizer in synchronizers:
+                        await synchronizer.stop()
+                    await interface.taskgroup.cancel_remaining()
+            return network
+        network = asyncio.get_event_loop().run_until_complete(run())
+
+        # each address is subscribed to, and each tx downloaded, once
+        self.assertEqual(num_addresses, server.num_requests['blockchain.scripthash.subscribe'])
+        self.assertEqual(len(txs), server.num_requests['blockchain.transaction.get'])
+        self.assertLessEqual(server.num_requests['blockchain.scripthash.get_history'], 400)
+        self.assertEqual(len(txs), network.shared_sync.txs_fetched)
+        # each wallet has 201 txs: the 200 first paying to its addresses, and one more
+        self.assertEqual(2 * 201, network.shared_sync.txs_requested)
+        for wallet, addrs in zip(wallets, [addresses[:200], addresses[100:]]):
+            for addr in addrs:
+                self.assertEqual(2, len(wallet.get_address_history(addr)))
+
+    def test_reconnect_only_fetches_changed_histories(self):
+        num_addresses = 300
+        addresses = make_addresses(num_addresses)
+        histories, txs = make_histories(addresses)
+        server = FakeElectrumX(histories, txs)
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        wallet = restore_wallet_from_text(' '.join(addresses), path=self.electrum_path + '/wallet',
+                                          config=config)['wallet']
+
+        async def synchronize():
+            network = MockNetwork(config)
+            interface = MockInterface(network)
+            async with await aiorpcx.serve_rs(server.session_factory, 'localhost', 0) as electrumx:
+                port = electrumx.sockets[0].getsockname()[1]
+                session_factory = lambda *args, **kwargs: NotificationSession(*args, interface=interface, **kwargs)
+                async with aiorpcx.connect_rs('localhost', port, session_factory=session_factory) as session:
+                    interface.session = session
+                    network.interface = interface
+                    wallet.network = network
+                    wallet.set_up_to_date(False)
+                    synchronizer = Synchronizer(wallet)
+                    t0 = time.perf_counter()
+                    while not wallet.is_up_to_date():
+                        await asyncio.sleep(0.01)
+                        self.assertLess(time.perf_counter() - t0, 30)
+                    await synchronizer.stop()
+                    await interface.taskgroup.cancel_remaining()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(synchronize())
+        self.assertEqual(num_addresses, server.num_requests['blockchain.scripthash.get_history'])
+        # the statuses of the histories are stored along with them
+        for addr in addresses:
+            self.assertEqual(history_status(wallet.db.get_addr_history(addr)), wallet.db.get_addr_history_status(addr))
+        # while we were offline, 5 addresses got a new tx
+        changed = addresses[10:15]
+        raw_tx = make_raw_tx(1000, changed)
+        txid = Transaction(raw_tx).txid()
+        txs[txid] = raw_tx
+        for addr in changed:
+            histories[address_to_scripthash(addr)].append({'tx_hash': txid, 'height': 2000})
+        # and 10 addresses have a history saved by an older version, without status
+        for addr in addresses[100:110]:
+            wallet.db.history_status.pop(addr)
+        server.num_requests.clear()
+        with mock.patch('electrum.address_synchronizer.history_status', wraps=history_status) as compute_status:
+            loop.run_until_complete(synchronize())
+        # all addresses are subscribed to again, but only the changed histories are fetched
+        self.assertEqual(num_addresses, server.num_requests['blockchain.scripthash.subscribe'])
+        self.assertEqual(len(changed), server.num_requests['blockchain.scripthash.get_history'])
+        self.assertEqual(1, server.num_requests['blockchain.transaction.get'])
+        # statuses are only computed for the histories that did not have one
+        self.assertEqual(10, compute_status.call_count)
+        self.assertIsNotNone(wallet.db.get_addr_history_status(addresses[100]))
+        for addr in changed:
+            self.assertEqual(3, len(wallet.get_address_history(addr)))
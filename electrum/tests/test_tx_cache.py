@@ -0,0 +1,122 @@
+import os
+import asyncio
+
+from electrum.crypto import sha256
+from electrum.shared_sync import SharedSync
+from electrum.simple_config import SimpleConfig
+from electrum.transaction import Transaction
+from electrum.tx_cache import TxCache
+
+from . import ElectrumTestCase
+
+
+def make_tx(i: int):
+    """Returns the txid and the raw hex of a 100 bytes tx."""
+    script = '6a26' + sha256(b'data %d' % i).hex() + '00' * 6  # 40 bytes OP_RETURN
+    raw_tx = ('02000000' + '01' + sha256(b'prevout %d' % i).hex() + '00000000' + '00' + 'ffffffff'
+              + '01' + '00' * 8 + '28' + script + '00000000')
+    return Transaction(raw_tx).txid(), raw_tx
+
+
+class TestTxCache(ElectrumTestCase):
+
+    def test_put_and_get(self):
+        cache = TxCache(os.path.join(self.electrum_path, 'tx_cache'))
+        txid, raw_tx = make_tx(1)
+        self.assertIsNone(cache.get(txid))
+        cache.put(txid, raw_tx)
+        self.assertEqual(raw_tx, cache.get(txid))
+        # stored as binary, under a directory named after the first byte of the txid
+        filename = os.path.join(self.electrum_path, 'tx_cache', txid[:2], txid)
+        self.assertEqual(100, os.path.getsize(filename))
+        self.assertEqual(100, cache.get_size())
+        self.assertEqual({'txs': 1, 'size': 100, 'hits': 1, 'misses': 1}, cache.get_stats())
+
+    def test_least_recently_used_are_evicted(self):
+        cache = TxCache(os.path.join(self.electrum_path, 'tx_cache'), max_size=350)
+        txs = [make_tx(i) for i in range(4)]
+        for txid, raw_tx in txs[:3]:
+            cache.put(txid, raw_tx)
+        cache.get(txs[0][0])
+        cache.put(*txs[3])
+        self.assertEqual(300, cache.get_size())
+        self.assertNotIn(txs[1][0], cache)
+        self.assertFalse(os.path.exists(os.path.join(self.electrum_path, 'tx_cache', txs[1][0][:2], txs[1][0])))
+        for i in (0, 2, 3):
+            self.assertEqual(txs[i][1], cache.get(txs[i][0]))
+
+    def test_corrupted_files_are_dropped(self):
+        cache = TxCache(os.path.join(self.electrum_path, 'tx_cache'))
+        txid, raw_tx = make_tx(1)
+        cache.put(txid, raw_tx)
+        filename = os.path.join(self.electrum_path, 'tx_cache', txid[:2], txid)
+        with open(filename, 'r+b') as f:
+            f.truncate(50)
+        self.assertIsNone(cache.get(txid))
+        self.assertNotIn(txid, cache)
+        self.assertEqual(0, cache.get_size())
+        self.assertFalse(os.path.exists(filename))
+
+    def test_reload(self):
+        path = os.path.join(self.electrum_path, 'tx_cache')
+        cache = TxCache(path)
+        txs = [make_tx(i) for i in range(3)]
+        for i, (txid, raw_tx) in enumerate(txs):
+            cache.put(txid, raw_tx)
+            # recency is read from the mtime of the files
+            os.utime(os.path.join(path, txid[:2], txid), (1_600_000_000 + i, 1_600_000_000 + i))
+        # a smaller cache keeps the most recently used txs
+        cache = TxCache(path, max_size=250)
+        self.assertEqual(2, len(cache))
+        self.assertNotIn(txs[0][0], cache)
+        self.assertEqual(txs[1][1], cache.get(txs[1][0]))
+        self.assertEqual(txs[2][1], cache.get(txs[2][0]))
+
+
+class MockInterface:
+    def __init__(self, txs):
+        self.txs = txs
+        self.requested = []
+
+    async def get_transactions(self, tx_hashes):
+        self.requested += tx_hashes
+        return [self.txs[tx_hash] for tx_hash in tx_hashes]
+
+
+class MockNetwork:
+    def __init__(self, config):
+        self.config = config
+        self.shared_sync = SharedSync(self)
+
+
+class TestSharedTxCache(ElectrumTestCase):
+
+    def test_txs_are_served_from_disk_after_restart(self):
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'tx_cache_size': 10_000})
+        txs = dict(make_tx(i) for i in range(10))
+        interface = MockInterface(txs)
+        loop = asyncio.get_event_loop()
+        shared_sync = MockNetwork(config).shared_sync
+        tx_hashes = list(txs)
+        results = loop.run_until_complete(shared_sync.get_transactions(interface, tx_hashes[:5]))
+        for tx_hash, raw_tx in zip(tx_hashes[:5], results):
+            # what the synchronizer does once it checked the txid
+            loop.run_until_complete(shared_sync.add_tx(tx_hash, raw_tx))
+        self.assertEqual(tx_hashes[:5], interface.requested)
+        # new process: the memory cache is empty, the disk cache is not
+        interface.requested.clear()
+        shared_sync = MockNetwork(config).shared_sync
+        results = loop.run_until_complete(shared_sync.get_transactions(interface, tx_hashes))
+        self.assertEqual([txs[tx_hash] for tx_hash in tx_hashes], results)
+        self.assertEqual(tx_hashes[5:], interface.requested)
+        self.assertEqual(5, shared_sync.tx_cache.hits)
+        # txs read from disk are kept in memory
+        self.assertEqual({tx_hashes[0]: txs[tx_hashes[0]]},
+                         loop.run_until_complete(shared_sync.get_cached_txs([tx_hashes[0]])))
+        self.assertEqual(5, shared_sync.tx_cache.hits)
+
+    def test_disabled_by_default(self):
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        shared_sync = MockNetwork(config).shared_sync
+        self.assertIsNone(shared_sync.tx_cache)
+        self.assertFalse(os.path.exists(os.path.join(self.electrum_path, 'tx_cache')))
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 
-from electrum.bitcoin import hash_encode
+import asyncio
+
+from aiorpcx.jsonrpc import RPCError
+
+from electrum.bitcoin import hash_encode, hash_decode
+from electrum.blockchain import HeaderView
+from electrum.crypto import sha256, sha256d
+from electrum.network import UntrustedServerReturnedError
+from electrum.shared_sync import SharedSync
+from electrum.simple_config import SimpleConfig
 from electrum.transaction import Transaction
 from electrum.util import bfh
 from electrum.verifier import SPV, InnerNodeOfSpvProofIsValidTx
@@ -48,3 +57,142 @@ class VerifierTestCase(TestCaseForTestnet):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+class MockChain:
+    """Blocks with two txs each; merkle_roots maps height -> merkle root."""
+    def __init__(self, merkle_roots, height):
+        self.merkle_roots = merkle_roots
+        self._height = height
+        self.num_header_reads = 0
+    def height(self):
+        return self._height
+    def read_header_view(self, height):
+        self.num_header_reads += 1
+        if height not in self.merkle_roots:
+            return None
+        raw = (bytes(4) + bytes(32) + hash_decode(self.merkle_roots[height])
+               + (1_500_000_000 + height).to_bytes(4, 'little') + bytes(8))
+        return HeaderView(raw, height)
+    def check_hash(self, height, header_hash):
+        header = self.read_header_view(height)
+        return header is not None and header.hash() == header_hash
+
+
+class MockNetwork:
+    def __init__(self, config, chain, proofs):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.config = config
+        self.interface = None
+        self.bhi_lock = asyncio.Lock()
+        self.chain = chain
+        self.proofs = proofs
+        self.batches = []
+        self.shared_sync = SharedSync(self)
+    def blockchain(self):
+        return self.chain
+    async def get_merkle_for_transactions(self, txs):
+        self.batches.append(list(txs))
+        return [self.proofs.get(tx_hash) or UntrustedServerReturnedError(original_exception=RPCError(1, 'not found'))
+                for tx_hash, tx_height in txs]
+
+
+class MockWallet:
+    def __init__(self, unverified):
+        self.unverified = unverified
+        self.verified = {}
+        self.removed = []
+    def diagnostic_name(self):
+        return 'mock-wallet'
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified.pop(tx_hash)
+        self.verified[tx_hash] = info
+    def remove_unverified_tx(self, tx_hash, tx_height):
+        self.unverified.pop(tx_hash)
+        self.removed.append(tx_hash)
+
+
+class BatchedVerifierTestCase(TestCaseForTestnet):
+
+    def test_proofs_are_batched_by_block(self):
+        num_blocks = 120
+        merkle_roots, proofs, unverified = {}, {}, {}
+        for height in range(1, num_blocks + 1):
+            tx1, tx2 = sha256(b'%d-1' % height).hex(), sha256(b'%d-2' % height).hex()
+            merkle_roots[height] = hash_encode(sha256d(hash_decode(tx1) + hash_decode(tx2)))
+            proofs[tx1] = {'block_height': height, 'pos': 0, 'merkle': [tx2]}
+            proofs[tx2] = {'block_height': height, 'pos': 1, 'merkle': [tx1]}
+            unverified[tx1] = unverified[tx2] = height
+        unknown_tx = sha256(b'unknown').hex()
+        unverified[unknown_tx] = 5
+        future_tx = sha256(b'future').hex()
+        unverified[future_tx] = num_blocks + 1
+        chain = MockChain(merkle_roots, num_blocks)
+        network = MockNetwork(SimpleConfig({'electrum_path': self.electrum_path}), chain, proofs)
+        wallet = MockWallet(unverified)
+        loop = asyncio.get_event_loop()
+        spv = SPV(network, wallet)
+        spv.blockchain = chain
+
+        async def run():
+            await spv._request_proofs()
+            await spv.taskgroup.join()
+            await spv.stop()
+        loop.run_until_complete(run())
+
+        self.assertEqual([100, 100, 41], [len(batch) for batch in network.batches])
+        self.assertEqual(2 * num_blocks, len(wallet.verified))
+        self.assertEqual([unknown_tx], wallet.removed)
+        self.assertEqual({future_tx: num_blocks + 1}, wallet.unverified)
+        self.assertEqual(set(), spv.requested_merkle)
+        info = wallet.verified[sha256(b'7-2').hex()]
+        self.assertEqual((7, 1, 1_500_000_007), (info.height, info.txpos, info.timestamp))
+        # one header read per block while collecting txs, and one per block and batch while verifying
+        self.assertEqual(num_blocks + num_blocks + 2, chain.num_header_reads)
+
+    def test_proofs_are_shared_between_wallets(self):
+        merkle_roots, proofs, unverified = {}, {}, {}
+        for height in range(1, 11):
+            tx1, tx2 = sha256(b'%d-1' % height).hex(), sha256(b'%d-2' % height).hex()
+            merkle_roots[height] = hash_encode(sha256d(hash_decode(tx1) + hash_decode(tx2)))
+            proofs[tx1] = {'block_height': height, 'pos': 0, 'merkle': [tx2]}
+            proofs[tx2] = {'block_height': height, 'pos': 1, 'merkle': [tx1]}
+            unverified[tx1] = unverified[tx2] = height
+        chain = MockChain(merkle_roots, 10)
+        network = MockNetwork(SimpleConfig({'electrum_path': self.electrum_path}), chain, proofs)
+        loop = asyncio.get_event_loop()
+
+        def verify(wallet):
+            spv = SPV(network, wallet)
+            spv.blockchain = chain
+            async def run():
+                await spv._request_proofs()
+                await spv.taskgroup.join()
+                await spv.stop()
+            loop.run_until_complete(run())
+
+        wallet1 = MockWallet(dict(unverified))
+        verify(wallet1)
+        self.assertEqual(1, len(network.batches))
+        # a second wallet with some of the same txs only fetches the others
+        own_tx = sha256(b'own').hex()
+        merkle_roots[11] = own_tx
+        chain._height = 11
+        proofs[own_tx] = {'block_height': 11, 'pos': 0, 'merkle': []}
+        wallet2 = MockWallet({tx: h for tx, h in unverified.items() if h <= 5})
+        wallet2.unverified[own_tx] = 11
+        verify(wallet2)
+        self.assertEqual([(own_tx, 11)], network.batches[1])
+        self.assertEqual(wallet1.verified[sha256(b'4-2').hex()], wallet2.verified[sha256(b'4-2').hex()])
+        self.assertEqual(31, network.shared_sync.proofs_requested)
+        self.assertEqual(21, network.shared_sync.proofs_fetched)
+        # after a reorg, cached proofs of the replaced blocks are not used anymore
+        tx1, tx2 = sha256(b'9-1').hex(), sha256(b'9-2').hex()
+        merkle_roots[9] = hash_encode(sha256d(hash_decode(tx2) + hash_decode(tx1)))
+        proofs[tx1] = {'block_height': 9, 'pos': 1, 'merkle': [tx2]}
+        wallet3 = MockWallet({tx1: 9, sha256(b'8-1').hex(): 8})
+        verify(wallet3)
+        self.assertEqual([(tx1, 9)], network.batches[2])
+        self.assertEqual(2, len(wallet3.verified))
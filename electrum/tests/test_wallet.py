@@ -1,5 +1,8 @@
 import shutil
 import tempfile
+import threading
+from functools import partial
+from unittest import mock
 import sys
 import os
 import json
@@ -16,6 +19,8 @@ from electrum.util import TxMinedInfo, InvalidPassword
 from electrum.bitcoin import COIN
 from electrum.wallet_db import WalletDB
 from electrum.simple_config import SimpleConfig
+from electrum.json_db import StoredDict
+from electrum.transaction import Transaction
 
 from . import ElectrumTestCase
 
@@ -83,6 +88,164 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def test_write_appends_changes_to_file(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.put('a', {'b': 1, 'c': [1, 2]})
+        db.write(storage)
+        size_after_full_write = os.path.getsize(self.wallet_path)
+        db.get('a')['b'] = 2
+        db.get('a').pop('c')
+        db.put('d', 'e')
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertTrue(contents.endswith('{"op": "add", "path": ["d"], "value": "e"}'))
+        self.assertTrue(len(contents) > size_after_full_write)
+        # reload, replaying the patches
+        storage = WalletStorage(self.wallet_path)
+        db2 = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual({'b': 2}, db2.get('a'))
+        self.assertEqual('e', db2.get('d'))
+        self.assertEqual(db.dump(), db2.dump())
+
+    def test_write_consolidates_file(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.write(storage)
+        for i in range(50):
+            db.put('key', i)
+            db.write(storage)
+        # the file must have been rewritten in full at least once
+        self.assertTrue(os.path.getsize(self.wallet_path) < 50 * len(', {"op": "replace", "path": ["key"], "value": 0}'))
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual(db.dump(), WalletDB(contents, manual_upgrades=False).dump())
+
+    def test_incomplete_patch_is_dropped(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.write(storage)
+        db.put('a', 1)
+        db.write(storage)
+        db.put('b', 2)
+        db.write(storage)
+        # simulate an interrupted append
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        with open(self.wallet_path, "w") as f:
+            f.write(contents[:-10])
+        storage = WalletStorage(self.wallet_path)
+        db2 = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual(1, db2.get('a'))
+        self.assertIsNone(db2.get('b'))
+        # the next write does not append after the incomplete patch
+        self.assertTrue(db2.needs_full_write())
+        db2.write(storage)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(db2.dump(), WalletDB(storage.read(), manual_upgrades=False).dump())
+
+    def test_failed_append_is_truncated(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.write(storage)
+        size = os.path.getsize(self.wallet_path)
+        with mock.patch('os.fsync', side_effect=OSError('disk full')):
+            db.put('a', 1)
+            with self.assertRaises(OSError):
+                db.write(storage)
+        self.assertEqual(size, os.path.getsize(self.wallet_path))
+        db.write(storage)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(1, WalletDB(storage.read(), manual_upgrades=False).get('a'))
+
+    def test_dirty_paths(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.put('a', {'b': {'c': 1}})
+        self.assertIsNone(db.pop_dirty_paths('test'))
+        db.track_dirty_paths('test')
+        db.get('a')['b']['c'] = 2
+        db.get('a')['d'] = 3
+        db.put('e', 4)
+        db.put('e', None)
+        self.assertEqual({('a', 'b', 'c'), ('a', 'd'), ('e',)}, db.pop_dirty_paths('test'))
+        self.assertEqual(set(), db.pop_dirty_paths('test'))
+        db.set_modified(True)
+        self.assertEqual({()}, db.pop_dirty_paths('test'))
+        # too many paths are reduced to their top-level keys
+        for i in range(db.MAX_DIRTY_PATHS + 1):
+            db.get('a')[str(i)] = i
+        db.put('e', 5)
+        self.assertEqual({('a',), ('e',)}, db.pop_dirty_paths('test'))
+
+    def test_copy_paths_from(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.put('a', {'b': {'c': 1}, 'f': [1]})
+        db.put('e', 4)
+        db2 = WalletDB(db.dump(), manual_upgrades=False)
+        db.track_dirty_paths('test')
+        db.get('a')['b']['c'] = 2
+        db.get('a').pop('f')
+        db.put('e', None)
+        db.put('g', 5)
+        db2.copy_paths_from(db, db.pop_dirty_paths('test'), exclude=['g'])
+        self.assertEqual({'b': {'c': 2}}, db2.get('a'))
+        self.assertIsNone(db2.get('e'))
+        self.assertIsNone(db2.get('g'))
+
+
+    def test_heavy_sections_are_loaded_lazily(self):
+        raw_tx = '0200000001f4eb2c5d1e5bb41e0a7a6f1c1cd9b2ef1ba2cd5b7e2d9f79b9d1ee0f6b61a5b30000000000fdffffff01a08601000000000016001428f3a2d1e1b6b0e2e3c9fb5a3f8e3e4e06b06f8d00000000'
+        txid = Transaction(raw_tx).txid()
+        data = {
+            'seed_version': FINAL_SEED_VERSION,
+            'transactions': {txid: raw_tx, 'ab' * 32: raw_tx},
+            'txo': {txid: {'addr': {'0': [100000, False]}}},
+            'spent_outpoints': {txid: {'0': 'cd' * 32}},
+        }
+        db = WalletDB(json.dumps(data), manual_upgrades=False)
+        # neither does a full write
+        dumped = json.loads(db.dump())
+        for key in ('transactions', 'txo', 'spent_outpoints'):
+            self.assertEqual(data[key], dumped[key])
+        self.assertIs(dict, type(dict.get(db.txo, txid)))
+        self.assertIs(str, type(dict.get(db.transactions, txid)))
+        # reading does not convert
+        self.assertEqual(['addr'], db.get_txo_addresses(txid))
+        self.assertEqual({0: (100000, False)}, db.get_txo_addr(txid, 'addr'))
+        self.assertIs(dict, type(dict.get(db.txo, txid)))
+        self.assertIs(str, type(dict.get(db.transactions, txid)))
+        # accessing does
+        self.assertEqual(txid, db.get_transaction(txid).txid())
+        db.add_txo_addr(txid, 'addr', 1, 2000, False)
+        self.assertIsInstance(dict.get(db.txo, txid), StoredDict)
+        self.assertEqual({0: (100000, False), 1: (2000, False)}, db.get_txo_addr(txid, 'addr'))
+        # the dump is unaffected
+        db2 = WalletDB(db.dump(), manual_upgrades=False)
+        self.assertEqual(json.loads(db.dump()), json.loads(db2.dump()))
+        # cleanup
+        db.remove_unreferenced_data()
+        self.assertEqual([txid], db.list_transactions())
+        self.assertEqual([], db.list_spent_outpoints())
+
+
+    def test_pruning_waits_for_lock(self):
+        data = {
+            'seed_version': FINAL_SEED_VERSION,
+            'spent_outpoints': {'ab' * 32: {'0': 'cd' * 32}},
+        }
+        db = WalletDB(json.dumps(data), manual_upgrades=False)
+        # held by the wallet between recording a spent outpoint and adding the spending tx
+        lock = threading.RLock()
+        with lock:
+            t = threading.Thread(target=partial(db.remove_unreferenced_data, lock=lock))
+            t.start()
+            t.join(0.1)
+            self.assertTrue(t.is_alive())
+            self.assertEqual([('ab' * 32, '0')], db.list_spent_outpoints())
+        t.join()
+        self.assertEqual([], db.list_spent_outpoints())
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -172,6 +335,110 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(d['seed'], wallet.keystore.get_seed(password))
         self.assertEqual(encrypt_file, wallet.storage.is_encrypted())
 
+    def test_reopen_wallet_after_incremental_writes(self):
+        d = create_new_wallet(path=self.wallet_path, config=self.config, encrypt_file=False)
+        wallet = d['wallet']  # type: Standard_Wallet
+        wallet.set_label('some_key', 'some label')
+        wallet.create_new_address(for_change=False)
+        wallet.create_new_address(for_change=True)
+        wallet.save_db()
+        wallet.set_label('some_key', None)
+        wallet.save_db()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual(json.loads(wallet.db.dump()), json.loads(db.dump()))
+        self.assertEqual(wallet.get_receiving_addresses(), db.get('addresses')['receiving'])
+
+    def test_save_backup_incrementally(self):
+        backup_dir = os.path.join(self.user_dir, 'backups')
+        os.mkdir(backup_dir)
+        self.config.set_key('backup_dir', backup_dir)
+        d = create_new_wallet(path=self.wallet_path, config=self.config, encrypt_file=False)
+        wallet = d['wallet']  # type: Standard_Wallet
+        backup_path = wallet.save_backup()
+        size_after_full_write = os.path.getsize(backup_path)
+        wallet.set_label('some_key', 'some label')
+        wallet.create_new_address(for_change=False)
+        self.assertEqual(backup_path, wallet.save_backup())
+        with open(backup_path, "r") as f:
+            contents = f.read()
+        # the changes were appended
+        self.assertEqual(size_after_full_write, contents.index(',\n{"op"'))
+        backup_db = WalletDB(contents, manual_upgrades=False)
+        expected = json.loads(wallet.db.dump())
+        expected.pop('channels', None)
+        expected.pop('lightning_privkey2', None)
+        self.assertEqual(expected, json.loads(backup_db.dump()))
+
+    def test_save_backup_of_encrypted_wallet(self):
+        backup_dir = os.path.join(self.user_dir, 'backups')
+        os.mkdir(backup_dir)
+        self.config.set_key('backup_dir', backup_dir)
+        d = create_new_wallet(path=self.wallet_path, config=self.config, password='password', encrypt_file=True)
+        wallet = d['wallet']  # type: Standard_Wallet
+        backup_path = wallet.save_backup()
+        wallet.set_label('some_key', 'some label')
+        self.assertEqual(backup_path, wallet.save_backup())
+        # always a full write: no copy of the db is kept, and changes are not tracked
+        self.assertIsNone(wallet._backup)
+        self.assertIsNone(wallet.db.pop_dirty_paths('backup'))
+        storage = WalletStorage(backup_path)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt('password')
+        backup_db = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual('some label', backup_db.get('labels')['some_key'])
+
+    def test_failed_backup_keeps_dirty_paths(self):
+        backup_dir = os.path.join(self.user_dir, 'backups')
+        os.mkdir(backup_dir)
+        self.config.set_key('backup_dir', backup_dir)
+        d = create_new_wallet(path=self.wallet_path, config=self.config, encrypt_file=False)
+        wallet = d['wallet']  # type: Standard_Wallet
+        backup_path = wallet.save_backup()
+        # a change that patches do not capture: the backup gets fully rewritten
+        wallet.db.set_modified(True)
+        wallet.set_label('some_key', 'some label')
+        with mock.patch('os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                wallet.save_backup()
+        self.assertEqual(backup_path, wallet.save_backup())
+        storage = WalletStorage(backup_path)
+        backup_db = WalletDB(storage.read(), manual_upgrades=False)
+        self.assertEqual('some label', backup_db.get('labels')['some_key'])
+
+    def test_save_db_coalesces_writes(self):
+        d = create_new_wallet(path=self.wallet_path, config=self.config, encrypt_file=False)
+        wallet = d['wallet']  # type: Standard_Wallet
+        try:
+            self.config.set_key('wallet_save_delay', 0.2)
+            wallet.network = mock.Mock()
+            writes = wallet.get_save_db_stats()['writes']
+            # save requests come from network callbacks, which may run in daemon threads
+            def save_labels():
+                for i in range(10):
+                    wallet.set_label('key%d' % i, 'label')
+                    wallet.save_db()
+            t = threading.Thread(target=save_labels, daemon=True)
+            t.start()
+            t.join()
+            self.assertEqual(writes, wallet.get_save_db_stats()['writes'])
+            time.sleep(0.5)
+            self.assertEqual(writes + 1, wallet.get_save_db_stats()['writes'])
+            self.assertEqual('label', WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False).get('labels')['key9'])
+            # flush writes right away
+            wallet.set_label('key', 'label')
+            wallet.save_db(flush=True)
+            self.assertEqual(writes + 2, wallet.get_save_db_stats()['writes'])
+            # writes refused by the db are not counted
+            wallet.set_label('key', 'other label')
+            t = threading.Thread(target=partial(wallet.save_db, flush=True), daemon=True)
+            t.start()
+            t.join()
+            self.assertEqual(writes + 2, wallet.get_save_db_stats()['writes'])
+            self.assertTrue(wallet.db.modified())
+        finally:
+            wallet.network = None
+
     def test_restore_wallet_from_text_mnemonic(self):
         text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
         passphrase = 'mypassphrase'
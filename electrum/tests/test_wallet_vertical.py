@@ -5,13 +5,14 @@ import tempfile
 from typing import Sequence
 import asyncio
 import copy
+import time
 
 from electrum import storage, bitcoin, keystore, bip32, wallet
 from electrum import Transaction
 from electrum import SimpleConfig
 from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
 from electrum.wallet import sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet, restore_wallet_from_text, Abstract_Wallet
-from electrum.util import bfh, bh2u
+from electrum.util import bfh, bh2u, TxMinedInfo
 from electrum.transaction import TxOutput, Transaction, PartialTransaction, PartialTxOutput, PartialTxInput, tx_from_any
 from electrum.mnemonic import seed_type
 
@@ -2515,6 +2516,118 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
 
+    def _assert_indexes_match_history(self, w):
+        # recompute utxos and balances by walking the address histories
+        utxos = set()
+        balance = [0, 0, 0]
+        for addr in w.get_addresses():
+            for prevout, txin in w.get_addr_outputs(addr).items():
+                if txin.spent_height is None:
+                    utxos.add((prevout.to_str(), txin.block_height))
+            received, sent = w.get_addr_io(addr)
+            for txo, (tx_height, v, is_cb) in received.items():
+                balance[0 if tx_height > 0 else 1] += v
+                if txo in sent:
+                    balance[0 if sent[txo] > 0 else 1] -= v
+        self.assertEqual(utxos, {(txin.prevout.to_str(), txin.block_height) for txin in w.get_utxos()})
+        self.assertEqual(tuple(balance), w.get_balance())
+        # compare the history index with a full recomputation
+        h1 = w.get_history()
+        h2 = w.get_history(domain=w.get_addresses())
+        self.assertEqual({(x.txid, x.delta, x.fee) for x in h2}, {(x.txid, x.delta, x.fee) for x in h1})
+        self.assertEqual(sorted(h1, key=lambda x: w.get_txpos(x.txid)), h1)
+        running_balance = 0
+        for item in h1:
+            running_balance += item.delta
+            self.assertEqual(running_balance, item.balance)
+        self.assertEqual(sum(w.get_balance()), running_balance)
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    @mock.patch('electrum.util.trigger_callback')
+    def test_indexes_follow_verification_and_removal(self, mock_trigger_callback, mock_save_db):
+        w = self.create_old_wallet()
+        for i, txid in enumerate(self.txid_list):
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, 1000 + i)
+            self._assert_indexes_match_history(w)
+        # once verified, spent coins are dropped from the index
+        for i, txid in enumerate(self.txid_list):
+            w.add_verified_tx(txid, TxMinedInfo(height=1000 + i, timestamp=0, txpos=0, header_hash='00' * 32))
+        self.assertEqual(0, sum(len(d) for d in w._unsettled_spent_txos.values()))
+        self._assert_indexes_match_history(w)
+        self.assertEqual((27633300, 0, 0), w.get_balance())
+        # txs becoming unconfirmed again
+        for txid in self.txid_list[::3]:
+            w.add_unverified_tx(txid, TX_HEIGHT_UNCONFIRMED)
+        self._assert_indexes_match_history(w)
+        # removing txs
+        for txid in self.txid_list[::4]:
+            if w.db.get_transaction(txid):
+                for child in w.get_depending_transactions(txid) | {txid}:
+                    w.remove_transaction(child)
+        self._assert_indexes_match_history(w)
+        # reloading rebuilds the same index
+        utxos = w._utxos
+        w.load_utxo_index()
+        self.assertEqual({k: v for k, v in utxos.items() if v}, {k: v for k, v in w._utxos.items() if v})
+
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    @mock.patch('electrum.util.trigger_callback')
+    def test_history_paging_and_time_range(self, mock_trigger_callback, mock_save_db):
+        w = self.create_old_wallet()
+        for i, txid in enumerate(self.txid_list):
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, 1000 + i)
+        # all but the last two are mined. timestamps are not monotonic
+        for i, txid in enumerate(self.txid_list[:-2]):
+            timestamp = 1_600_000_000 + 600 * i - (2000 if i == 5 else 0)
+            w.add_verified_tx(txid, TxMinedInfo(height=1000 + i, timestamp=timestamp, txpos=0, header_hash='00' * 32))
+        full = w.get_history()
+        self.assertEqual(len(self.txid_list), len(full))
+        # paging with a cursor
+        pages = []
+        after_txid = None
+        while True:
+            page = w.get_history(after_txid=after_txid, limit=4)
+            pages += page
+            if len(page) < 4:
+                break
+            after_txid = page[-1].txid
+        self.assertEqual(full, pages)
+        # offset and limit
+        self.assertEqual(full[3:8], w.get_history(offset=3, limit=5))
+        self.assertEqual(full[5:], w.get_history(after_txid=full[2].txid, offset=2))
+        # time range, consistent with the full recomputation
+        for from_timestamp, to_timestamp in [(1_600_000_000 + 1700, 1_600_000_000 + 3500),
+                                             (1_600_000_000 + 2900, None),
+                                             (None, 1_600_000_000 + 1000)]:
+            expected = [item for item in full
+                        if not (from_timestamp and (item.tx_mined_status.timestamp or time.time()) < from_timestamp)
+                        and not (to_timestamp and (item.tx_mined_status.timestamp or time.time()) >= to_timestamp)]
+            self.assertTrue(expected)
+            self.assertEqual(expected, w.get_history(from_timestamp=from_timestamp, to_timestamp=to_timestamp))
+            self.assertEqual(expected, w.get_history(domain=w.get_addresses(),
+                                                     from_timestamp=from_timestamp, to_timestamp=to_timestamp))
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    @mock.patch('electrum.util.trigger_callback')
+    def test_iter_detailed_history_survives_removed_cursor(self, mock_trigger_callback, mock_save_db):
+        w = self.create_old_wallet()
+        for i, txid in enumerate(self.txid_list):
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, 1000 + i)
+        full = [item.txid for item in w.get_history()]
+        it = w.iter_detailed_history(page_size=4)
+        first_page = [next(it)['txid'] for _ in range(4)]
+        self.assertEqual(full[:4], first_page)
+        # the last tx of the page (and its children) leave the history mid-export
+        w.remove_transaction(first_page[-1])
+        remaining = [item.txid for item in w.get_history()]
+        self.assertNotIn(first_page[-1], remaining)
+        rest = list(it)
+        self.assertIn('start_balance', rest[-1])
+        self.assertEqual(remaining[3:], [item['txid'] for item in rest[:-1]])
 
 class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
     transactions = {
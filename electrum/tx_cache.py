@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""On-disk cache of raw transactions, keyed by txid.
+
+Each tx is stored once, as binary, in <path>/<txid[:2]>/<txid>, whichever
+wallet or component fetched it. The total size is bounded: the least
+recently used txs are evicted first. Recency is kept in the mtime of the
+files, so that it survives restarts.
+
+Only txs whose txid was checked by the caller may be put in the cache.
+The txid is checked again when a tx is read, so that a truncated or
+corrupted file is dropped instead of being served.
+
+The methods do blocking file I/O: call them from a thread, not from
+the event loop.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from .logging import Logger
+from .transaction import Transaction
+from .util import make_dir, is_hash256_str
+
+
+DEFAULT_TX_CACHE_SIZE = 100 * 1024 * 1024  # bytes on disk
+
+
+class TxCache(Logger):
+
+    def __init__(self, path: str, max_size: int = DEFAULT_TX_CACHE_SIZE):
+        Logger.__init__(self)
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._files = OrderedDict()  # type: OrderedDict[str, int]  # txid -> size, least recently used first
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        make_dir(self.path)
+        self._load()
+
+    def _load(self) -> None:
+        files = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if not is_hash256_str(entry.name):
+                    continue  # e.g. leftover temporary file
+                st = entry.stat()
+                files.append((st.st_mtime, entry.name, st.st_size))
+        files.sort()
+        for mtime, txid, size in files:
+            self._files[txid] = size
+            self._size += size
+        self.logger.info(f"{len(self._files)} txs, {self._size} bytes")
+        self._evict()
+
+    def _filename(self, txid: str) -> str:
+        return os.path.join(self.path, txid[:2], txid)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, txid: str):
+        return txid in self._files
+
+    def get_size(self) -> int:
+        return self._size
+
+    def get(self, txid: str) -> Optional[str]:
+        """Returns the raw tx as hex, or None if it is not in the cache."""
+        with self.lock:
+            if txid not in self._files:
+                self.misses += 1
+                return None
+            filename = self._filename(txid)
+            try:
+                with open(filename, 'rb') as f:
+                    raw = f.read()
+                os.utime(filename)
+            except OSError as e:
+                self.logger.info(f"could not read {txid}: {e!r}")
+                self._size -= self._files.pop(txid)
+                self.misses += 1
+                return None
+            raw_tx = raw.hex()
+            try:
+                is_valid = Transaction(raw_tx).txid() == txid
+            except Exception:
+                is_valid = False
+            if not is_valid:
+                self.logger.info(f"dropping corrupted file for {txid}")
+                self._size -= self._files.pop(txid)
+                self._unlink(txid)
+                self.misses += 1
+                return None
+            self._files.move_to_end(txid)
+            self.hits += 1
+            return raw_tx
+
+    def put(self, txid: str, raw_tx: str) -> None:
+        assert is_hash256_str(txid), txid
+        with self.lock:
+            if txid in self._files:
+                return
+            raw = bytes.fromhex(raw_tx)
+            if len(raw) > self.max_size:
+                return
+            filename = self._filename(txid)
+            make_dir(os.path.dirname(filename))
+            tmp = filename + '.tmp'
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(raw)
+                os.replace(tmp, filename)
+            except OSError as e:
+                self.logger.info(f"could not write {txid}: {e!r}")
+                return
+            self._files[txid] = len(raw)
+            self._size += len(raw)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_size:
+            txid, size = self._files.popitem(last=False)
+            self._size -= size
+            self._unlink(txid)
+
+    def _unlink(self, txid: str) -> None:
+        try:
+            os.unlink(self._filename(txid))
+        except OSError:
+            pass
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'txs': len(self._files),
+                'size': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
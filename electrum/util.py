@@ -1129,6 +1129,13 @@ class NetworkJobOnDefaultServer(Logger):
         server connection changes.
         """
         self.taskgroup = SilentTaskGroup()
+        # set when there might be new work for the job; see wakeup()
+        self._wakeup = asyncio.Event()
+
+    def wakeup(self) -> None:
+        """Tells the job to look for new work. Can be called from any thread."""
+        if not self._wakeup.is_set():
+            self.network.asyncio_loop.call_soon_threadsafe(lambda: self._wakeup.set())
 
     async def _start(self, interface: 'Interface'):
         self.interface = interface
@@ -21,16 +21,12 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from typing import Sequence, Optional, TYPE_CHECKING, Dict, Tuple, List
 
-import aiorpcx
-
-from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
+from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer, register_callback, unregister_callback
 from .crypto import sha256d
 from .bitcoin import hash_decode, hash_encode
 from .transaction import Transaction
-from .blockchain import hash_header
 from .interface import GracefulDisconnect
 from .network import UntrustedServerReturnedError
 from . import constants
@@ -49,15 +45,27 @@ class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
+    # max number of merkle proofs requested in a single batch
+    MAX_PROOFS_PER_BATCH = 100
+
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         NetworkJobOnDefaultServer.__init__(self, network)
+        register_callback(self._on_blockchain_updated, ['blockchain_updated', 'network_updated'])
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
 
+    async def stop(self):
+        unregister_callback(self._on_blockchain_updated)
+        await super().stop()
+
+    def _on_blockchain_updated(self, event, *args):
+        # new headers, or a chain switch
+        self._wakeup.set()
+
     async def _start_tasks(self):
         async with self.taskgroup as group:
             await group.spawn(self.main)
@@ -68,14 +76,16 @@ class SPV(NetworkJobOnDefaultServer):
     async def main(self):
         self.blockchain = self.network.blockchain()
         while True:
+            self._wakeup.clear()
             await self._maybe_undo_verifications()
             await self._request_proofs()
-            await asyncio.sleep(0.1)
+            await self._wakeup.wait()
 
     async def _request_proofs(self):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
-
+        to_request = []  # type: List[Tuple[str, int]]
+        have_header = {}  # type: Dict[int, bool]
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -84,55 +94,75 @@ class SPV(NetworkJobOnDefaultServer):
             if tx_height <= 0 or tx_height > local_height:
                 continue
             # if it's in the checkpoint region, we still might not have the header
-            header = self.blockchain.read_header(tx_height)
-            if header is None:
-                if tx_height < constants.net.max_checkpoint():
-                    await self.taskgroup.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+            if tx_height not in have_header:
+                have_header[tx_height] = self.blockchain.read_header_view(tx_height) is not None
+                if not have_header[tx_height] and tx_height < constants.net.max_checkpoint():
+                    await self.taskgroup.spawn(self._request_chunk(tx_height))
+            if not have_header[tx_height]:
                 continue
-            # request now
-            self.logger.info(f'requested merkle {tx_hash}')
-            self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
-
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
+            to_request.append((tx_hash, tx_height))
+        # request now; txs of the same block go in the same batch where possible
+        to_request.sort(key=lambda x: x[1])
+        for i in range(0, len(to_request), self.MAX_PROOFS_PER_BATCH):
+            batch = to_request[i:i + self.MAX_PROOFS_PER_BATCH]
+            self.logger.info(f'requested {len(batch)} merkle proofs, heights {batch[0][1]}-{batch[-1][1]}')
+            self.requested_merkle.update(tx_hash for tx_hash, tx_height in batch)
+            await self.taskgroup.spawn(self._request_and_verify_proofs, batch)
+
+    async def _request_chunk(self, height: int):
+        await self.network.request_chunk(height, None, can_return_early=True)
+        self._wakeup.set()
+
+    async def _request_and_verify_proofs(self, txs: Sequence[Tuple[str, int]]):
+        results = await self.network.shared_sync.get_merkle_for_transactions(txs)
+        # read each block header once.
         # we need to wait if header sync/reorg is still ongoing, hence lock:
+        headers = {}  # type: Dict[int, Tuple[Optional[dict], Optional[str]]]  # height -> (header, hash)
         async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.logger.info(f"skipping merkle proof check {tx_hash}")
+            chain = self.network.blockchain()
+            for res in results:
+                if isinstance(res, UntrustedServerReturnedError):
+                    continue
+                tx_height = res.get('block_height')
+                if tx_height not in headers:
+                    header = chain.read_header_view(tx_height)
+                    headers[tx_height] = (header.to_dict(), header.hash()) if header else (None, None)
+        num_verified = 0
+        for (tx_hash, tx_height), res in zip(txs, results):
+            if isinstance(res, UntrustedServerReturnedError):
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                continue
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            if tx_height != res.get('block_height'):
+                self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
+                                 .format(tx_height, res.get('block_height'), tx_hash))
+            tx_height = res.get('block_height')
+            pos = res.get('pos')
+            merkle_branch = res.get('merkle')
+            header, header_hash = headers[tx_height]
+            try:
+                verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
+            except MerkleVerificationFailure as e:
+                if self.network.config.get("skipmerklecheck"):
+                    self.logger.info(f"skipping merkle proof check {tx_hash}")
+                else:
+                    self.logger.info(repr(e))
+                    raise GracefulDisconnect(e) from e
             else:
-                self.logger.info(repr(e))
-                raise GracefulDisconnect(e) from e
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        self.requested_merkle.discard(tx_hash)
-        self.logger.info(f"verified {tx_hash}")
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
-                              timestamp=header.get('timestamp'),
-                              txpos=pos,
-                              header_hash=header_hash)
-        self.wallet.add_verified_tx(tx_hash, tx_info)
+                self.network.shared_sync.add_verified_proof(tx_hash, header_hash, res)
+            # we passed all the tests
+            self.merkle_roots[tx_hash] = header.get('merkle_root')
+            self.requested_merkle.discard(tx_hash)
+            tx_info = TxMinedInfo(height=tx_height,
+                                  timestamp=header.get('timestamp'),
+                                  txpos=pos,
+                                  header_hash=header_hash)
+            self.wallet.add_verified_tx(tx_hash, tx_info)
+            num_verified += 1
+        self.logger.info(f"verified {num_verified} txs")
 
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
@@ -186,6 +216,7 @@ class SPV(NetworkJobOnDefaultServer):
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
         self.requested_merkle.discard(tx_hash)
+        self.wakeup()
 
     def is_up_to_date(self):
         return not self.requested_merkle
@@ -36,6 +36,7 @@ import errno
 import traceback
 import operator
 import math
+import threading
 from functools import partial
 from collections import defaultdict
 from numbers import Number
@@ -55,7 +56,7 @@ from .util import (NotEnoughFunds, UserCancelled, profiler,
                    WalletFileException, BitcoinException, MultipleSpendMaxTxOutputs,
                    InvalidPassword, format_time, timestamp_to_datetime, Satoshis,
                    Fiat, bfh, bh2u, TxMinedInfo, quantize_feerate, create_bip21_uri, OrderedDictWithIndex)
-from .util import get_backup_dir
+from .util import get_backup_dir, standardize_path
 from .simple_config import SimpleConfig
 from .bitcoin import COIN, TYPE_ADDRESS
 from .bitcoin import is_address, address_to_script, is_minikey, relayfee, dust_threshold
@@ -237,6 +238,75 @@ class TxWalletDetails(NamedTuple):
     is_lightning_funding_tx: bool
 
 
+class DetailedHistorySummary:
+    """Computes the summary of get_detailed_history, one tx at a time."""
+
+    def __init__(self, wallet: 'Abstract_Wallet', *, fx, from_timestamp, to_timestamp):
+        self.wallet = wallet
+        self.fx = fx if fx and fx.is_enabled() and fx.get_history_config() else None
+        self.from_timestamp = from_timestamp
+        self.to_timestamp = to_timestamp
+        self.first_item = None
+        self.last_item = None
+        self.income = 0
+        self.expenditures = 0
+        self.capital_gains = Decimal(0)
+        self.fiat_income = Decimal(0)
+        self.fiat_expenditures = Decimal(0)
+
+    def add_item(self, item) -> None:
+        if self.first_item is None:
+            self.first_item = item
+        self.last_item = item
+        # fixme: use in and out values
+        value = item['bc_value'].value
+        if value < 0:
+            self.expenditures += -value
+        else:
+            self.income += value
+        if self.fx:
+            fiat_value = item['fiat_value'].value
+            if value < 0:
+                self.capital_gains += item['capital_gain'].value
+                self.fiat_expenditures += -fiat_value
+            else:
+                self.fiat_income += fiat_value
+
+    def to_dict(self) -> dict:
+        if self.first_item is None:
+            return {}
+        fx = self.fx
+        b, v = self.first_item['bc_balance'].value, self.first_item['bc_value'].value
+        start_balance = None if b is None or v is None else b - v
+        end_balance = self.last_item['bc_balance'].value
+        if self.from_timestamp is not None and self.to_timestamp is not None:
+            start_date = timestamp_to_datetime(self.from_timestamp)
+            end_date = timestamp_to_datetime(self.to_timestamp)
+        else:
+            start_date = None
+            end_date = None
+        summary = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'start_balance': Satoshis(start_balance),
+            'end_balance': Satoshis(end_balance),
+            'incoming': Satoshis(self.income),
+            'outgoing': Satoshis(self.expenditures)
+        }
+        if fx:
+            unrealized = self.wallet.unrealized_gains(None, fx.timestamp_rate, fx.ccy)
+            summary['fiat_currency'] = fx.ccy
+            summary['fiat_capital_gains'] = Fiat(self.capital_gains, fx.ccy)
+            summary['fiat_incoming'] = Fiat(self.fiat_income, fx.ccy)
+            summary['fiat_outgoing'] = Fiat(self.fiat_expenditures, fx.ccy)
+            summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
+            summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
+            summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
+            summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
+            summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        return summary
+
+
 class Abstract_Wallet(AddressSynchronizer, ABC):
     """
     Wallet classes are created to handle various address generation methods.
@@ -285,18 +355,93 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         self._coin_price_cache = {}
 
         self.lnworker = None
+        self._backup = None  # type: Optional[Tuple[WalletDB, WalletStorage]]
+        # write-behind state, see save_db
+        self._save_db_lock = threading.Lock()
+        self._save_db_timer = None  # type: Optional[threading.Timer]
+        self._save_db_stats = {'requests': 0, 'writes': 0, 'total_time': 0.0, 'max_time': 0.0}
         # a wallet may have channel backups, regardless of lnworker activation
         self.lnbackups = LNBackups(self)
 
-    def save_db(self):
-        if self.storage:
-            self.db.write(self.storage)
+    def save_db(self, *, flush: bool = False) -> None:
+        """Writes the db to storage.
+
+        When the wallet runs on the network, writes are coalesced: requests are
+        collected for 'wallet_save_delay' seconds, then the db is written once,
+        in a timer thread. Use flush=True for changes that must be on disk
+        before proceeding.
+        """
+        if not self.storage:
+            return
+        delay = self.config.get('wallet_save_delay', 1)
+        with self._save_db_lock:
+            self._save_db_stats['requests'] += 1
+            if not (flush or not delay or self.network is None):
+                if self._save_db_timer is None:
+                    self._save_db_timer = threading.Timer(delay, self._write_db)
+                    # WalletDB does not write from daemon threads
+                    self._save_db_timer.daemon = False
+                    self._save_db_timer.start()
+                return
+        self._write_db()
+
+    def _write_db(self) -> None:
+        with self._save_db_lock:
+            timer, self._save_db_timer = self._save_db_timer, None
+        if timer is not None:
+            # this write covers the scheduled one
+            timer.cancel()
+        if not self.db.modified():
+            return
+        t0 = time.monotonic()
+        if not self.db.write(self.storage):
+            return
+        dt = time.monotonic() - t0
+        with self._save_db_lock:
+            stats = self._save_db_stats
+            stats['writes'] += 1
+            stats['total_time'] += dt
+            stats['max_time'] = max(stats['max_time'], dt)
+
+    def get_save_db_stats(self) -> dict:
+        """Returns the number of save requests and actual writes, and write latency."""
+        with self._save_db_lock:
+            stats = dict(self._save_db_stats)
+        stats['avg_time'] = stats['total_time'] / stats['writes'] if stats['writes'] else 0
+        return stats
 
     def save_backup(self):
         backup_dir = get_backup_dir(self.config)
         if backup_dir is None:
             return
-        new_db = WalletDB(self.db.dump(), manual_upgrades=False)
+        new_path = os.path.join(backup_dir, self.basename() + '.backup')
+        # if we wrote a backup before, only copy the parts of the db that changed since.
+        # encrypted files are always fully rewritten, so there is nothing to gain from
+        # keeping a copy of the db in memory
+        incremental = not self.storage.is_encrypted()
+        with self.db.lock:
+            dirty_paths = self.db.pop_dirty_paths('backup')
+            if (incremental
+                    and self._backup is not None
+                    and dirty_paths is not None
+                    and () not in dirty_paths
+                    and self._backup[1].path == standardize_path(new_path)
+                    and self._backup[1].pubkey == self.storage.pubkey
+                    and os.path.exists(new_path)):
+                new_db, new_storage = self._backup
+                new_db.copy_paths_from(self.db, dirty_paths, exclude=['channels', 'lightning_privkey2'])
+            else:
+                new_db = WalletDB(self.db.dump(), manual_upgrades=False)
+                if incremental:
+                    self.db.track_dirty_paths('backup')
+                else:
+                    self.db.untrack_dirty_paths('backup')
+                # if the full write fails, the next backup must be a full one too
+                dirty_paths = {()}
+                new_storage = WalletStorage(new_path)
+                new_storage._encryption_version = self.storage._encryption_version
+                new_storage.pubkey = self.storage.pubkey
+                new_db.set_modified(True)
 
         if self.lnworker:
             channel_backups = new_db.get_dict('channel_backups')
@@ -305,12 +450,13 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
             new_db.put('channels', None)
             new_db.put('lightning_privkey2', None)
 
-        new_path = os.path.join(backup_dir, self.basename() + '.backup')
-        new_storage = WalletStorage(new_path)
-        new_storage._encryption_version = self.storage._encryption_version
-        new_storage.pubkey = self.storage.pubkey
-        new_db.set_modified(True)
-        new_db.write(new_storage)
+        try:
+            new_db.write(new_storage)
+        except BaseException:
+            # the changes did not make it to the file; copy them again next time
+            self.db.restore_dirty_paths('backup', dirty_paths)
+            raise
+        self._backup = (new_db, new_storage) if incremental else None
         return new_path
 
     def has_lightning(self):
@@ -341,7 +487,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 self.lnworker = None
             self.lnbackups.stop()
             self.lnbackups = None
-        self.save_db()
+        self.save_db(flush=True)
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -675,17 +821,19 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         # return last balance
         return balance
 
-    def get_onchain_history(self, *, domain=None):
-        monotonic_timestamp = 0
-        for hist_item in self.get_history(domain=domain):
-            monotonic_timestamp = max(monotonic_timestamp, (hist_item.tx_mined_status.timestamp or 999_999_999_999))
+    def get_onchain_history(self, *, domain=None, from_timestamp=None, to_timestamp=None,
+                            after_txid=None, after_txpos=None, offset=0, limit=None):
+        history = self.get_history(
+            domain=domain, from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+            after_txid=after_txid, after_txpos=after_txpos, offset=offset, limit=limit)
+        for hist_item in history:
             yield {
                 'txid': hist_item.txid,
                 'fee_sat': hist_item.fee,
                 'height': hist_item.tx_mined_status.height,
                 'confirmations': hist_item.tx_mined_status.conf,
                 'timestamp': hist_item.tx_mined_status.timestamp,
-                'monotonic_timestamp': monotonic_timestamp,
+                'monotonic_timestamp': hist_item.monotonic_timestamp,
                 'incoming': True if hist_item.delta>0 else False,
                 'bc_value': Satoshis(hist_item.delta),
                 'bc_balance': Satoshis(hist_item.balance),
@@ -903,84 +1051,66 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
 
     @profiler
     def get_detailed_history(self, from_timestamp=None, to_timestamp=None,
-                             fx=None, show_addresses=False):
+                             fx=None, show_addresses=False, *,
+                             after_txid=None, after_txpos=None, offset=0, limit=None):
         # History with capital gains, using utxo pricing
         # FIXME: Lightning capital gains would requires FIFO
         out = []
-        income = 0
-        expenditures = 0
-        capital_gains = Decimal(0)
-        fiat_income = Decimal(0)
-        fiat_expenditures = Decimal(0)
-        now = time.time()
-        for item in self.get_onchain_history():
-            timestamp = item['timestamp']
-            if from_timestamp and (timestamp or now) < from_timestamp:
-                continue
-            if to_timestamp and (timestamp or now) >= to_timestamp:
-                continue
-            tx_hash = item['txid']
-            tx = self.db.get_transaction(tx_hash)
-            tx_fee = item['fee_sat']
-            item['fee'] = Satoshis(tx_fee) if tx_fee is not None else None
-            if show_addresses:
-                item['inputs'] = list(map(lambda x: x.to_json(), tx.inputs()))
-                item['outputs'] = list(map(lambda x: {'address': x.get_ui_address_str(), 'value': Satoshis(x.value)},
-                                           tx.outputs()))
-            # fixme: use in and out values
-            value = item['bc_value'].value
-            if value < 0:
-                expenditures += -value
-            else:
-                income += value
-            # fiat computations
-            if fx and fx.is_enabled() and fx.get_history_config():
-                fiat_fields = self.get_tx_item_fiat(tx_hash, value, fx, tx_fee)
-                fiat_value = fiat_fields['fiat_value'].value
-                item.update(fiat_fields)
-                if value < 0:
-                    capital_gains += fiat_fields['capital_gain'].value
-                    fiat_expenditures += -fiat_value
-                else:
-                    fiat_income += fiat_value
+        summary = DetailedHistorySummary(self, fx=fx, from_timestamp=from_timestamp, to_timestamp=to_timestamp)
+        onchain_history = self.get_onchain_history(
+            from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+            after_txid=after_txid, after_txpos=after_txpos, offset=offset, limit=limit)
+        for item in onchain_history:
+            item = self._get_detailed_history_item(item, fx=fx, show_addresses=show_addresses)
+            summary.add_item(item)
             out.append(item)
-        # add summary
-        if out:
-            b, v = out[0]['bc_balance'].value, out[0]['bc_value'].value
-            start_balance = None if b is None or v is None else b - v
-            end_balance = out[-1]['bc_balance'].value
-            if from_timestamp is not None and to_timestamp is not None:
-                start_date = timestamp_to_datetime(from_timestamp)
-                end_date = timestamp_to_datetime(to_timestamp)
-            else:
-                start_date = None
-                end_date = None
-            summary = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'start_balance': Satoshis(start_balance),
-                'end_balance': Satoshis(end_balance),
-                'incoming': Satoshis(income),
-                'outgoing': Satoshis(expenditures)
-            }
-            if fx and fx.is_enabled() and fx.get_history_config():
-                unrealized = self.unrealized_gains(None, fx.timestamp_rate, fx.ccy)
-                summary['fiat_currency'] = fx.ccy
-                summary['fiat_capital_gains'] = Fiat(capital_gains, fx.ccy)
-                summary['fiat_incoming'] = Fiat(fiat_income, fx.ccy)
-                summary['fiat_outgoing'] = Fiat(fiat_expenditures, fx.ccy)
-                summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
-                summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
-                summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
-                summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
-                summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
-        else:
-            summary = {}
         return {
             'transactions': out,
-            'summary': summary
+            'summary': summary.to_dict(),
         }
 
+    def iter_detailed_history(self, from_timestamp=None, to_timestamp=None,
+                              fx=None, show_addresses=False, *, page_size=1000):
+        """Yields the transactions of get_detailed_history, followed by its summary.
+
+        The history is read from the wallet one page at a time, so that
+        memory use does not depend on the size of the history.
+        Pages are chained by tx position rather than by txid, as the last
+        tx of a page may get removed or reorged before the next one is read.
+        """
+        summary = DetailedHistorySummary(self, fx=fx, from_timestamp=from_timestamp, to_timestamp=to_timestamp)
+        after_txpos = None
+        while True:
+            with self.lock:
+                page = list(self.get_onchain_history(
+                    from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+                    after_txpos=after_txpos, limit=page_size))
+                if page:
+                    last_txid = page[-1]['txid']
+                    after_txpos = (*self.get_txpos(last_txid), last_txid)
+            for item in page:
+                item = self._get_detailed_history_item(item, fx=fx, show_addresses=show_addresses)
+                summary.add_item(item)
+                yield item
+            if len(page) < page_size:
+                break
+        yield summary.to_dict()
+
+    def _get_detailed_history_item(self, item, *, fx, show_addresses):
+        tx_hash = item['txid']
+        tx_fee = item['fee_sat']
+        item['fee'] = Satoshis(tx_fee) if tx_fee is not None else None
+        if show_addresses:
+            tx = self.db.get_transaction(tx_hash)
+            item['inputs'] = list(map(lambda x: x.to_json(), tx.inputs()))
+            item['outputs'] = list(map(lambda x: {'address': x.get_ui_address_str(), 'value': Satoshis(x.value)},
+                                       tx.outputs()))
+        # fiat computations
+        if fx and fx.is_enabled() and fx.get_history_config():
+            fiat_fields = self.get_tx_item_fiat(tx_hash, item['bc_value'].value, fx, tx_fee)
+            item.update(fiat_fields)
+        return item
+
     def default_fiat_value(self, tx_hash, fx, value_sat):
         return value_sat / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
 
@@ -2027,7 +2157,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         self._update_password_for_keystore(old_pw, new_pw)
         encrypt_keystore = self.can_have_keystore_encryption()
         self.db.set_keystore_encryption(bool(new_pw) and encrypt_keystore)
-        self.save_db()
+        self.save_db(flush=True)
 
     @abstractmethod
     def _update_password_for_keystore(self, old_pw: Optional[str], new_pw: Optional[str]) -> None:
@@ -2325,6 +2455,7 @@ class Imported_Wallet(Simple_Wallet):
         self.set_frozen_state_of_addresses([address], False)
         pubkey = self.get_public_key(address)
         self.db.remove_imported_address(address)
+        self.reset_history_index()
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -39,7 +39,7 @@ from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransactio
 from .logging import Logger
 from .lnutil import LOCAL, REMOTE, FeeUpdate, UpdateAddHtlc, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKeypair, RevocationStore, ChannelBackupStorage
 from .lnutil import ChannelConstraints, Outpoint, ShachainElement
-from .json_db import StoredDict, JsonDB, locked, modifier
+from .json_db import StoredDict, JsonDB, locked, modifier, apply_patch
 from .plugin import run_hook, plugin_loaders
 from .paymentrequest import PaymentRequest
 from .submarine_swaps import SwapData
@@ -52,10 +52,13 @@ if TYPE_CHECKING:
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
 NEW_SEED_VERSION = 11       # electrum versions >= 2.0
-FINAL_SEED_VERSION = 32     # electrum >= 2.7 will set this to prevent
+FINAL_SEED_VERSION = 33     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
 
+MULTISIG_KEYSTORE_NAMES = frozenset(('x%d/' % i) for i in range(1, 16))
+
+
 class TxFeesValue(NamedTuple):
     fee: Optional[int] = None
     is_calculated_by_us: bool = False
@@ -67,6 +70,7 @@ class WalletDB(JsonDB):
     def __init__(self, raw, *, manual_upgrades: bool):
         JsonDB.__init__(self, {})
         self._manual_upgrades = manual_upgrades
+        self._loading = False
         self._called_after_upgrade_tasks = False
         if raw:  # loading existing db
             self.load_data(raw)
@@ -76,14 +80,17 @@ class WalletDB(JsonDB):
             self._after_upgrade_tasks()
 
     def load_data(self, s):
+        patches = []
         try:
-            self.data = json.loads(s)
+            # the file is a json dict, optionally followed by appended patches
+            self.data, *patches = self._parse_records(s)
         except:
             try:
                 d = ast.literal_eval(s)
                 labels = d.get('labels', {})
             except Exception as e:
                 raise WalletFileException("Cannot read wallet file. (parsing failed)")
+            self.set_modified(True)
             self.data = {}
             for key, value in d.items():
                 try:
@@ -95,6 +102,11 @@ class WalletDB(JsonDB):
                 self.data[key] = value
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
+        try:
+            for patch in patches:
+                apply_patch(self.data, patch)
+        except Exception as e:
+            raise WalletFileException(f"Cannot read wallet file. (applying patches failed: {repr(e)})") from e
 
         if not self._manual_upgrades and self.requires_split():
             raise WalletFileException("This wallet has multiple accounts and must be split")
@@ -104,6 +116,21 @@ class WalletDB(JsonDB):
         elif not self._manual_upgrades:
             self.upgrade()
 
+    def _parse_records(self, s: str) -> list:
+        try:
+            return json.loads('[' + s + ']')
+        except json.JSONDecodeError:
+            # an append to the file might have been interrupted. Patches
+            # never contain a newline, so the last one starts at the last ',\n'
+            i = s.rfind(',\n')
+            if i == -1:
+                raise
+            records = json.loads('[' + s[:i] + ']')
+            self.logger.warning(f'dropping incomplete patch at the end of the wallet file: {len(s) - i} chars')
+            # rewrite the file without it on the next save
+            self.set_modified(True)
+            return records
+
     def requires_split(self):
         d = self.get('accounts', {})
         return len(d) > 1
@@ -180,6 +207,7 @@ class WalletDB(JsonDB):
         self._convert_version_30()
         self._convert_version_31()
         self._convert_version_32()
+        self._convert_version_33()
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
 
         self._after_upgrade_tasks()
@@ -356,6 +384,7 @@ class WalletDB(JsonDB):
 
             # note: we don't remove 'addr' from self.get('addresses')
             remove_from_dict('addr_history')
+            remove_from_dict('addr_history_status')
             remove_from_dict('labels')
             remove_from_dict('payment_requests')
             remove_from_list('frozen_addresses')
@@ -729,6 +758,14 @@ class WalletDB(JsonDB):
             return
         self.put('accounts', None)
 
+    def _convert_version_33(self):
+        # changes are now appended to the file as patches, which older
+        # versions cannot parse. Nothing to convert: bumping the version
+        # makes them refuse the file instead.
+        if not self._is_upgrade_method_needed(32, 32):
+            return
+        self.data['seed_version'] = 33
+
     def _is_upgrade_method_needed(self, min_version, max_version):
         assert min_version <= max_version
         cur_version = self.get_seed_version()
@@ -777,20 +814,20 @@ class WalletDB(JsonDB):
     def get_txi_addresses(self, tx_hash: str) -> List[str]:
         """Returns list of is_mine addresses that appear as inputs in tx."""
         assert isinstance(tx_hash, str)
-        return list(self.txi.get(tx_hash, {}).keys())
+        return list(self.txi.peek(tx_hash, {}).keys())
 
     @locked
     def get_txo_addresses(self, tx_hash: str) -> List[str]:
         """Returns list of is_mine addresses that appear as outputs in tx."""
         assert isinstance(tx_hash, str)
-        return list(self.txo.get(tx_hash, {}).keys())
+        return list(self.txo.peek(tx_hash, {}).keys())
 
     @locked
     def get_txi_addr(self, tx_hash: str, address: str) -> Iterable[Tuple[str, int]]:
         """Returns an iterable of (prev_outpoint, value)."""
         assert isinstance(tx_hash, str)
         assert isinstance(address, str)
-        d = self.txi.get(tx_hash, {}).get(address, {})
+        d = self.txi.peek(tx_hash, {}).get(address, {})
         return list(d.items())
 
     @locked
@@ -798,7 +835,7 @@ class WalletDB(JsonDB):
         """Returns a dict: output_index -> (value, is_coinbase)."""
         assert isinstance(tx_hash, str)
         assert isinstance(address, str)
-        d = self.txo.get(tx_hash, {}).get(address, {})
+        d = self.txo.peek(tx_hash, {}).get(address, {})
         return {int(n): (v, cb) for (n, (v, cb)) in d.items()}
 
     @modifier
@@ -857,13 +894,13 @@ class WalletDB(JsonDB):
     @locked
     def get_spent_outpoints(self, prevout_hash: str) -> Sequence[str]:
         assert isinstance(prevout_hash, str)
-        return list(self.spent_outpoints.get(prevout_hash, {}).keys())
+        return list(self.spent_outpoints.peek(prevout_hash, {}).keys())
 
     @locked
     def get_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str]) -> Optional[str]:
         assert isinstance(prevout_hash, str)
         prevout_n = str(prevout_n)
-        return self.spent_outpoints.get(prevout_hash, {}).get(prevout_n)
+        return self.spent_outpoints.peek(prevout_hash, {}).get(prevout_n)
 
     @modifier
     def remove_spent_outpoint(self, prevout_hash: str, prevout_n: Union[int, str]) -> None:
@@ -887,17 +924,19 @@ class WalletDB(JsonDB):
         assert isinstance(scripthash, str)
         assert isinstance(prevout, TxOutpoint)
         assert isinstance(value, int)
-        if scripthash not in self._prevouts_by_scripthash:
-            self._prevouts_by_scripthash[scripthash] = set()
-        self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value))
+        # note: the set is replaced, not mutated, so that the change gets recorded
+        prevouts = self._prevouts_by_scripthash.get(scripthash, set())
+        self._prevouts_by_scripthash[scripthash] = prevouts | {(prevout.to_str(), value)}
 
     @modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
         assert isinstance(scripthash, str)
         assert isinstance(prevout, TxOutpoint)
         assert isinstance(value, int)
-        self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
-        if not self._prevouts_by_scripthash[scripthash]:
+        prevouts = self._prevouts_by_scripthash[scripthash] - {(prevout.to_str(), value)}
+        if prevouts:
+            self._prevouts_by_scripthash[scripthash] = prevouts
+        else:
             self._prevouts_by_scripthash.pop(scripthash)
 
     @locked
@@ -932,6 +971,11 @@ class WalletDB(JsonDB):
         assert isinstance(tx_hash, str)
         return self.transactions.get(tx_hash)
 
+    @locked
+    def has_transaction(self, tx_hash: str) -> bool:
+        assert isinstance(tx_hash, str)
+        return tx_hash in self.transactions
+
     @locked
     def list_transactions(self) -> Sequence[str]:
         return list(self.transactions.keys())
@@ -951,14 +995,29 @@ class WalletDB(JsonDB):
         return self.history.get(addr, [])
 
     @modifier
-    def set_addr_history(self, addr: str, hist) -> None:
+    def set_addr_history(self, addr: str, hist, *, status: str = None) -> None:
+        """status, if given, must be the status hash of hist (see synchronizer.history_status)"""
         assert isinstance(addr, str)
         self.history[addr] = hist
+        if status is not None:
+            self.history_status[addr] = status
+        else:
+            self.history_status.pop(addr, None)
 
     @modifier
     def remove_addr_history(self, addr: str) -> None:
         assert isinstance(addr, str)
         self.history.pop(addr, None)
+        self.history_status.pop(addr, None)
+
+    @locked
+    def get_addr_history_status(self, addr: str) -> Optional[str]:
+        """Returns the stored status hash of the history of addr, if any."""
+        return self.history_status.get(addr)
+
+    @modifier
+    def set_addr_history_status(self, addr: str, status: str) -> None:
+        self.history_status[addr] = status
 
     @locked
     def list_verified_tx(self) -> Sequence[str]:
@@ -1042,7 +1101,7 @@ class WalletDB(JsonDB):
     @locked
     def get_num_ismine_inputs_of_tx(self, txid: str) -> int:
         assert isinstance(txid, str)
-        txins = self.txi.get(txid, {})
+        txins = self.txi.peek(txid, {})
         return sum([len(tupls) for addr, tupls in txins.items()])
 
     @modifier
@@ -1081,12 +1140,14 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self.add_patch('add', ['addresses', 'change', '-'], addr)
 
     @modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self.add_patch('add', ['addresses', 'receiving', '-'], addr)
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -1136,7 +1197,12 @@ class WalletDB(JsonDB):
 
     @profiler
     def _load_transactions(self):
-        self.data = StoredDict(self.data, self, [])
+        # heavy sections are left as raw json until accessed, see _should_load_lazily
+        self._loading = True
+        try:
+            self.data = StoredDict(self.data, self, [])
+        finally:
+            self._loading = False
         # references in self.data
         # TODO make all these private
         # txid -> address -> prev_outpoint -> value
@@ -1146,22 +1212,34 @@ class WalletDB(JsonDB):
         self.transactions = self.get_dict('transactions')        # type: Dict[str, Transaction]
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
+        self.history_status = self.get_dict('addr_history_status')  # address -> status hash of its history
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
         self.tx_fees = self.get_dict('tx_fees')                  # type: Dict[str, TxFeesValue]
         # scripthash -> set of (outpoint, value)
         self._prevouts_by_scripthash = self.get_dict('prevouts_by_scripthash')  # type: Dict[str, Set[Tuple[str, int]]]
-        # remove unreferenced tx
-        for tx_hash in list(self.transactions.keys()):
-            if not self.get_txi_addresses(tx_hash) and not self.get_txo_addresses(tx_hash):
-                self.logger.info(f"removing unreferenced tx: {tx_hash}")
-                self.transactions.pop(tx_hash)
-        # remove unreferenced outpoints
-        for prevout_hash in self.spent_outpoints.keys():
-            d = self.spent_outpoints[prevout_hash]
-            for prevout_n, spending_txid in list(d.items()):
-                if spending_txid not in self.transactions:
-                    self.logger.info("removing unreferenced spent outpoint")
-                    d.pop(prevout_n)
+
+    @profiler
+    def remove_unreferenced_data(self, *, lock=None):
+        """Removes transactions and spent outpoints that are not referenced.
+        This walks the whole history, so it is not done while loading the db,
+        but scheduled by the wallet once it is up (see start_network).
+
+        lock: held along with the db lock for each item, so that changes
+              spanning several db calls are not pruned halfway.
+        """
+        lock = lock or self.lock
+        # note: the locks are only held per item, so that others can use the db meanwhile
+        for tx_hash in self.list_transactions():
+            with lock, self.lock:
+                if not self.get_txi_addresses(tx_hash) and not self.get_txo_addresses(tx_hash):
+                    self.logger.info(f"removing unreferenced tx: {tx_hash}")
+                    self.transactions.pop(tx_hash, None)
+        for prevout_hash in list(self.spent_outpoints.keys()):
+            with lock, self.lock:
+                for prevout_n, spending_txid in list(self.spent_outpoints.peek(prevout_hash, {}).items()):
+                    if spending_txid not in self.transactions:
+                        self.logger.info("removing unreferenced spent outpoint")
+                        self.remove_spent_outpoint(prevout_hash, prevout_n)
 
     @modifier
     def clear_history(self):
@@ -1170,6 +1248,7 @@ class WalletDB(JsonDB):
         self.spent_outpoints.clear()
         self.transactions.clear()
         self.history.clear()
+        self.history_status.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
         self._prevouts_by_scripthash.clear()
@@ -1214,23 +1293,42 @@ class WalletDB(JsonDB):
     def _should_convert_to_stored_dict(self, key) -> bool:
         if key == 'keystore':
             return False
-        multisig_keystore_names = [('x%d/' % i) for i in range(1, 16)]
-        if key in multisig_keystore_names:
+        if key in MULTISIG_KEYSTORE_NAMES:
             return False
         return True
 
-    def write(self, storage: 'WalletStorage'):
+    def _should_load_lazily(self, path) -> bool:
+        if not self._loading:
+            return False
+        if len(path) == 1:
+            return path[0] in ('transactions', 'txi', 'txo', 'spent_outpoints')
+        # channel logs: ['channels', channel_id, 'log']
+        return len(path) == 3 and path[0] == 'channels' and path[2] == 'log'
+
+    def write(self, storage: 'WalletStorage') -> bool:
+        """Writes the changes to storage. Returns whether the file was written."""
         with self.lock:
-            self._write(storage)
+            return self._write(storage)
 
-    def _write(self, storage: 'WalletStorage'):
+    def _write(self, storage: 'WalletStorage') -> bool:
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
-            return
+            return False
         if not self.modified():
-            return
-        storage.write(self.dump())
+            return False
+        written = True
+        if (self.needs_full_write()
+                or not storage.file_exists()
+                or storage.is_encrypted()
+                or storage.needs_consolidation()):
+            storage.write(self.dump())
+        elif self.pending_changes:
+            # only append what changed since the last write
+            storage.append(self.dump_pending_changes())
+        else:
+            written = False
         self.set_modified(False)
+        return written
 
     def is_ready_to_be_used_by_wallet(self):
         return not self.requires_upgrade() and self._called_after_upgrade_tasks